@@ -17,8 +17,24 @@ arg_group.add_argument("--init_remote",
                        help=_("Format the remote DB with the initial table structure."))
 arg_group.add_argument("--nuke_remote",
                        help=_("DELETES the remote DB and the default user roles."))
+arg_group.add_argument("--upgrade_remote",
+                       help=_("Add the tables and indexes of this version to an existing remote DB."))
+arg_group.add_argument("--prune_history",
+                       help=_("Move the old versions of the remote DB's history to its archive tables, "
+                              "or to a file (--output), following the retention policies."))
+arg_group.add_argument("--build_snapshot",
+                       help=_("Write the ready-to-install local DB of a base (--base) to a file (--output)."))
+arg_group.add_argument("--relay",
+                       help=_("Serve the local DB to the other desktops of the site on host:port."))
 parser.add_argument("--password",
-                    help=_("Provide the master password to the remote DB, for the init and nuke operations"))
+                    help=_("Provide the master password to the remote DB, "
+                           "for the init, upgrade, prune and nuke operations"))
+parser.add_argument("--login",
+                    help=_("Remote DB user for the snapshot and relay operations"))
+parser.add_argument("--base",
+                    help=_("Code of the base to snapshot, ie BASE-12"))
+parser.add_argument("--output",
+                    help=_("Snapshot or history archive file to write"))
 args = parser.parse_args()
 
 
@@ -30,5 +46,13 @@ if __name__ == '__main__':
         H3.GUI.GUIMain.init_remote(args.init_remote, args.password)
     elif args.nuke_remote:
         H3.GUI.GUIMain.nuke_remote(args.nuke_remote, args.password)
+    elif args.upgrade_remote:
+        H3.GUI.GUIMain.upgrade_remote(args.upgrade_remote, args.password)
+    elif args.prune_history:
+        H3.GUI.GUIMain.prune_history(args.prune_history, args.password, args.output)
+    elif args.build_snapshot:
+        H3.GUI.GUIMain.build_snapshot(args.build_snapshot, args.login, args.password, args.base, args.output)
+    elif args.relay:
+        H3.GUI.GUIMain.run_relay(args.relay, args.login, args.password)
     else:
         H3.GUI.GUIMain.run()
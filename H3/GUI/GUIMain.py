@@ -13,6 +13,8 @@ from iso3166 import countries
 
 from H3.core import AlchemyClassDefs as Acd
 from H3.core import AlchemyCore
+from H3.core import AlchemyImport
+from H3.core import AlchemyRelay
 
 H3Core = AlchemyCore.H3AlchemyCore()
 
@@ -50,6 +52,7 @@ class SetupWizard:
         self.wizard.remote_ok = False
         self.wizard.user_ok = False
         self.wizard.pw_ok = False
+        self.wizard.snapshot_file = ""
 
         if H3Core.local_db:
             self.wizard.localAddress.setText(H3Core.local_db.location)
@@ -97,6 +100,9 @@ class SetupWizard:
             H3Core.internal_state["user"] = "remote"
         elif H3Core.internal_state["user"] == "remote":
             H3Core.remote_login(username, password)
+        if self.wizard.snapshot_file:
+            if not H3Core.wizard_install_snapshot(self.wizard.snapshot_file):
+                self.gui.set_status(_("Snapshot could not be installed, downloading base data instead"))
         H3Core.initial_setup()
         self.gui.set_status(_("Initial data downloaded and ready"))
 
@@ -360,10 +366,16 @@ class RecapWizardPage(QtGui.QWizardPage):
                                                 _("H3 will now download the data for the office this user is "
                                                   "affected to. If this is not a new H3 installation, "
                                                   "please consider deleting and rebuilding your local Database file, "
-                                                  "or use the administrative options in H3 to remove old data."),
+                                                  "or use the administrative options in H3 to remove old data.\n"
+                                                  "If your focal point gave you a snapshot file for this office, "
+                                                  "installing it is much faster."),
                                                 QtGui.QMessageBox.Ok)
+                snapshot_button = message_box.addButton(_("Install snapshot file"), QtGui.QMessageBox.ActionRole)
                 message_box.setWindowIcon(QtGui.QIcon(":/images/H3.png"))
                 message_box.exec_()
+                if message_box.clickedButton() == snapshot_button:
+                    filename = QtGui.QFileDialog.getOpenFileName(self, _("Choose snapshot file"))
+                    self.wizard().snapshot_file = filename[0]
 
 
 class LoginBox:
@@ -512,15 +524,21 @@ class H3MainGUI:
         a custom menu out of them.
         """
         H3Core.update_assigned_actions()
+        catalog = H3Core.get_catalog()
         model = QtGui.QStandardItemModel()
 
-        categories = set()
-        action_items = list()
-
+        # One pass over the actions, texts looked up in the pre-parsed catalog
+        action_items = dict()
         for assigned_action in H3Core.assigned_actions:
-            action = H3Core.get_from_primary_key(Acd.Action, assigned_action.action)
-            categories.add(AlchemyCore.json_read(action.language, H3Core.language, 'cat'))
-            item = QtGui.QStandardItem(AlchemyCore.json_read(action.language, H3Core.language, 'desc'))
+            action = H3Core.actions[assigned_action.action]
+            if catalog is not None:
+                category = catalog.category(action.code, H3Core.language)
+                description = catalog.description(action.code, H3Core.language)
+            else:
+                # Translations couldn't be read : the action's own category and identifier
+                category = action.category or action.code
+                description = action.identifier or action.code
+            item = QtGui.QStandardItem(description)
             item.setData(assigned_action, 33)
             item.setData(action, 34)
             if assigned_action.delegated_from:
@@ -531,16 +549,12 @@ class H3MainGUI:
                 #     tooltip.append(_("\nLimit :  {lim}").format(lim=assigned_action.maximum))
                 item.setToolTip(tooltip)
                 item.setBackground(QtGui.QBrush(QtCore.Qt.green))
-            action_items.append(item)
-
-        cat2 = sorted(categories)
+            action_items.setdefault(category, list()).append(item)
 
-        for cat in cat2:
+        for cat in sorted(action_items):
             cat_item = QtGui.QStandardItem(cat)
-            for item in action_items:
-                action = item.data(34)
-                if AlchemyCore.json_read(action.language, H3Core.language, 'cat') == cat:
-                    cat_item.appendRow(item)
+            for item in action_items[cat]:
+                cat_item.appendRow(item)
             model.appendRow(cat_item)
 
         return model
@@ -566,6 +580,8 @@ class H3MainGUI:
         if action_menu_item.data(34):
             action = action_menu_item.data(34).identifier
         if action == 'manage_bases':
+            if self.current_screen:
+                self.current_screen.close()
             self.current_screen = ManageBases(self)
 
     def run_setup_wizard(self):
@@ -599,6 +615,9 @@ class ManageBases:
         self.gui.root_window.setCentralWidget(self.menu)
         self.selected_base = None
 
+        # All the lookups of this screen share one session; tree items hold detached snapshots
+        self.uow = H3Core.unit_of_work()
+
         self.countries_model = QtGui.QStandardItemModel()
         for c in countries:
             localized_name = self.gui.locale.territories[c.alpha2]
@@ -635,11 +654,42 @@ class ManageBases:
         if action == "delete":
             self.close_base(base)
 
+    def close(self):
+        """
+        Called when another screen replaces this one.
+        """
+        self.uow.close()
+
+    def call(self, core_call, *args, failed=None):
+        """
+        Runs a core call through the unit of work of the screen. With a relay configured, a call sent to the relay
+        that didn't come back as a result is shown as failed rather than closing the screen.
+        :param failed: what the screen gets instead, ie "ERR" for a write
+        """
+        try:
+            return core_call(*args, uow=self.uow)
+        except AlchemyRelay.RelayError:
+            logger.exception(_("{call} not confirmed by the relay")
+                             .format(call=core_call.__name__))
+            return failed
+
+    def save(self, result):
+        """
+        Commits the unit of work after a core write, on each save : a write run by the relay is committed there
+        as it returns, so nothing of it is left for this screen to roll back.
+        :param result: the "OK" / "ERR" result of the core call
+        :return: True if the change is committed
+        """
+        if result == "OK" and self.uow.commit():
+            return True
+        self.uow.rollback()
+        return False
+
     def refresh_tree(self, base_code):
         self.bases_tree_model.clear()
         hidden_root = self.bases_tree_model.invisibleRootItem()
 
-        queue_data = H3Core.read_table(Acd.SyncJournal)
+        queue_data = self.call(H3Core.read_table, Acd.SyncJournal, failed=list())
         fresh = list()
         temp = list()
         for queue_item in queue_data:
@@ -649,7 +699,7 @@ class ManageBases:
             if queue_item.type == "CREATE" and queue_item.status == "UNSUBMITTED":
                 temp.append(queue_item.key)
 
-        base_data = H3Core.read_table(Acd.WorkBase)
+        base_data = self.uow.snapshot(self.call(H3Core.read_table, Acd.WorkBase, failed=list()))
 
         tree_row = list()
         next_row = list()
@@ -676,18 +726,23 @@ class ManageBases:
                 hidden_root.setChild(root_child_no, 1, root_desc)
                 tree_row.append(root_item)
 
+        # Children grouped by parent in one pass, so each level is a lookup rather than a scan
+        children = dict()
+        for base in base_data:
+            if base.parent != base.code:
+                children.setdefault(base.parent, list()).append(base)
+
         while tree_row:
             for parent in tree_row:
-                for base in base_data:
-                    if base.parent == parent.data(33).code:
-                        base_item = QtGui.QStandardItem(base.identifier)
-                        base_desc = QtGui.QStandardItem(base.full_name)
-                        base_item.setData(base, 33)
-                        parent_child_no = parent.rowCount()
-                        self.paint_line(base_item, base_desc, fresh, temp)
-                        parent.setChild(parent_child_no, 0, base_item)
-                        parent.setChild(parent_child_no, 1, base_desc)
-                        next_row.append(base_item)
+                for base in children.get(parent.data(33).code, list()):
+                    base_item = QtGui.QStandardItem(base.identifier)
+                    base_desc = QtGui.QStandardItem(base.full_name)
+                    base_item.setData(base, 33)
+                    parent_child_no = parent.rowCount()
+                    self.paint_line(base_item, base_desc, fresh, temp)
+                    parent.setChild(parent_child_no, 0, base_item)
+                    parent.setChild(parent_child_no, 1, base_desc)
+                    next_row.append(base_item)
             tree_row = next_row
             next_row = []
 
@@ -721,15 +776,17 @@ class ManageBases:
         self.selected_base = base_index.data(33) or self.bases_tree_model.invisibleRootItem().child(0).data(33)
         self.menu.statsGroupBox.setTitle(_("{base} stats").format(base=self.selected_base.identifier))
         self.menu.openDate.setText(str(self.selected_base.opened_date))
-        count = H3Core.get_user_count(self.selected_base.code)
-        if count:
-            self.menu.userNo.setText(str(count))
+        stats = self.call(H3Core.get_base_stats, self.selected_base.code)
+        if stats:
+            self.menu.userNo.setText(_("{active} ({headcount} with sub-bases)")
+                                     .format(active=stats.active_contracts, headcount=stats.headcount))
+            self.menu.subBases.setText(_("{open} / {closed}")
+                                       .format(open=stats.open_sub_bases, closed=stats.closed_sub_bases))
+            self.menu.lastChange.setText(str(stats.last_change))
         else:
-            count = H3Core.get_user_count(self.selected_base.code, "remote")
-            if count:
-                self.menu.userNo.setText(str(count))
-            else:
-                self.menu.userNo.setText(_("Data unavailable without a connection to the remote DB"))
+            self.menu.userNo.setText("-")
+            self.menu.subBases.setText("-")
+            self.menu.lastChange.setText("-")
         if self.selected_base.closed_date and self.selected_base.closed_date <= datetime.date.today():
             self.menu.deleteButton.setEnabled(False)
             self.menu.editButton.setEnabled(False)
@@ -755,7 +812,7 @@ class ManageBases:
 
         if base:
             create_base_box.baseCodeLineEdit.setText(base.identifier)
-            parent_base = H3Core.get_from_primary_key(Acd.WorkBase, base.parent)
+            parent_base = self.call(H3Core.get_from_primary_key, Acd.WorkBase, base.parent)
             if parent_base:
                 create_base_box.parentComboBox.setCurrentIndex(
                     create_base_box.parentComboBox.findText(parent_base.identifier, QtCore.Qt.MatchStartsWith))
@@ -790,7 +847,7 @@ class ManageBases:
                                     time_zone=create_base_box.timeZoneComboBox.itemData(
                                         create_base_box.timeZoneComboBox.currentIndex(), 33))
 
-            if H3Core.create_base(new_base) == "OK":
+            if self.save(self.call(H3Core.create_base, new_base, failed="ERR")):
                 self.refresh_tree(H3Core.current_job_contract.work_base)
             else:
                 message_box = QtGui.QMessageBox(QtGui.QMessageBox.Warning, _("Base not created"),
@@ -822,7 +879,7 @@ class ManageBases:
             base = self.selected_base
 
         edit_base_box.baseCodeLineEdit.setText(base.identifier)
-        parent_base = H3Core.get_from_primary_key(Acd.WorkBase, base.parent)
+        parent_base = self.call(H3Core.get_from_primary_key, Acd.WorkBase, base.parent)
         if parent_base:
             edit_base_box.parentComboBox.setCurrentIndex(
                 edit_base_box.parentComboBox.findText(parent_base.identifier, QtCore.Qt.MatchStartsWith))
@@ -845,7 +902,7 @@ class ManageBases:
                 edit_base_box.countryComboBox.currentIndex(), 33)[1]
             base.time_zone = edit_base_box.timeZoneComboBox.itemData(edit_base_box.timeZoneComboBox.currentIndex(), 33)
 
-            if H3Core.update_base(base) == "OK":
+            if self.save(self.call(H3Core.update_base, base, failed="ERR")):
                 self.refresh_tree(H3Core.current_job_contract.work_base)
             else:
                 message_box = QtGui.QMessageBox(QtGui.QMessageBox.Warning, _("Base not modified"),
@@ -867,7 +924,7 @@ class ManageBases:
 
         if close_base_box.exec_() == QtGui.QDialog.Accepted:
             base.closed_date = close_base_box.dateEdit.date().toPython()
-            if H3Core.update_base(base) == "OK":
+            if self.save(self.call(H3Core.update_base, base, failed="ERR")):
                 self.refresh_tree(H3Core.current_job_contract.work_base)
             else:
                 message_box = QtGui.QMessageBox(QtGui.QMessageBox.Warning, _("Base not closed"),
@@ -877,7 +934,7 @@ class ManageBases:
                 message_box.exec_()
 
     def export_bases(self):
-        filename = H3Core.export_bases()
+        filename = H3Core.export_bases(uow=self.uow)
         message_box = QtGui.QMessageBox(QtGui.QMessageBox.Information, _("Base data exported successfully"),
                                         _("Base data has been exported to the file {file}. Do you want"
                                           " to open it ?")
@@ -893,10 +950,8 @@ class ManageBases:
         Then presents a preview of data to be imported; the Table View gives feedback on success of import
         """
         filename = QtGui.QFileDialog.getOpenFileName(self.menu, _("Choose file to import"))
-        raw_data = list()
         if filename[0] != "":
-            raw_data = H3Core.import_excel(filename[0])
-        ImportBases(self.gui, raw_data)
+            ImportBases(self.gui, filename[0])
         self.refresh_tree(H3Core.current_job_contract.work_base)
 
     def query_history(self):
@@ -908,8 +963,8 @@ class ManageBases:
                                             QtGui.QMessageBox.Ok)
             message_box.setWindowIcon(QtGui.QIcon(":/images/H3.png"))
             message_box.exec_()
-        else:
-            pass
+        elif self.selected_base:
+            BaseHistory(self.gui, self.selected_base)
 
     @QtCore.Slot(str)
     def update_timezones(self, country):
@@ -922,17 +977,76 @@ class ManageBases:
             self.timezones_model.appendRow(tz_item)
 
 
+class BaseHistory:
+    """
+    Lists the past versions of a base page by page, and shows its subtree as it was at a chosen date.
+    """
+    page_size = 50
+
+    def __init__(self, gui, base):
+        self.history_box = QtUiTools.QUiLoader().load(QtCore.QFile("H3/GUI/QtDesigns/History.ui"),
+                                                      gui.root_window)
+        self.history_box.setWindowTitle(_("History of {base}").format(base=base.identifier))
+        self.base = base
+        self.before_version = None
+
+        self.model = QtGui.QStandardItemModel()
+        self.history_box.tableView.setModel(self.model)
+        self.history_box.asOfEdit.setDateTime(QtCore.QDateTime.currentDateTime())
+        self.history_box.olderButton.clicked.connect(self.load_page)
+        self.history_box.asOfButton.clicked.connect(self.show_as_of)
+
+        self.load_page()
+        self.history_box.exec_()
+
+    def load_page(self):
+        if self.before_version is None:
+            self.model.clear()
+            self.model.setHorizontalHeaderLabels((_('Version'), _('Replaced on (UTC)'), _('Base code'),
+                                                  _('Full name'), _('Parent'), _('Closed on')))
+        changes = H3Core.get_changes(Acd.WorkBase, self.base.code, self.before_version, self.page_size)
+        for change in changes:
+            self.model.appendRow([QtGui.QStandardItem(str(value)) for value in (change.version,
+                                                                                 change.changed,
+                                                                                 change.identifier,
+                                                                                 change.full_name,
+                                                                                 change.parent,
+                                                                                 change.closed_date)])
+        if changes:
+            self.before_version = changes[-1].version
+        self.history_box.olderButton.setEnabled(len(changes) == self.page_size)
+        self.history_box.tableView.resizeColumnsToContents()
+
+    def show_as_of(self):
+        timestamp = self.history_box.asOfEdit.dateTime().toUTC().toPython()
+        self.model.clear()
+        self.model.setHorizontalHeaderLabels((_('Base code'), _('Full name'), _('Parent'), _('Closed on')))
+        for base in H3Core.get_subtree_as_of(self.base.code, timestamp):
+            self.model.appendRow([QtGui.QStandardItem(str(value)) for value in (base.identifier,
+                                                                                 base.full_name,
+                                                                                 base.parent,
+                                                                                 base.closed_date)])
+        self.history_box.olderButton.setEnabled(False)
+        self.before_version = None
+        self.history_box.tableView.resizeColumnsToContents()
+
+
 class ImportBases:
-    def __init__(self, gui, raw_data):
+    """
+    Previews the Data sheet of a file as it's read, then imports it chunk by chunk; each row turns green
+    or red as soon as its chunk is written.
+    """
+
+    def __init__(self, gui, filename):
         self.import_box = QtUiTools.QUiLoader().load(QtCore.QFile("H3/GUI/QtDesigns/Import.ui"),
                                                      gui.root_window)
 
         self.model = QtGui.QStandardItemModel(0, 8)
-        self.raw_data = raw_data
+        self.filename = filename
 
-        for line in raw_data:
+        for line in H3Core.import_excel(filename):
             line_list = list()
-            for cell in line:
+            for cell in line[:8]:
                 item = QtGui.QStandardItem(str(cell))
                 line_list.append(item)
             self.model.appendRow(line_list)
@@ -945,29 +1059,20 @@ class ImportBases:
         self.import_box.exec_()
 
     def import_bases(self):
-        cursor = 0
-        for line in self.raw_data:
-            # noinspection PyArgumentList
-            base = Acd.WorkBase(base='BASE-1',
-                                period='PERMANENT',
-                                identifier=line[1],
-                                parent=line[2],
-                                full_name=line[3],
-                                opened_date=line[4],
-                                closed_date=line[5],
-                                country=line[6],
-                                time_zone=line[7])
-            result = H3Core.create_base(base)
+        self.import_box.pushButton.setEnabled(False)
+        # The file is read again, lazily : rows are never all held at once
+        for cursor, result, detail in H3Core.import_bases(H3Core.import_excel(self.filename)):
             if result == "OK":
                 self.model.setItem(cursor, 8, QtGui.QStandardItem(_("Success")))
-                for i in range(0, 8):
-                    self.model.item(cursor, i).setBackground(QtGui.QBrush(QtGui.QColor('green')))
-            elif result == "ERR":
-                self.model.setItem(cursor, 8, QtGui.QStandardItem(_("Fail")))
-                for i in range(0, 8):
-                    self.model.item(cursor, i).setBackground(QtGui.QBrush(QtGui.QColor('red')))
-            cursor += 1
-        self.import_box.pushButton.setEnabled(False)
+                colour = 'green'
+            else:
+                self.model.setItem(cursor, 8, QtGui.QStandardItem(_("Fail : {error}").format(error=detail)))
+                colour = 'red'
+            for i in range(0, 8):
+                if self.model.item(cursor, i):
+                    self.model.item(cursor, i).setBackground(QtGui.QBrush(QtGui.QColor(colour)))
+            if cursor % AlchemyImport.IMPORT_CHUNK == 0:
+                QtGui.QApplication.processEvents()
 
 
 def run():
@@ -984,3 +1089,19 @@ def init_remote(location, password):
 
 def nuke_remote(location, password):
     AlchemyCore.nuke_remote(location, password)
+
+
+def upgrade_remote(location, password):
+    AlchemyCore.upgrade_remote(location, password)
+
+
+def prune_history(location, password, archive_file=None):
+    AlchemyCore.prune_history(location, password, archive_file)
+
+
+def build_snapshot(location, username, password, base_code, filename):
+    AlchemyCore.build_snapshot(location, username, password, base_code, filename)
+
+
+def run_relay(address, username, password):
+    AlchemyCore.run_relay(address, username, password)
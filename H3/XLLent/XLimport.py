@@ -1,19 +1,35 @@
 __author__ = 'Emmanuel'
 
+import itertools
+
 import openpyxl
 
 
-def data_reader(filename):
+def row_reader(filename):
+    """
+    Reads the Data sheet one row at a time, never holding more than the current row.
+    Blank rows (ie left after deleting lines in Excel) are skipped.
+    """
     wb = openpyxl.load_workbook(filename, read_only=True)
-    data_ws = wb["Data"]
+    try:
+        for row in wb["Data"].iter_rows(values_only=True):
+            if any(value is not None for value in row):
+                yield list(row)
+    finally:
+        wb.close()
 
-    data = list()
-    for row in data_ws.rows:
-        individual_row = list()
-        for cell in row:
-            individual_row.append(cell.value)
-        data.append(individual_row)
 
-    del wb
+def chunked(rows, size):
+    """
+    Groups an iterable of rows into lists of at most size rows, reading only one list ahead.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
 
-    return data
+
+def data_reader(filename):
+    return list(row_reader(filename))
@@ -1,136 +1,231 @@
 __author__ = 'Emmanuel'
 
 import datetime
+import json
 import locale
+import os
 
 import babel
 import babel.dates
 import xlsxwriter
 import xlsxwriter.utility
 
-
-def bases_writer(bases):
-    # First get a babel Locale object
-    loc = babel.Locale.parse(locale.getdefaultlocale()[0], "_")
-    # Make the timestamp for the filename both locally correct and windows-compatible
+MAX_WIDTH = 60  # columns of long free text stop growing there
+MAX_ROW = 1048575  # last row of a worksheet
+
+HEADER_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'GUI', 'QtDesigns', 'images',
+                            'H3big.png')
+
+
+class H3ExportColumn:
+    """
+    One value of the exported rows : where it goes and how it's shown.
+    kind is one of 'text', 'date', 'datetime', 'number', 'bool'.
+    """
+    __slots__ = ('name', 'header', 'kind', 'in_data', 'in_view', 'locked', 'codes', 'lookup')
+
+    def __init__(self, name, header, kind='text', in_data=True, in_view=True, locked=False, codes=False,
+                 lookup=None):
+        """
+        :param locked: greyed in the Data sheet, ie the code
+        :param codes: picked among the codes of the export itself in the Data sheet, ie the parent base
+        :param lookup: for a view column holding the label of a code of the export, (code column, label column)
+        to keep it as a live VLOOKUP into the Data sheet; the label is written as its cached result
+        """
+        self.name = name
+        self.header = header
+        self.kind = kind
+        self.in_data = in_data
+        self.in_view = in_view
+        self.locked = locked
+        self.codes = codes
+        self.lookup = lookup
+
+
+def export_filename(title, loc):
+    """
+    Makes the timestamp for the filename both locally correct and windows-compatible
+    """
     timestamp = babel.dates.format_datetime(datetime.datetime.now(), locale=loc) \
         .replace('/', '-').replace(':', '.')
-
-    filename = _("Bases exported {time}.xlsx").format(time=timestamp)
-    wb = xlsxwriter.Workbook(filename)
-    ws = wb.add_worksheet("Bases")
+    return _("{title} exported {time}.xlsx").format(title=title, time=timestamp)
+
+
+def open_workbook(filename):
+    """
+    Workbooks are written in constant memory mode : each row goes to a temporary file as soon as the next one
+    starts, so exports take the same memory whatever their size. Rows must be written in order, one pass.
+    """
+    return xlsxwriter.Workbook(filename, {'constant_memory': True})
+
+
+def cell_value(value):
+    """
+    What xlsxwriter can't write as is goes as text : JSON for structures, str for the rest.
+    """
+    if value is None or isinstance(value, (str, int, float, bool, datetime.date)):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    try:
+        return float(value)  # Decimal
+    except (TypeError, ValueError):
+        return str(value)
+
+
+class H3SheetWriter:
+    """
+    Writes rows to a worksheet as they come, keeping the widest value of each column for the column widths.
+    """
+
+    def __init__(self, worksheet, formats, date_width=10):
+        """
+        :param formats: the format of each column, or None
+        :param date_width: width of the dates as the locale formats them
+        """
+        self.worksheet = worksheet
+        self.formats = formats
+        self.date_width = date_width
+        self.widths = [0] * len(formats)
+        self.row_formats = formats
+        self.row_no = 0
+
+    def write_row(self, values, formats=None):
+        formats = self.row_formats = formats or self.formats
+        for col, value in enumerate(values):
+            self.worksheet.write(self.row_no, col, value, formats[col])
+            if value is None:
+                continue
+            if isinstance(value, (datetime.date, datetime.datetime)):
+                width = self.date_width
+            else:
+                width = len(str(value))
+            if width > self.widths[col]:
+                self.widths[col] = width
+        self.row_no += 1
+
+    def write_formula(self, col, formula, value=None):
+        """
+        Writes a formula in the row just written.
+        """
+        self.worksheet.write_formula(self.row_no - 1, col, formula, self.row_formats[col], value)
+
+    def set_widths(self, minimums=None):
+        for col, width in enumerate(self.widths):
+            if minimums:
+                width = max(width, minimums[col])
+            self.worksheet.set_column(col, col, min(width, MAX_WIDTH) + 1)
+
+
+def table_writer(title, columns, rows, filename=None):
+    """
+    Exports rows in a single pass over them : a formatted sheet for reading and printing,
+    and the protected Data sheet the import reads back, without a header row.
+    :param title: name of the formatted sheet, also used for the file name
+    :param columns: list of H3ExportColumn, one per value of the rows; the first Data column holds the codes
+    :param rows: iterable of tuples, ie a query cursor; read once
+    :return: the file name
+    """
+    # First get a babel Locale object
+    loc = babel.Locale.parse(locale.getdefaultlocale()[0], "_")
+    filename = filename or export_filename(title, loc)
+    wb = open_workbook(filename)
+    ws = wb.add_worksheet(title[:31])
     data_ws = wb.add_worksheet("Data")
 
-    title = _("\nH3 Export Bases")
+    heading = _("\nH3 Export {title}").format(title=title)
     date_time = _("Exported &D at &T")
     page_count = _("Page &P of &N")
     ws.set_header('&L&G&C&30{title}&R{date_time}\n{page_count}'
-                  .format(title=title, date_time=date_time, page_count=page_count),
-                  {'image_left': 'H3\GUI\QtDesigns\images\H3big.png'})
+                  .format(title=heading, date_time=date_time, page_count=page_count),
+                  {'image_left': HEADER_IMAGE})
 
     ws.set_margins(top=1.8)
 
     # Format the excel dates to the locale-appropriate representation
-    dates = wb.add_format({'num_format': loc.date_formats["short"].pattern})
-    dates.set_locked(False)
-
-    greyed = wb.add_format({'bg_color': '#BFBFBF'})
-    greyed.set_locked(False)
-    unlocked = wb.add_format()
-    unlocked.set_locked(False)
-
-    row_no = 0
-
-    table_data = list()
-
-    header_row = [_("Identifier"),
-                  _("Parent"),
-                  _("Full Name"),
-                  _("Opening date"),
-                  _("Closing date"),
-                  _("Country code"),
-                  _("Time zone")]
-
-    widths = list()
-    for i in range(0, len(header_row)):
-        widths.append(len(header_row[i]))
-
-    # Write the nice-looking sheet
-    row = list()
-    for base in bases:
-        row = list()
-        row.append(base.identifier)
-        row.append(base.parent)
-        row.append(base.full_name)
-        row.append(base.opened_date)
-        row.append(base.closed_date)
-        row.append(base.country)
-        row.append(base.time_zone)
-        table_data.append(row)
-        row_no += 1
-
-    # Write the raw data sheet
-    j = 0
-    for base in bases:
-        data_ws.write(j, 0, base.code, greyed)  # Stays locked because user shouldn't touch
-        data_ws.write(j, 1, base.identifier, unlocked)
-        data_ws.write(j, 2, base.parent, unlocked)
-        data_ws.data_validation(j, 2, j, 2, {'validate': 'list', 'source': '=$A:$A'})
-        data_ws.write(j, 3, base.full_name, unlocked)
-        data_ws.write(j, 4, base.opened_date, dates)
-        data_ws.write(j, 5, base.closed_date, dates)
-        data_ws.write(j, 6, base.country, unlocked)
-        data_ws.write(j, 7, base.time_zone, unlocked)
-        j += 1
-
+    date_pattern = loc.date_formats["short"].pattern
+    patterns = {'date': date_pattern, 'datetime': date_pattern + " hh:mm"}
+
+    def cell_format(kind, **properties):
+        if kind in patterns:
+            properties['num_format'] = patterns[kind]
+        return wb.add_format(properties) if properties else None
+
+    # Data cells are left unlocked so the values can be edited, codes stay greyed because user shouldn't touch
+    data_columns = [column for column in columns if column.in_data]
+    data_formats = [cell_format(column.kind, locked=False, **({'bg_color': '#BFBFBF'} if column.locked else {}))
+                    for column in data_columns]
+
+    # Tables aren't available in constant memory mode : the view gets the look of one, band by band
+    view_columns = [column for column in columns if column.in_view]
+    header = wb.add_format({'bold': True, 'font_color': '#FFFFFF', 'bg_color': '#4F81BD', 'bottom': 1})
+    plain = [cell_format(column.kind) for column in view_columns]
+    banded = [cell_format(column.kind, bg_color='#DCE6F1') for column in view_columns]
+
+    view = H3SheetWriter(ws, plain, len(patterns['datetime']))
+    data = H3SheetWriter(data_ws, data_formats, len(patterns['datetime']))
+
+    data_positions = [position for position, column in enumerate(columns) if column.in_data]
+    view_positions = [position for position, column in enumerate(columns) if column.in_view]
+    # Labels are precomputed by the query; a formula per row makes files Excel takes minutes to open and
+    # recalculate, so live lookups are only written for the columns asking for one
+    lookups = [(view_col, position, columns.index(column.lookup[0]), data_columns.index(column.lookup[1]) + 1)
+               for view_col, (position, column) in enumerate(zip(view_positions, view_columns))
+               if column.lookup is not None]
+
+    view.write_row([column.header for column in view_columns], [header] * len(view_columns))
+    for row in rows:
+        row = [cell_value(value) for value in row]
+        data.write_row([row[position] for position in data_positions])
+        view.write_row([row[position] for position in view_positions], None if view.row_no % 2 else banded)
+        for view_col, position, code_position, data_col in lookups:
+            if row[code_position] is not None:
+                view.write_formula(view_col, '=VLOOKUP("{code}",DataTable,{col},FALSE)'
+                                   .format(code=row[code_position], col=data_col), row[position])
+
+    # Codes are picked among the codes : one rule over the whole column, rows inserted later included
+    for data_col, column in enumerate(data_columns):
+        if column.codes:
+            data_ws.data_validation(0, data_col, MAX_ROW, data_col, {'validate': 'list', 'source': '=$A:$A'})
     data_ws.protect('', {'insert_rows': True, 'delete_rows': True})
 
-    wb.define_name('DataTable', '=Data!$A:$G')
-
-    ws.add_table(0, 0, len(table_data), len(row) - 1,
-                 {'data': table_data,
-                  'name': "Bases",
-                  'autofilter': False,
-                  'style': 'Table Style Medium 15',
-                  'columns':
-                      [{'header': header_row[0]},
-                       {'header': header_row[1]},
-                       {'header': header_row[2]},
-                       {'header': header_row[3]},
-                       {'header': header_row[4]},
-                       {'header': header_row[5]},
-                       {'header': header_row[6]}]})
-
-    # Special cases for dates : second writing pass and fixed width.
-    # Use this pass to overwrite parent with a formula pulling the base name
-    for line in range(1, len(table_data) + 1):
-        ws.write(line, 3, table_data[line - 1][3], dates)
-        ws.write(line, 4, table_data[line - 1][4], dates)
-        formula = '=VLOOKUP("{parent_code}",DataTable,2,FALSE)'.format(parent_code=table_data[line - 1][1])
-        ws.write_formula(line, 1, formula)
-        # Completely excessive data validation
-        # ws.data_validation(line, 1, line, 1, {'validate': 'list', 'source': '=$A$2:{cell_before}'
-        #                    .format(cell_before=xlsxwriter.utility.xl_rowcol_to_cell(line-1, 0, True, True))})
-    widths[3] = len(header_row[3])
-    widths[4] = len(header_row[4])
-
-    # This pass to calculate column widths
-    for line in table_data:
-        for col in range(0, len(line)):
-            if col not in [1, 3, 4] and len(line[col]) > widths[col]:
-                widths[col] = len(line[col])
-
-    # Since we used base identifiers for the parent column, copy that width if necessary
-    if widths[0] > widths[1]:
-        widths[1] = widths[0]
-
-    for index in range(0, len(widths)):
-        ws.set_column(index, index, widths[index])
-
-    ws.print_area(0, 0, len(table_data), len(header_row) - 1)
+    last_col = xlsxwriter.utility.xl_col_to_name(len(data_columns) - 1)
+    wb.define_name('DataTable', '=Data!$A:${last_col}'.format(last_col=last_col))
+
+    view.set_widths([len(column.header) for column in view_columns])
+    data.set_widths()
+
+    last_row = max(view.row_no - 1, 1)
+    ws.autofilter(0, 0, last_row, len(view_columns) - 1)
+    ws.freeze_panes(1, 0)
+    ws.print_area(0, 0, last_row, len(view_columns) - 1)
+    ws.repeat_rows(0)
     ws.fit_to_pages(1, 0)
 
     # data_ws.hide()
 
     wb.close()
     return filename
+
+
+def bases_writer(bases, lookup=False):
+    """
+    Exports bases in the layout the bases import reads back.
+    :param bases: iterable of (code, identifier, parent, parent identifier, full name, opening date, closing date,
+    country, time zone), ie a query cursor; read once
+    :param lookup: keep the parent column as a live lookup into the Data sheet
+    :return: the file name
+    """
+    identifier = H3ExportColumn('identifier', _("Identifier"))
+    parent = H3ExportColumn('parent', _("Parent"), in_view=False, codes=True)
+    columns = [H3ExportColumn('code', _("Code"), in_view=False, locked=True),
+               identifier,
+               parent,
+               H3ExportColumn('parent_label', _("Parent"), in_data=False,
+                              lookup=(parent, identifier) if lookup else None),
+               H3ExportColumn('full_name', _("Full Name")),
+               H3ExportColumn('opened_date', _("Opening date"), 'date'),
+               H3ExportColumn('closed_date', _("Closing date"), 'date'),
+               H3ExportColumn('country', _("Country code")),
+               H3ExportColumn('time_zone', _("Time zone"))]
+    return table_writer(_("Bases"), columns, bases)
@@ -0,0 +1,216 @@
+__author__ = 'Man'
+
+import datetime
+import logging
+import os
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+
+from . import AlchemyClassDefs as Acd
+from . import AlchemyLocal
+from . import AlchemyStock
+
+logger = logging.getLogger(__name__)
+
+
+def archive_location(local_location, period):
+    """
+    Archives live next to the local DB, one file per period : H3.sqlite -> H3_archive_2014.sqlite
+    """
+    root, extension = os.path.splitext(local_location)
+    return "{root}_archive_{period}{ext}".format(root=root, period=period, ext=extension or '.sqlite')
+
+
+def archivable_tables():
+    """
+    Tables holding period-scoped records, in foreign key order (parents first).
+    """
+    return [table for table in Acd.Base.metadata.sorted_tables
+            if 'period' in table.c and table.name != Acd.ArchivedPeriod.__tablename__]
+
+
+def get_archived_periods(session):
+    try:
+        return set(period for period, in session.query(Acd.ArchivedPeriod.period).distinct())
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to read the archived periods"))
+        return set()
+
+
+def get_closed_periods(session):
+    """
+    Periods that can be archived : any year before the current one that is still in the hot DB.
+    """
+    current_year = str(datetime.date.today().year)
+    periods = set()
+    try:
+        for table in archivable_tables():
+            for period, in session.execute(sqlalchemy.select([table.c.period]).distinct()):
+                if period is not None and str(period) != 'PERMANENT' and str(period) < current_year:
+                    periods.add(str(period))
+        return sorted(periods - get_archived_periods(session))
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to list the closed periods"))
+        return list()
+
+
+def has_queued_entries(session, period):
+    """
+    Records still waiting to be uploaded must not leave the hot DB.
+    """
+    for table in archivable_tables():
+        mapped_class = Acd.get_class_by_table_name(table.name)
+        if not mapped_class or not hasattr(mapped_class, 'code'):
+            # derived tables (ie budget rollups) are never queued
+            continue
+        queued = session.query(Acd.SyncJournal) \
+            .filter(Acd.SyncJournal.serial < 0,
+                    Acd.SyncJournal.table == table.name,
+                    Acd.SyncJournal.key.in_(session.query(mapped_class.code)
+                                            .filter(mapped_class.period == period))) \
+            .count()
+        if queued:
+            return True
+    return False
+
+
+def archive_period(local_db, period):
+    """
+    Moves every record of a closed period into its archive file, in a single transaction :
+    snapshot the stock balances at the end of the period, copy to the attached archive,
+    note the highest serials, then delete from the hot DB (children first).
+    :param local_db: the H3AlchemyLocalDB to shrink
+    :param period: the closed period, ie "2014"
+    :return: number of records moved, or False on failure
+    """
+    period = str(period)
+    if period == 'PERMANENT' or period >= str(datetime.date.today().year):
+        logger.error(_("Period {period} is not closed and can't be archived")
+                     .format(period=period))
+        return False
+
+    session = sqlalchemy.orm.sessionmaker(bind=local_db.engine)()
+    try:
+        if period in get_archived_periods(session):
+            logger.info(_("Period {period} is already archived")
+                        .format(period=period))
+            return 0
+        if has_queued_entries(session, period):
+            logger.error(_("Period {period} still has records waiting for upload, sync first")
+                         .format(period=period))
+            return False
+    finally:
+        session.close()
+
+    location = archive_location(local_db.location, period)
+    create_archive_tables(location)
+
+    moved = 0
+    connection = local_db.engine.connect()
+    connection.execute(sqlalchemy.text("ATTACH DATABASE :file AS archive"), file=location)
+    transaction = connection.begin()
+    try:
+        timestamp = datetime.datetime.utcnow()
+        # stock balances carry on from the year-end snapshots once the movements are gone
+        AlchemyStock.snapshot_period(connection, period)
+        tables = archivable_tables()
+        for table in tables:
+            columns = ", ".join('"{name}"'.format(name=column.name) for column in table.c)
+            connection.execute(sqlalchemy.text('INSERT INTO archive."{table}" ({columns}) '
+                                               'SELECT {columns} FROM main."{table}" WHERE period = :period'
+                                               .format(table=table.name, columns=columns)),
+                               period=period)
+            if 'serial' in table.c and 'base' in table.c:
+                top_serials = connection.execute(sqlalchemy.select([table.c.base,
+                                                                    sqlalchemy.func.max(table.c.serial)])
+                                                 .where(table.c.period == period)
+                                                 .group_by(table.c.base)).fetchall()
+                for base, top_serial in top_serials:
+                    connection.execute(Acd.ArchivedPeriod.__table__.insert(),
+                                       period=period,
+                                       table=table.name,
+                                       base=base,
+                                       top_serial=top_serial,
+                                       location=location,
+                                       archived_timestamp=timestamp)
+        for table in reversed(tables):
+            moved += connection.execute(table.delete().where(table.c.period == period)).rowcount
+        transaction.commit()
+        logger.info(_("Archived {no} records of period {period} to {file}")
+                    .format(no=moved, period=period, file=location))
+        return moved
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Failed to archive period {period}; records still referenced by live data ?")
+                         .format(period=period))
+        transaction.rollback()
+        return False
+    finally:
+        connection.execute(sqlalchemy.text("DETACH DATABASE archive"))
+        connection.close()
+
+
+def create_archive_tables(location):
+    """
+    Archive tables mirror the live ones without their foreign keys : the records they point to
+    (PERMANENT bases, users...) stay in the hot DB.
+    """
+    archive_meta = sqlalchemy.MetaData()
+    for table in archivable_tables():
+        sqlalchemy.Table(table.name, archive_meta,
+                         *[sqlalchemy.Column(column.name, column.type, primary_key=column.primary_key)
+                           for column in table.c])
+    archive_db = AlchemyLocal.H3AlchemyLocalDB(location)
+    archive_meta.create_all(bind=archive_db.engine)
+    archive_db.engine.dispose()
+
+
+def attach_archive(session, period):
+    """
+    ATTACHes the archive of a period to the session's connection, on demand.
+    Must be called before the session starts writing, as SQLite refuses to ATTACH inside a transaction.
+    :return: the schema name to query, or None if the period isn't archived
+    """
+    period = str(period)
+    location = session.query(Acd.ArchivedPeriod.location) \
+        .filter(Acd.ArchivedPeriod.period == period) \
+        .first()
+    if not location:
+        return None
+    schema = "archive_{period}".format(period=period)
+    attached = [row[1] for row in session.execute("PRAGMA database_list")]
+    if schema not in attached:
+        session.execute(sqlalchemy.text('ATTACH DATABASE :file AS "{schema}"'.format(schema=schema)),
+                        {'file': location[0]})
+    return schema
+
+
+def read_archived_table(session, mapped_class, period):
+    """
+    Historical query : the records of an archived period, read from its attached archive.
+    :return: list of records, meant for reading only
+    """
+    try:
+        schema = attach_archive(session, period)
+        if not schema:
+            return list()
+        return session.query(mapped_class) \
+            .from_statement(sqlalchemy.text('SELECT * FROM "{schema}"."{table}"'
+                                            .format(schema=schema, table=mapped_class.__tablename__))) \
+            .all()
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Failed to read table {table} from the archive of {period}")
+                         .format(table=mapped_class.__tablename__, period=period))
+        return list()
+
+
+def get_archived_serial(session, mapped_class, base_code):
+    """
+    Highest serial of a class and base that was moved to an archive, 0 if none.
+    """
+    top_serial = session.query(sqlalchemy.func.max(Acd.ArchivedPeriod.top_serial)) \
+        .filter(Acd.ArchivedPeriod.table == mapped_class.__tablename__,
+                Acd.ArchivedPeriod.base == base_code) \
+        .scalar()
+    return top_serial or 0
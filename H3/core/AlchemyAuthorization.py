@@ -0,0 +1,336 @@
+__author__ = 'Man'
+
+import datetime
+import decimal
+import json
+import logging
+import threading
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from . import AlchemyClassDefs as Acd
+
+logger = logging.getLogger(__name__)
+
+# AssignedAction.limits is a JSON dict of {scope: maximum amount}, ie
+# {"currency": "USD", "project:PRJ-12": 5000, "base:BASE-3": 2000, "*": 500}
+# "*" applies anywhere no specific scope is listed; no limits at all means no maximum.
+ANY_SCOPE = '*'
+
+MAX_CHAIN = 10  # delegation chains longer than this are treated as broken
+
+# {contract code: H3Permissions}, emptied whenever actions or their assignments change
+_cache = dict()
+_cache_lock = threading.Lock()
+
+limits_table = Acd.ActionLimit.__table__
+
+
+def parse_limits(limits):
+    """
+    :return: (currency or None, {scope: maximum}); an empty dict means unlimited
+    """
+    if not limits:
+        return None, dict()
+    try:
+        parsed = json.loads(limits)
+        currency = parsed.pop('currency', None)
+        return currency, dict((scope, float(maximum)) for scope, maximum in parsed.items())
+    except (ValueError, TypeError, AttributeError):
+        logger.error(_("Unreadable limits {limits}, treated as no right at all")
+                     .format(limits=limits))
+        return None, {ANY_SCOPE: 0}
+
+
+def split_scope(scope):
+    """
+    "project:PRJ-12" -> ("project", "PRJ-12"), "*" -> ("*", "")
+    """
+    scope_type, _sep, scope_key = scope.partition(':')
+    return scope_type, scope_key
+
+
+def join_scope(scope_type, scope_key):
+    return "{type}:{key}".format(type=scope_type, key=scope_key) if scope_key else scope_type
+
+
+def limit_rows(assigned_action_code, limits):
+    """
+    The ActionLimit rows of an assignment's JSON limits.
+    """
+    currency, parsed = parse_limits(limits)
+    rows = list()
+    for scope, maximum in parsed.items():
+        scope_type, scope_key = split_scope(scope)
+        rows.append({'assigned_action': assigned_action_code, 'scope_type': scope_type, 'scope_key': scope_key,
+                     'currency': currency, 'maximum': decimal.Decimal(str(maximum))})
+    return rows
+
+
+def retract_record(session, record):
+    """
+    Drops the limit rows of an assignment, before it's updated or deleted.
+    """
+    if isinstance(record, Acd.AssignedAction):
+        session.execute(limits_table.delete().where(limits_table.c.assigned_action == record.code))
+
+
+def apply_record(session, record):
+    """
+    Writes the limit rows of a freshly written assignment.
+    """
+    if isinstance(record, Acd.AssignedAction):
+        session.execute(limits_table.delete().where(limits_table.c.assigned_action == record.code))
+        rows = limit_rows(record.code, record.limits)
+        if rows:
+            session.execute(limits_table.insert(), rows)
+
+
+def backfill_limits(session, batch_size=1000):
+    """
+    Converts the JSON limits of the assignments that have no limit rows yet, ie in a DB that predates them
+    or after assignments were merged in bulk. Works with a session or a plain connection.
+    :return: number of assignments converted
+    """
+    assignments = Acd.AssignedAction.__table__
+    pending = session.execute(sqlalchemy.select([assignments.c.code, assignments.c.limits])
+                              .where(sqlalchemy.and_(assignments.c.limits.isnot(None),
+                                                     assignments.c.limits != '',
+                                                     ~sqlalchemy.exists().where(limits_table.c.assigned_action ==
+                                                                                assignments.c.code)))) \
+        .fetchall()
+    for start in range(0, len(pending), batch_size):
+        rows = [row for code, limits in pending[start:start + batch_size] for row in limit_rows(code, limits)]
+        if rows:
+            session.execute(limits_table.insert(), rows)
+    if pending:
+        logger.info(_("Limits of {no} assigned actions converted")
+                    .format(no=len(pending)))
+    return len(pending)
+
+
+def read_limits(session, assigned_action_codes):
+    """
+    :return: dict of {assigned action code: (currency or None, {scope: maximum})}, for the limited ones
+    """
+    limits = dict()
+    codes = list(assigned_action_codes)
+    for start in range(0, len(codes), 500):
+        for code, scope_type, scope_key, currency, maximum in session.execute(
+                sqlalchemy.select([limits_table.c.assigned_action, limits_table.c.scope_type,
+                                   limits_table.c.scope_key, limits_table.c.currency, limits_table.c.maximum])
+                .where(limits_table.c.assigned_action.in_(codes[start:start + 500]))):
+            limits.setdefault(code, (currency, dict()))[1][join_scope(scope_type, scope_key)] = float(maximum)
+    return limits
+
+
+def cap_limits(own, delegator):
+    """
+    A delegate can't sign for more than the person delegating : keeps the lowest maximum of each scope.
+    """
+    if not delegator:
+        return own
+    if not own:
+        return dict(delegator)
+    capped = dict()
+    for scope in set(own) | set(delegator):
+        own_maximum = own.get(scope, own.get(ANY_SCOPE))
+        delegator_maximum = delegator.get(scope, delegator.get(ANY_SCOPE))
+        if own_maximum is not None and delegator_maximum is not None:
+            capped[scope] = min(own_maximum, delegator_maximum)
+    return capped
+
+
+class H3Grant:
+    """
+    One way a contract holds an action : its validity window, its limits, and the delegation chain it came through.
+    """
+    __slots__ = ('start', 'end', 'currency', 'limits', 'chain')
+
+    def __init__(self, start, end, currency, limits, chain):
+        self.start = start or datetime.date.min
+        self.end = end or datetime.date.max
+        self.currency = currency
+        self.limits = limits
+        self.chain = chain
+
+    def allows(self, on_date, amount, scope, currency):
+        if not self.start <= on_date <= self.end:
+            return False
+        if amount is None or not self.limits:
+            return True
+        # amounts are only compared in the grant's currency, an amount without one can't be checked against it
+        if self.currency and currency != self.currency:
+            return False
+        maximum = self.limits.get(scope, self.limits.get(ANY_SCOPE))
+        return maximum is not None and amount <= maximum
+
+
+class H3Permissions:
+    """
+    Everything a contract may do, compiled once from its assigned actions : delegations resolved up their chain,
+    windows intersected and limits parsed and capped. Checks are then dictionary lookups.
+    """
+
+    def __init__(self, contract_code, grants):
+        """
+        :param grants: dict of {action identifier: list of H3Grant}
+        """
+        self.contract_code = contract_code
+        self.grants = grants
+
+    def can(self, action, amount=None, scope=ANY_SCOPE, currency=None, on_date=None):
+        """
+        :param action: identifier of the action, ie "manage_bases"
+        :param amount: value to sign off, if any
+        :param scope: what the amount is spent on, ie "project:PRJ-12"
+        :param on_date: defaults to today
+        :return: True if any grant of the action covers the request
+        """
+        on_date = on_date or datetime.date.today()
+        for grant in self.grants.get(action, ()):
+            if grant.allows(on_date, amount, scope, currency):
+                return True
+        return False
+
+    def actions(self, on_date=None):
+        on_date = on_date or datetime.date.today()
+        return sorted(action for action, grants in self.grants.items()
+                      if any(grant.start <= on_date <= grant.end for grant in grants))
+
+
+def compile_permissions(session, contract_code):
+    """
+    Reads the assignments of the contract and of the contracts it was delegated from, in one query per
+    link of the longest chain, and compiles them.
+    A delegation from a contract whose assignments this DB doesn't hold is taken on its own terms.
+    """
+    assignments = dict()  # {contract: [(AssignedAction, identifier)]}
+    limits = dict()  # {assigned action: (currency, {scope: maximum})}
+    to_read = {contract_code}
+    while to_read:
+        rows = session.query(Acd.AssignedAction, Acd.Action.identifier) \
+            .join(Acd.Action, Acd.Action.code == Acd.AssignedAction.action) \
+            .filter(Acd.AssignedAction.assigned_to.in_(list(to_read))) \
+            .all()
+        for contract in to_read:
+            assignments[contract] = list()
+        for assigned_action, identifier in rows:
+            assignments[assigned_action.assigned_to].append((assigned_action, identifier))
+        limits.update(read_limits(session, [assigned_action.code for assigned_action, _identifier in rows]))
+        to_read = set(assigned_action.delegated_from for assigned_action, _identifier in rows
+                      if assigned_action.delegated_from) - set(assignments)
+
+    def resolve(contract, chain):
+        grants = dict()
+        for assigned_action, identifier in assignments.get(contract, ()):
+            currency, maximums = limits.get(assigned_action.code, (None, dict()))
+            delegator = assigned_action.delegated_from
+            if not delegator or delegator == contract:
+                grants.setdefault(identifier, list()).append(
+                    H3Grant(assigned_action.start_date, assigned_action.end_date, currency, maximums, chain))
+                continue
+            if delegator in chain or len(chain) >= MAX_CHAIN:
+                logger.warning(_("Delegation loop through {contract} ignored")
+                               .format(contract=delegator))
+                continue
+            own = H3Grant(assigned_action.start_date, assigned_action.end_date, currency, maximums,
+                          chain + (delegator,))
+            if delegator not in assignments or not assignments[delegator]:
+                grants.setdefault(identifier, list()).append(own)
+                continue
+            for upstream in resolve(delegator, chain + (delegator,)).get(identifier, ()):
+                start = max(own.start, upstream.start)
+                end = min(own.end, upstream.end)
+                if start <= end:
+                    grants.setdefault(identifier, list()).append(
+                        H3Grant(start, end, own.currency or upstream.currency,
+                                cap_limits(own.limits, upstream.limits), own.chain))
+        return grants
+
+    return H3Permissions(contract_code, resolve(contract_code, (contract_code,)))
+
+
+def find_approvers(session, action, amount=None, scope=ANY_SCOPE, currency=None, on_date=None):
+    """
+    The contracts that can sign off an amount, ie "who can approve USD 20000 at base X" :
+    one query over the assignments of the action and their limit rows for the scope (or "*").
+    Delegated assignments found that way are then checked against their delegation chain.
+    :param action: identifier of the action, ie "sign_off"
+    :return: sorted list of contract codes
+    """
+    on_date = on_date or datetime.date.today()
+    assignments = Acd.AssignedAction.__table__
+    actions = Acd.Action.__table__
+    scope_type, scope_key = split_scope(scope)
+    specific = limits_table.alias('specific')
+    fallback = limits_table.alias('fallback')
+
+    clauses = [actions.c.identifier == action,
+               sqlalchemy.or_(assignments.c.start_date.is_(None), assignments.c.start_date <= on_date),
+               sqlalchemy.or_(assignments.c.end_date.is_(None), assignments.c.end_date >= on_date)]
+    if amount is not None:
+        covered = [sqlalchemy.func.coalesce(specific.c.maximum, fallback.c.maximum) >= amount]
+        limit_currency = sqlalchemy.func.coalesce(specific.c.currency, fallback.c.currency)
+        if currency:
+            covered.append(sqlalchemy.or_(limit_currency.is_(None), limit_currency == currency))
+        else:
+            covered.append(limit_currency.is_(None))
+        clauses.append(sqlalchemy.or_(~sqlalchemy.exists().where(limits_table.c.assigned_action ==
+                                                                 assignments.c.code),
+                                      sqlalchemy.and_(*covered)))
+    query = sqlalchemy.select([assignments.c.assigned_to, assignments.c.delegated_from]) \
+        .select_from(assignments
+                     .join(actions, actions.c.code == assignments.c.action)
+                     .outerjoin(specific, sqlalchemy.and_(specific.c.assigned_action == assignments.c.code,
+                                                          specific.c.scope_type == scope_type,
+                                                          specific.c.scope_key == scope_key))
+                     .outerjoin(fallback, sqlalchemy.and_(fallback.c.assigned_action == assignments.c.code,
+                                                          fallback.c.scope_type == ANY_SCOPE))) \
+        .where(sqlalchemy.and_(*clauses))
+
+    approvers = set()
+    for contract, delegator in session.execute(query):
+        if contract in approvers:
+            continue
+        if delegator and delegator != contract:
+            permissions = get_permissions(session, contract)
+            if not permissions or not permissions.can(action, amount, scope, currency, on_date):
+                continue
+        approvers.add(contract)
+    return sorted(approvers)
+
+
+def cached(contract_code):
+    return _cache.get(contract_code)
+
+
+def get_permissions(session, contract_code):
+    """
+    The compiled permissions of a contract, from the cache when possible.
+    :return: H3Permissions, or None if the assignments can't be read
+    """
+    permissions = _cache.get(contract_code)
+    if permissions is not None:
+        return permissions
+    try:
+        permissions = compile_permissions(session, contract_code)
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to compile the permissions of contract {contract}")
+                         .format(contract=contract_code))
+        return None
+    with _cache_lock:
+        _cache[contract_code] = permissions
+    return permissions
+
+
+def invalidate(contract_code=None):
+    """
+    Drops the compiled permissions of a contract, or of everyone (a delegation may reach any contract).
+    """
+    with _cache_lock:
+        if contract_code is None:
+            _cache.clear()
+        else:
+            _cache.pop(contract_code, None)
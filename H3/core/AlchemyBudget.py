@@ -0,0 +1,165 @@
+__author__ = 'Man'
+
+import datetime
+import decimal
+import logging
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from . import AlchemyClassDefs as Acd
+from . import AlchemyTree
+
+logger = logging.getLogger(__name__)
+
+rollups = Acd.BudgetRollup.__table__
+lines = Acd.BudgetLine.__table__
+commitments = Acd.Commitment.__table__
+closure = Acd.BaseClosure.__table__
+
+MEASURES = ('budget', 'committed', 'spent')
+
+ZERO = decimal.Decimal(0)
+
+
+def record_figures(mapped_class, record, sign=1):
+    """
+    What a budget line or commitment adds to the rollups of its base and the bases above it.
+    :param record: a record, or a row of its table
+    :return: dict of {measure: amount}
+    """
+    if mapped_class is Acd.BudgetLine:
+        return {'budget': sign * decimal.Decimal(str(record.amount))}
+    return {'committed': sign * decimal.Decimal(str(record.amount)),
+            'spent': sign * decimal.Decimal(str(record.spent or 0))}
+
+
+def compute_rollups(session, base_codes):
+    """
+    Sums the lines and commitments of some bases' subtrees from scratch : two grouped queries over the
+    org tree index, whatever the depth of the tree.
+    :return: dict of {(base code, period, currency): {measure: amount}}
+    """
+    figures = dict()
+    base_codes = list(base_codes)
+    for start in range(0, len(base_codes), 500):
+        chunk = base_codes[start:start + 500]
+        for code, period, currency, budget in session.execute(
+                sqlalchemy.select([closure.c.ancestor, lines.c.period, lines.c.currency,
+                                   sqlalchemy.func.sum(lines.c.amount)])
+                .select_from(closure.join(lines, lines.c.base == closure.c.descendant))
+                .where(closure.c.ancestor.in_(chunk))
+                .group_by(closure.c.ancestor, lines.c.period, lines.c.currency)):
+            figures.setdefault((code, period, currency), dict((measure, ZERO) for measure in MEASURES))
+            figures[(code, period, currency)]['budget'] = budget or ZERO
+        for code, period, currency, committed, spent in session.execute(
+                sqlalchemy.select([closure.c.ancestor, commitments.c.period, commitments.c.currency,
+                                   sqlalchemy.func.sum(commitments.c.amount),
+                                   sqlalchemy.func.sum(commitments.c.spent)])
+                .select_from(closure.join(commitments, commitments.c.base == closure.c.descendant))
+                .where(closure.c.ancestor.in_(chunk))
+                .group_by(closure.c.ancestor, commitments.c.period, commitments.c.currency)):
+            figures.setdefault((code, period, currency), dict((measure, ZERO) for measure in MEASURES))
+            figures[(code, period, currency)].update(committed=committed or ZERO, spent=spent or ZERO)
+    return figures
+
+
+def rebuild_rollups(session):
+    """
+    Recomputes every rollup, ie after lines were merged in bulk or the org tree index was rebuilt.
+    Works with a session or a plain connection.
+    :return: number of rows written
+    """
+    base_codes = [code for code, in session.execute(sqlalchemy.select([Acd.WorkBase.code]))]
+    figures = compute_rollups(session, base_codes)
+    now = datetime.datetime.utcnow()
+    session.execute(rollups.delete())
+    if figures:
+        session.execute(rollups.insert(), [dict(values, base=code, period=period, currency=currency, last_change=now)
+                                           for (code, period, currency), values in figures.items()])
+    logger.info(_("{no} budget rollups rebuilt")
+                .format(no=len(figures)))
+    return len(figures)
+
+
+def adjust(session, base_codes, period, currency, **deltas):
+    """
+    Adds amounts to the rollups of some bases for a period and currency, in one UPDATE.
+    Missing rows are created first, at zero.
+    """
+    deltas = dict((measure, delta) for measure, delta in deltas.items() if delta)
+    if not base_codes or not deltas:
+        return
+    key_filter = sqlalchemy.and_(rollups.c.base.in_(base_codes),
+                                 rollups.c.period == period,
+                                 rollups.c.currency == currency)
+    now = datetime.datetime.utcnow()
+    existing = set(code for code, in session.execute(sqlalchemy.select([rollups.c.base]).where(key_filter)))
+    missing = [code for code in base_codes if code not in existing]
+    if missing:
+        session.execute(rollups.insert(), [dict(((measure, ZERO) for measure in MEASURES), base=code, period=period,
+                                                currency=currency, last_change=now)
+                                           for code in missing])
+    values = dict((measure, getattr(rollups.c, measure) + delta) for measure, delta in deltas.items())
+    values['last_change'] = now
+    session.execute(rollups.update().where(key_filter).values(**values))
+
+
+def retract_record(session, record):
+    """
+    Takes the stored version of a record out of the rollups, before it's updated, moved or deleted.
+    """
+    if isinstance(record, (Acd.BudgetLine, Acd.Commitment)):
+        table = sqlalchemy.inspect(record).mapper.local_table
+        stored = session.execute(sqlalchemy.select([table]).where(table.c.code == record.code)).first()
+        if stored:
+            adjust(session, AlchemyTree.ancestors(session, stored.base), stored.period, stored.currency,
+                   **record_figures(type(record), stored, -1))
+    elif isinstance(record, Acd.WorkBase):
+        if session.query(Acd.WorkBase).filter(Acd.WorkBase.code == record.code).count():
+            above = AlchemyTree.ancestors(session, record.code)[1:]
+            for (code, period, currency), values in compute_rollups(session, [record.code]).items():
+                adjust(session, above, period, currency,
+                       **dict((measure, -amount) for measure, amount in values.items()))
+
+
+def apply_record(session, record):
+    """
+    Adds a freshly written record to the rollups; the org tree index must already be up to date.
+    """
+    if isinstance(record, (Acd.BudgetLine, Acd.Commitment)):
+        adjust(session, AlchemyTree.ancestors(session, record.base), record.period, record.currency,
+               **record_figures(type(record), record))
+    elif isinstance(record, Acd.WorkBase):
+        # the base's own rows are recomputed too, ie for a base adopting sub-bases that arrived before it
+        figures = compute_rollups(session, [record.code])
+        now = datetime.datetime.utcnow()
+        for (code, period, currency), values in figures.items():
+            if not session.execute(rollups.update()
+                                   .where(sqlalchemy.and_(rollups.c.base == code,
+                                                          rollups.c.period == period,
+                                                          rollups.c.currency == currency))
+                                   .values(last_change=now, **values)).rowcount:
+                session.execute(rollups.insert(), dict(values, base=code, period=period, currency=currency,
+                                                       last_change=now))
+        above = AlchemyTree.ancestors(session, record.code)[1:]
+        for (code, period, currency), values in figures.items():
+            adjust(session, above, period, currency, **values)
+
+
+def get_rollups(session, base_code, period):
+    """
+    The budget, commitments and spend of a base and its whole subtree for a period : one row per currency,
+    read by primary key.
+    :return: list of BudgetRollup, or None on failure
+    """
+    try:
+        return session.query(Acd.BudgetRollup) \
+            .filter(Acd.BudgetRollup.base == base_code,
+                    Acd.BudgetRollup.period == period) \
+            .order_by(Acd.BudgetRollup.currency) \
+            .all()
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to read the budget of base {base} for {period}")
+                         .format(base=base_code, period=period))
+        return None
@@ -20,6 +20,8 @@ class WorkBase(Base, Versioned):
     Assumed public (global) and permanent.
     """
     __tablename__ = 'bases'
+    __history_snapshot_every__ = 10  # history rows only hold the changed columns, and the full base every 10
+    __history_retention__ = (730, 'year')  # every version for 2 years, then the last one of each year
 
     prefix = 'BASE'
 
@@ -47,6 +49,48 @@ class WorkBase(Base, Versioned):
                                               single_parent=True)
 
 
+class BaseClosure(Base):
+    """
+    Class holding every ancestor / descendant pair of the org tree with the distance between them;
+    each base is its own ancestor at depth 0.
+    Derived from WorkBase.parent and maintained alongside it (see AlchemyTree), never synced.
+    """
+    __tablename__ = 'bases_closure'
+
+    ancestor = sqlalchemy.Column(sqlalchemy.String,
+                                 sqlalchemy.ForeignKey('bases.code', onupdate="cascade", ondelete="cascade"),
+                                 primary_key=True)
+    descendant = sqlalchemy.Column(sqlalchemy.String,
+                                   sqlalchemy.ForeignKey('bases.code', onupdate="cascade", ondelete="cascade"),
+                                   primary_key=True)
+    depth = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+    __table_args__ = (sqlalchemy.Index('bases_closure_descendant_idx', 'descendant', 'depth'),)
+
+
+class BaseStats(Base):
+    """
+    Class holding the figures shown for a base, kept up to date as records are written (see AlchemyStats)
+    so they can be read as a single row.
+    Contract counts depend on the date, so rows are recomputed the first time they're read each day;
+    rows delivered by the main DB cover the contracts this DB doesn't hold, and are refreshed by sync instead.
+    """
+    __tablename__ = 'base_stats'
+
+    base = sqlalchemy.Column(sqlalchemy.String,
+                             sqlalchemy.ForeignKey('bases.code', onupdate="cascade", ondelete="cascade"),
+                             primary_key=True)
+
+    active_contracts = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    headcount = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)  # sub-bases included
+    open_sub_bases = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    closed_sub_bases = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+
+    last_change = sqlalchemy.Column(sqlalchemy.DateTime)
+    computed_date = sqlalchemy.Column(sqlalchemy.Date)
+    delivered = sqlalchemy.Column(sqlalchemy.Boolean, nullable=False, default=False)
+
+
 class User(Base, Versioned):
     """
     Class representing a person's user account, irrespective of any job.
@@ -54,6 +98,8 @@ class User(Base, Versioned):
     Assumed public (global) and permanent.
     """
     __tablename__ = 'users'
+    __history_snapshot_every__ = 10
+    __history_retention__ = (730, 'year')
 
     prefix = 'USER'
 
@@ -63,7 +109,8 @@ class User(Base, Versioned):
     period = sqlalchemy.Column(sqlalchemy.String, default='PERMANENT')
 
     login = sqlalchemy.Column(sqlalchemy.String)  # i.e ebertolus
-    pw_hash = sqlalchemy.Column(sqlalchemy.String)  # hashed app-level password. SQL access will be different.
+    pw_hash = sqlalchemy.Column(sqlalchemy.String,
+                                info={'export': False})  # hashed app-level password. SQL access will be different.
     first_name = sqlalchemy.Column(sqlalchemy.String)
     last_name = sqlalchemy.Column(sqlalchemy.String)
 
@@ -101,6 +148,10 @@ class JobContract(Base):
     job_fk = sqlalchemy.orm.relationship('Job', backref=sqlalchemy.orm.backref('job_contracts'),
                                          foreign_keys=job_code)
 
+    # Validity intervals, searched per user or per base for "active at date" questions
+    __table_args__ = (sqlalchemy.Index('job_contracts_user_validity_idx', 'user', 'start_date', 'end_date'),
+                      sqlalchemy.Index('job_contracts_base_validity_idx', 'work_base', 'start_date', 'end_date'))
+
 
 class Action(Base):
     """
@@ -168,6 +219,7 @@ class AssignedAction(Base):
     action = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey('actions.code', onupdate="cascade"))
     assigned_to = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey('job_contracts.code', onupdate="cascade"))
     limits = sqlalchemy.Column(sqlalchemy.String)  # JSON limiting sign-off value per-project, base, contract...
+    # as synced; queries use the ActionLimit rows derived from it
 
     job_contract_fk = sqlalchemy.orm.relationship('JobContract',
                                                   backref=sqlalchemy.orm.backref('assigned_actions'),
@@ -178,25 +230,60 @@ class AssignedAction(Base):
                                             foreign_keys=action)
 
 
-# class RoutingRules(Base, Versioned):
-#     """
-#     Class holding the rules governing where a given action should send messages and validation / approval requests
-#
-#     """
-#     ___tablename__ = 'routing_rules'
-#
-#     code = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
-#     serial = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
-#     base = sqlalchemy.Column(sqlalchemy.String, default="ROOT")
-#     period = sqlalchemy.Column(sqlalchemy.String, default='PERMANENT')
-#
-#     scope = sqlalchemy.Column(sqlalchemy.String)  # "ROOT" for baseline rules, can be base-level or contract-level
-#     action = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey('actions.code'))
-#
-#     routing_action_fk = sqlalchemy.orm.relationship('Action',
-#                                                     backref=sqlalchemy.orm.backref('routing_rules',
-#                                                                                    cascade="all, delete-orphan"),
-#                                                     foreign_keys=action)
+class ActionLimit(Base):
+    """
+    Class holding the limits of an assigned action as typed rows, one per scope, so approvers can be found
+    with an indexed query instead of parsing every assignment's JSON. An assignment without rows is unlimited.
+    Derived from AssignedAction.limits and maintained alongside it (see AlchemyAuthorization), never synced.
+    """
+    __tablename__ = 'action_limits'
+
+    assigned_action = sqlalchemy.Column(sqlalchemy.String,
+                                        sqlalchemy.ForeignKey('assignedactions.code',
+                                                              onupdate="cascade", ondelete="cascade"),
+                                        primary_key=True)
+    scope_type = sqlalchemy.Column(sqlalchemy.String, primary_key=True)  # "project", "base", "contract" or "*"
+    scope_key = sqlalchemy.Column(sqlalchemy.String, primary_key=True, default='')  # ie PRJ-12; empty for "*"
+
+    currency = sqlalchemy.Column(sqlalchemy.String(3))
+    maximum = sqlalchemy.Column(sqlalchemy.Numeric(14, 2), nullable=False)
+
+    __table_args__ = (sqlalchemy.Index('action_limits_scope_idx', 'scope_type', 'scope_key', 'maximum'),)
+
+
+class RoutingRules(Base, Versioned):
+    """
+    Class holding the rules governing where a given action should send messages and validation / approval requests.
+    Baseline rules have the "ROOT" scope; a base overrides them for itself and its sub-bases, a contract for itself.
+    Each step of a route (1 = first) is taken from the most specific rule defining it (see AlchemyRouting).
+    Keeps a history table for changes.
+    Assumed public (global) and permanent.
+    """
+    __tablename__ = 'routing_rules'
+
+    prefix = 'ROUTINGRULE'
+
+    code = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    serial = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    base = sqlalchemy.Column(sqlalchemy.String, default="BASE-1")
+    period = sqlalchemy.Column(sqlalchemy.String, default='PERMANENT')
+
+    scope = sqlalchemy.Column(sqlalchemy.String, nullable=False)  # "ROOT", a base code or a job contract code
+    action = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey('actions.code', onupdate="cascade"))
+    step = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=1)
+    requested_action = sqlalchemy.Column(sqlalchemy.String)  # as in Message : "validate", "authorize", "comment"
+    # the recipient : a given contract, or else whoever holds a job at the nearest base up the tree.
+    # Neither drops the step for this scope.
+    target_jc = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey('job_contracts.code', onupdate="cascade"))
+    target_job = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey('jobs.code', onupdate="cascade"))
+
+    routing_action_fk = sqlalchemy.orm.relationship('Action',
+                                                    backref=sqlalchemy.orm.backref('routing_rules',
+                                                                                   cascade="all, delete-orphan"),
+                                                    foreign_keys=action)
+
+    __table_args__ = (sqlalchemy.Index('routing_rules_action_idx', 'action', 'scope'),)
+
 
 class SyncJournal(Base):
     """
@@ -223,6 +310,37 @@ class SyncJournal(Base):
     processed_timestamp = sqlalchemy.Column(sqlalchemy.DateTime)
 
 
+class ArchivedPeriod(Base):
+    """
+    Local bookkeeping of the periods moved out of the hot DB into an archive file.
+    One line per table and base, keeping the highest serial archived so serials never go backwards.
+    Never synced.
+    """
+    __tablename__ = 'archived_periods'
+
+    period = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    table = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    base = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+
+    top_serial = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    location = sqlalchemy.Column(sqlalchemy.String)  # path of the archive SQLite file
+    archived_timestamp = sqlalchemy.Column(sqlalchemy.DateTime)
+
+
+class SerialCounter(Base):
+    """
+    Local bookkeeping of the last serial handed out per table and base, so new records don't need
+    a MAX(serial) over their whole table. Ranges are reserved with a single UPDATE (see AlchemySerials).
+    Never synced : kept at or above every serial written locally, downloaded or archived.
+    """
+    __tablename__ = 'serial_counters'
+
+    table = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    base = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+
+    last_serial = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+
+
 class Message(Base):
     """
     Represents a message passed from an employee to another.
@@ -254,15 +372,156 @@ class Message(Base):
                                                     backref=sqlalchemy.orm.backref('messages_in'),
                                                     foreign_keys=target_jc)
 
-    # Project - DonorBudgetLine - InternalBudgetLine - Activities - Donors
+    # Project - DonorBudgetLine - Activities - Donors
 
-    # PSR - SR - GRN - Stock - Asset - Procurement (single or group / full SP)
+    # PSR - SR - GRN - Asset - Procurement (single or group / full SP)
 
     # Group of items moving (internal) - incoming goods (proper admin format like waybill etc).
 
     #  Global tables will have base = BASE-1. Codes will be of the form USER-1. (important for the rebase mechanism)
 
 
+class BudgetLine(Base):
+    """
+    Class representing a line of a base's budget for a period, ie "vehicle rental, 2015, USD 12000".
+    Scoped to the base that owns it and to the budget period, so closed years can be archived.
+    """
+    __tablename__ = 'budget_lines'
+
+    prefix = 'BUDGETLINE'
+
+    code = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    serial = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    base = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    period = sqlalchemy.Column(sqlalchemy.String, nullable=False)  # budget year, ie "2015"
+
+    identifier = sqlalchemy.Column(sqlalchemy.String)  # ie the donor's line number
+    description = sqlalchemy.Column(sqlalchemy.String)
+    project = sqlalchemy.Column(sqlalchemy.String)
+    donor = sqlalchemy.Column(sqlalchemy.String)
+    amount = sqlalchemy.Column(sqlalchemy.Numeric(14, 2), nullable=False)
+    currency = sqlalchemy.Column(sqlalchemy.String(3), nullable=False)  # ISO-4217
+
+
+class Commitment(Base):
+    """
+    Class holding money committed against a budget line by a base (ie a purchase order),
+    and how much of it was actually spent so far.
+    Takes the period and currency of its budget line.
+    """
+    __tablename__ = 'commitments'
+
+    prefix = 'COMMITMENT'
+
+    code = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    serial = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    base = sqlalchemy.Column(sqlalchemy.String, nullable=False)  # the base spending
+    period = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+
+    budget_line = sqlalchemy.Column(sqlalchemy.String,
+                                    sqlalchemy.ForeignKey('budget_lines.code', onupdate="cascade"),
+                                    nullable=False)
+    committed_date = sqlalchemy.Column(sqlalchemy.Date)
+    amount = sqlalchemy.Column(sqlalchemy.Numeric(14, 2), nullable=False)
+    spent = sqlalchemy.Column(sqlalchemy.Numeric(14, 2), nullable=False, default=0)
+    currency = sqlalchemy.Column(sqlalchemy.String(3), nullable=False)
+    reference = sqlalchemy.Column(sqlalchemy.String)  # ie the PO number
+
+    budget_line_fk = sqlalchemy.orm.relationship('BudgetLine',
+                                                 backref=sqlalchemy.orm.backref('commitments'),
+                                                 foreign_keys=budget_line)
+
+
+class BudgetRollup(Base):
+    """
+    Class holding the budget, commitments and spend of a base and all its sub-bases, per period and currency,
+    kept up to date as lines, commitments and bases are written (see AlchemyBudget) so a dashboard reads one row.
+    Derived from BudgetLine, Commitment and the org tree index, never synced; archived along with its period.
+    """
+    __tablename__ = 'budget_rollups'
+
+    base = sqlalchemy.Column(sqlalchemy.String,
+                             sqlalchemy.ForeignKey('bases.code', onupdate="cascade", ondelete="cascade"),
+                             primary_key=True)
+    period = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    currency = sqlalchemy.Column(sqlalchemy.String(3), primary_key=True)
+
+    budget = sqlalchemy.Column(sqlalchemy.Numeric(14, 2), nullable=False, default=0)
+    committed = sqlalchemy.Column(sqlalchemy.Numeric(14, 2), nullable=False, default=0)
+    spent = sqlalchemy.Column(sqlalchemy.Numeric(14, 2), nullable=False, default=0)
+
+    last_change = sqlalchemy.Column(sqlalchemy.DateTime)
+
+
+class Item(Base):
+    """
+    Class representing an item of the stock catalog, ie a carton of a given drug.
+    Assumed public (global) and permanent.
+    """
+    __tablename__ = 'items'
+
+    prefix = 'ITEM'
+
+    code = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    serial = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    base = sqlalchemy.Column(sqlalchemy.String, default="BASE-1")
+    period = sqlalchemy.Column(sqlalchemy.String, default='PERMANENT')
+
+    identifier = sqlalchemy.Column(sqlalchemy.String, nullable=False, unique=True)  # ie DORSPARA500TAB
+    description = sqlalchemy.Column(sqlalchemy.String)
+    category = sqlalchemy.Column(sqlalchemy.String)  # ie MED
+    unit = sqlalchemy.Column(sqlalchemy.String)  # ie "box of 100"
+
+
+class StockMovement(Base):
+    """
+    Class holding one line of the stock ledger of a base : goods in (positive quantity) or out (negative).
+    Movements are never edited in the normal course of things, mistakes are corrected by an adjustment.
+    Scoped to the base holding the stock and to the year of the movement, so closed years can be archived.
+    """
+    __tablename__ = 'stock_movements'
+
+    prefix = 'STOCK'
+
+    code = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    serial = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    base = sqlalchemy.Column(sqlalchemy.String, nullable=False)  # the base holding the stock
+    period = sqlalchemy.Column(sqlalchemy.String, nullable=False)  # year of moved_date, ie "2015"
+
+    item = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey('items.code', onupdate="cascade"),
+                             nullable=False)
+    moved_date = sqlalchemy.Column(sqlalchemy.Date, nullable=False)
+    quantity = sqlalchemy.Column(sqlalchemy.Numeric(14, 3), nullable=False)
+    movement_type = sqlalchemy.Column(sqlalchemy.String)  # "GRN", "issue", "transfer", "loss", "adjustment"
+    reference = sqlalchemy.Column(sqlalchemy.String)  # ie the waybill or requisition it comes from
+    origin_jc = sqlalchemy.Column(sqlalchemy.String)  # job contract who recorded it
+
+    item_fk = sqlalchemy.orm.relationship('Item', foreign_keys=item)
+
+    __table_args__ = (sqlalchemy.Index('stock_movements_ledger_idx', 'base', 'item', 'moved_date'),)
+
+
+class StockSnapshot(Base):
+    """
+    Class holding the balance of an item at a base at the end of a day, taken every so many movements
+    and at the end of each archived year (see AlchemyStock) : stock on hand is the latest snapshot
+    plus the few movements since, never a sum of the whole ledger.
+    Derived from StockMovement and kept in step with it by each DB, never synced.
+    """
+    __tablename__ = 'stock_snapshots'
+
+    base = sqlalchemy.Column(sqlalchemy.String,
+                             sqlalchemy.ForeignKey('bases.code', onupdate="cascade", ondelete="cascade"),
+                             primary_key=True)
+    item = sqlalchemy.Column(sqlalchemy.String,
+                             sqlalchemy.ForeignKey('items.code', onupdate="cascade", ondelete="cascade"),
+                             primary_key=True)
+    as_of = sqlalchemy.Column(sqlalchemy.Date, primary_key=True)  # movements of that day included
+
+    balance = sqlalchemy.Column(sqlalchemy.Numeric(14, 3), nullable=False, default=0)
+    taken = sqlalchemy.Column(sqlalchemy.DateTime)
+
+
 def get_class_by_table_name(tablename):
     # noinspection PyProtectedMember
     for c in Base._decl_class_registry.values():
@@ -270,5 +529,61 @@ def get_class_by_table_name(tablename):
             return c
 
 
+def create_missing_indexes(engine):
+    """
+    create_all only indexes the tables it creates : adds the indexes declared since a table was made.
+    :return: names of the indexes created
+    """
+    inspector = sqlalchemy.inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    created = list()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+                created.append(index.name)
+    return created
+
+
+def create_missing_columns(engine):
+    """
+    create_all doesn't alter existing tables : adds the columns declared since a table was made,
+    and lifts the NOT NULL of columns declared nullable since. SQLite can't do the latter :
+    the table is made again if it's empty (ie the history tables of a local DB), left as is otherwise.
+    :return: descriptions of the changes made
+    """
+    inspector = sqlalchemy.inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+    changed = list()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = dict((column['name'], column) for column in inspector.get_columns(table.name))
+        if engine.dialect.name == 'sqlite' \
+                and any(column.nullable and column.name in existing and not existing[column.name]['nullable']
+                        for column in table.columns) \
+                and not engine.execute(sqlalchemy.select([sqlalchemy.func.count()]).select_from(table)).scalar():
+            table.drop(bind=engine)
+            table.create(bind=engine)
+            changed.append("{table} made again".format(table=table.name))
+            continue
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute(sqlalchemy.text('ALTER TABLE {table} ADD COLUMN {column}'.format(
+                    table=preparer.format_table(table),
+                    column=sqlalchemy.schema.CreateColumn(column).compile(dialect=engine.dialect))))
+                changed.append("{table}.{column} added".format(table=table.name, column=column.name))
+            elif column.nullable and not existing[column.name]['nullable'] and engine.dialect.name != 'sqlite':
+                engine.execute(sqlalchemy.text('ALTER TABLE {table} ALTER COLUMN {column} DROP NOT NULL'.format(
+                    table=preparer.format_table(table),
+                    column=preparer.format_column(column))))
+                changed.append("{table}.{column} made nullable".format(table=table.name, column=column.name))
+    return changed
+
+
 def detach(acd):
     sqlalchemy.orm.session.make_transient(acd)
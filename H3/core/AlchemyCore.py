@@ -1,7 +1,9 @@
 __author__ = 'Man'
 
 import configparser
+import contextlib
 import datetime
+import functools
 import json
 import logging
 import os
@@ -11,12 +13,49 @@ import sqlalchemy.exc
 import sqlalchemy.orm
 
 from . import AlchemyClassDefs as Acd
-from . import AlchemyLocal, AlchemyRemote, AlchemyGeneric
-from .AlchemyTemporal import versioned_session
+from . import AlchemyLocal, AlchemyRemote, AlchemyGeneric, AlchemySnapshot, AlchemyArchive, AlchemyRelay
+from . import AlchemySearch
+from . import AlchemyTree
+from . import AlchemySerials
+from . import AlchemyStats
+from . import AlchemyStock
+from . import AlchemyBudget
+from . import AlchemyHistory
+from . import AlchemyRetention
+from . import AlchemyAuthorization
+from . import AlchemyLocalization
+from . import AlchemyRouting
+from . import AlchemyExport
+from . import AlchemyImport
+from .AlchemyUnitOfWork import H3UnitOfWork
+from .AlchemyTemporal import versioned_session, versioning_paused, skip_version
 from ..XLLent import XLexport, XLimport
 
 logger = logging.getLogger(__name__)
 
+
+def relayed(method):
+    """
+    Runs the core call on the site relay when one is configured, or directly on the local DB file when the relay
+    can't be reached. A call sent to the relay is never run again here : the relay may have committed it already,
+    so its failures reach the caller as AlchemyRelay.RelayError.
+    On the relay each call is its own unit of work, committed there; a uow passed by the caller is not used.
+    A relayed write can't be rolled back by its caller then : callers passing a uow commit it after each write
+    (see GUIMain.ManageBases.save) rather than holding several writes for one commit or rollback.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.relay:
+            relay_kwargs = dict(kwargs)
+            relay_kwargs.pop('uow', None)
+            try:
+                return self.relay.call(self.current_job_contract, method.__name__, *args, **relay_kwargs)
+            except AlchemyRelay.RelayUnavailable:
+                pass
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
 class H3AlchemyCore:
     """
     This is the central module for data manipulation. Now relies on SQLAlchemy's ORM.
@@ -28,9 +67,12 @@ class H3AlchemyCore:
 
         self.SessionRemote = sqlalchemy.orm.sessionmaker()
         self.SessionLocal = sqlalchemy.orm.sessionmaker()
-        
+        # local edits keep their history too, uploaded with them (off with "local history = no" in config.txt)
+        versioned_session(self.SessionLocal)
+
         self.local_db = AlchemyLocal.H3AlchemyLocalDB(None)
         self.remote_db = AlchemyRemote.H3AlchemyRemoteDB(None)
+        self.relay = None
 
         self.internal_state = dict({"user": "", "base": ""})
 
@@ -41,6 +83,7 @@ class H3AlchemyCore:
         self.local_job_contracts = list()
 
         self.assigned_actions = list()
+        self.actions = dict()
 
         self.language = "en_UK"
 
@@ -53,6 +96,7 @@ class H3AlchemyCore:
         self.local_job_contracts = list()
 
         self.assigned_actions = list()
+        self.actions = dict()
 
     # Wizard-related functions
 
@@ -72,9 +116,21 @@ class H3AlchemyCore:
                 temp_local_db_location = self.options.get('DB Locations', 'local')
                 temp_remote_db_location = self.options.get('DB Locations', 'remote')
                 self.remote_db = AlchemyRemote.H3AlchemyRemoteDB(temp_remote_db_location)
+                if self.options.has_option('DB Locations', 'relay'):
+                    try:
+                        self.relay = AlchemyRelay.H3RelayClient(
+                            AlchemyRelay.parse_address(self.options.get('DB Locations', 'relay')),
+                            self.options.get('DB Locations', 'relay key', fallback='').encode())
+                    except ValueError:
+                        logger.error(_("Relay configured without a relay key, not used"))
                 if ping_local(temp_local_db_location) == "H3DB":
                     self.local_db = AlchemyLocal.H3AlchemyLocalDB(temp_local_db_location)
-                    self.SessionLocal.configure(bind=self.local_db.engine)
+                    self.SessionLocal.configure(bind=self.local_db.engine,
+                                                info={'versioning': self.options.getboolean('H3 Options',
+                                                                                            'local history',
+                                                                                            fallback=True)})
+                    # DBs created by an older version get the new tables, indexes and search index on first open
+                    self.local_db.create_all_tables()
                     if self.options.has_option('H3 Options', 'current user'):
                         username = self.options.get('H3 Options', 'current user')
                         local_session = self.SessionLocal()
@@ -158,10 +214,26 @@ class H3AlchemyCore:
             self.internal_state["user"] = "invalid"
         self.options.write(open('config.txt', 'w'))
 
+    def wizard_install_snapshot(self, source):
+        """
+        Replaces the freshly created local DB with a snapshot prepared on the master for the user's base.
+        initial_setup will then skip the base download and only pull the updates made since the snapshot.
+        :param source: path to the snapshot file or a readable binary file object
+        :return: True if the snapshot was installed
+        """
+        self.local_db.engine.dispose()
+        if AlchemySnapshot.install_snapshot(source, self.local_db.location):
+            self.local_db = AlchemyLocal.H3AlchemyLocalDB(self.local_db.location)
+            self.SessionLocal.configure(bind=self.local_db.engine)
+            self.internal_state["base"] = "snapshot"
+            return True
+        return False
+
     def initial_setup(self):
         """
         If this is a new base, download the relevant records from base-specific tables.
         If this is a new user, download the user and job and then their current JC.
+        If a snapshot was installed, only the updates made since it was built are pulled.
 
         :return:
         """
@@ -180,17 +252,33 @@ class H3AlchemyCore:
             if self.internal_state["user"] == "remote":
                 records.extend(build_user_pack(remote_session, self.current_job_contract.user))
 
-        latest_sync_serial = AlchemyGeneric.get_highest_synced_sync_serial(remote_session)
-        latest_sync_entry = AlchemyGeneric.get_from_primary_key(remote_session, Acd.SyncJournal, latest_sync_serial)
-        records.append(latest_sync_entry)
-        remote_session.close()
+        if self.internal_state["base"] != "snapshot":
+            latest_sync_serial = AlchemyGeneric.get_highest_synced_sync_serial(remote_session)
+            latest_sync_entry = AlchemyGeneric.get_from_primary_key(remote_session, Acd.SyncJournal,
+                                                                    latest_sync_serial)
+            records.append(latest_sync_entry)
 
         AlchemyGeneric.merge_multiple(local_session, records)
+        local_session.flush()
+        # Packs come in no particular order : index the whole tree once rather than base by base
+        AlchemyTree.rebuild_closure(local_session)
+        AlchemySerials.backfill_serial_counters(local_session)
+        AlchemyStats.refresh_base_stats(local_session)
         local_session.commit()
 
         self.local_bases = AlchemyLocal.get_local_bases(local_session)
         self.local_job_contracts = AlchemyLocal.get_local_users(local_session)
 
+        if self.internal_state["base"] == "snapshot":
+            # The snapshot carries its own high-water mark : catch up from there
+            if self.rebase_sync_down(local_session, remote_session) == "success":
+                local_session.commit()
+            else:
+                local_session.rollback()
+            self.local_bases = AlchemyLocal.get_local_bases(local_session)
+            self.local_job_contracts = AlchemyLocal.get_local_users(local_session)
+
+        remote_session.close()
         local_session.close()
 
     # Login functions
@@ -253,6 +341,43 @@ class H3AlchemyCore:
                          .format(login=username))
             return False
 
+    # Unit of work functions
+
+    def unit_of_work(self, location="local"):
+        """
+        Opens a unit of work for a screen or batch job, to be passed to the core calls through their uow argument.
+        The caller commits, rolls back and closes it.
+        :param location: "local" or "remote"
+        :return: a H3UnitOfWork
+        """
+        if location == "remote":
+            return H3UnitOfWork(self.SessionRemote)
+        return H3UnitOfWork(self.SessionLocal)
+
+    @contextlib.contextmanager
+    def session_scope(self, uow=None, location="local"):
+        """
+        Yields the session of the unit of work if one is given, otherwise a fresh session closed on exit.
+        """
+        if uow:
+            yield uow.session
+        else:
+            session = self.SessionRemote() if location == "remote" else self.SessionLocal()
+            try:
+                yield session
+            finally:
+                session.close()
+
+    @staticmethod
+    def finish(session, uow):
+        """
+        Commits a write, unless it belongs to a unit of work in which case it is only flushed for the owner to commit.
+        """
+        if uow:
+            session.flush()
+        else:
+            session.commit()
+
     # Application functions
 
     def update_user_status(self, user):
@@ -288,74 +413,279 @@ class H3AlchemyCore:
 
         self.options.write(open('config.txt', 'w'))
 
-    def update_assigned_actions(self):
-        local_session = self.SessionLocal()
-        action_pairs = AlchemyGeneric.get_assigned_actions(local_session, self.current_job_contract)
-        local_session.close()
-        for assigned_action, _throwaway in action_pairs:
-            self.assigned_actions.append(assigned_action)
+    def update_assigned_actions(self, uow=None):
+        with self.session_scope(uow) as local_session:
+            action_pairs = AlchemyGeneric.get_assigned_actions(local_session, self.current_job_contract)
+        self.assigned_actions = [assigned_action for assigned_action, _action in action_pairs or list()]
+        self.actions = dict((action.code, action) for _assigned_action, action in action_pairs or list())
 
-    def create_base(self, base):
+    def get_catalog(self, uow=None):
+        """
+        The parsed translations of the actions, for the menu and anything else showing them.
+        """
+        catalog = AlchemyLocalization.cached()
+        if catalog is None:
+            with self.session_scope(uow) as local_session:
+                catalog = AlchemyLocalization.get_catalog(local_session)
+        return catalog
+
+    def can(self, action, amount=None, scope=AlchemyAuthorization.ANY_SCOPE, currency=None, on_date=None):
+        """
+        Permission check for the current contract, ie can("sign_off", 5000, "project:PRJ-12", "USD").
+        Answered from the contract's compiled permissions, built on first use and dropped by sync.
+        """
+        permissions = AlchemyAuthorization.cached(self.current_job_contract.code)
+        if permissions is None:
+            with self.session_scope() as local_session:
+                permissions = AlchemyAuthorization.get_permissions(local_session, self.current_job_contract.code)
+        return bool(permissions) and permissions.can(action, amount, scope, currency, on_date)
+
+    @relayed
+    def find_approvers(self, action, amount=None, scope=AlchemyAuthorization.ANY_SCOPE, currency=None, on_date=None,
+                       uow=None):
+        """
+        The contracts that can sign off an amount, ie find_approvers("sign_off", 20000, "base:BASE-3", "USD").
+        :return: sorted list of contract codes, empty on failure
+        """
+        with self.session_scope(uow) as local_session:
+            try:
+                return AlchemyAuthorization.find_approvers(local_session, action, amount, scope, currency, on_date)
+            except sqlalchemy.exc.SQLAlchemyError:
+                logger.exception(_("Unable to look up the approvers of {action}")
+                                 .format(action=action))
+                return list()
+
+    @relayed
+    def create_base(self, base, uow=None):
         """
         Prepares the record and sync entry to submit to local DB
         :param base:
+        :param uow: optional unit of work; if given, the caller commits
         :return:
         """
-        local_session = self.SessionLocal()
-        # self.get_authorizations('create_base', local_session)
-        record_incrementer(base, local_session)
-        code_builder(base)
-
-        sync_entry = self.prepare_sync_entry(base, local_session, "CREATE")
-
-        try:
-            local_session.add(base)
-            local_session.add(sync_entry)
-            local_session.commit()
-            return "OK"
-        except sqlalchemy.exc.SQLAlchemyError:
-            logger.exception(_("Failed to create base"))
-            local_session.rollback()
-            return "ERR"
-        finally:
-            local_session.close()
+        with self.session_scope(uow) as local_session:
+            # self.get_authorizations('create_base', local_session)
+            return self.write_record(local_session, base, "CREATE", uow, _("Failed to create base"))
 
-    def update_base(self, base):
+    @relayed
+    def update_base(self, base, uow=None):
         """
         Prepares the record and sync entry to submit to local DB
         :param base:
+        :param uow: optional unit of work; if given, the caller commits
         :return:
         """
-        local_session = self.SessionLocal()
-        # Check for cycles (can't make base child of its own child)
-        for child in AlchemyGeneric.subtree(local_session, base.code):
-            if base.parent == child:
+        with self.session_scope(uow) as local_session:
+            # Check for cycles (can't make base child of its own child)
+            if AlchemyTree.would_create_cycle(local_session, base.code, base.parent):
                 return "ERR"
+            return self.write_record(local_session, base, "UPDATE", uow, _("Failed to update base"))
+
+    @relayed
+    def record_movement(self, movement, uow=None):
+        """
+        Writes a line of the stock ledger to local DB, with its sync entry
+        :param movement: a new StockMovement; its period follows its date
+        :param uow: optional unit of work; if given, the caller commits
+        :return:
+        """
+        with self.session_scope(uow) as local_session:
+            movement.period = AlchemyStock.period_of(movement.moved_date)
+            if movement.origin_jc is None:
+                movement.origin_jc = self.current_job_contract.code
+            return self.write_record(local_session, movement, "CREATE", uow, _("Failed to record stock movement"))
+
+    @relayed
+    def get_stock_on_hand(self, base_code, item_code, on_date=None, uow=None):
+        """
+        :return: the balance of an item at a base (Decimal), or None on failure
+        """
+        with self.session_scope(uow) as local_session:
+            try:
+                return AlchemyStock.stock_on_hand(local_session, base_code, item_code, on_date)
+            except sqlalchemy.exc.SQLAlchemyError:
+                logger.exception(_("Unable to read the stock of {item} at {base}")
+                                 .format(item=item_code, base=base_code))
+                return None
+
+    @relayed
+    def get_stock_levels(self, base_code, on_date=None, uow=None):
+        """
+        :return: dict of {item code: balance} for a base, empty on failure
+        """
+        with self.session_scope(uow) as local_session:
+            try:
+                return AlchemyStock.stock_levels(local_session, base_code, on_date)
+            except sqlalchemy.exc.SQLAlchemyError:
+                logger.exception(_("Unable to read the stock levels of {base}")
+                                 .format(base=base_code))
+                return dict()
 
-        sync_entry = self.prepare_sync_entry(base, local_session, "UPDATE")
+    @relayed
+    def create_budget_line(self, budget_line, uow=None):
+        """
+        Prepares the record and sync entry to submit to local DB
+        :param budget_line:
+        :param uow: optional unit of work; if given, the caller commits
+        :return:
+        """
+        with self.session_scope(uow) as local_session:
+            return self.write_record(local_session, budget_line, "CREATE", uow, _("Failed to create budget line"))
 
+    @relayed
+    def write_commitment(self, commitment, uow=None):
+        """
+        Records a new commitment, or an update of one (ie what was spent of it so far).
+        A new commitment takes the period and currency of its budget line.
+        :param commitment:
+        :param uow: optional unit of work; if given, the caller commits
+        :return:
+        """
+        with self.session_scope(uow) as local_session:
+            if commitment.code is None:
+                budget_line = AlchemyGeneric.get_from_primary_key(local_session, Acd.BudgetLine,
+                                                                  commitment.budget_line)
+                if budget_line is None:
+                    logger.error(_("Budget line {code} not found")
+                                 .format(code=commitment.budget_line))
+                    return "ERR"
+                commitment.period = budget_line.period
+                commitment.currency = budget_line.currency
+                entry_type = "CREATE"
+            else:
+                entry_type = "UPDATE"
+            return self.write_record(local_session, commitment, entry_type, uow, _("Failed to write commitment"))
+
+    @relayed
+    def get_budget(self, base_code, period, uow=None):
+        """
+        :return: detached copies of the BudgetRollup rows of a base's subtree for a period, one per currency
+        """
+        with self.session_scope(uow) as local_session:
+            return H3UnitOfWork.snapshot(AlchemyBudget.get_rollups(local_session, base_code, period) or list())
+
+    @relayed
+    def write_routing_rule(self, rule, uow=None):
+        """
+        Records a new routing rule, or an update of one.
+        :param rule:
+        :param uow: optional unit of work; if given, the caller commits
+        :return:
+        """
+        with self.session_scope(uow) as local_session:
+            if rule.code is None:
+                rule.base = rule.base or 'BASE-1'
+                rule.period = rule.period or 'PERMANENT'
+                entry_type = "CREATE"
+            else:
+                entry_type = "UPDATE"
+            return self.write_record(local_session, rule, entry_type, uow, _("Failed to write routing rule"))
+
+    @relayed
+    def get_route(self, action_code, uow=None):
+        """
+        The route the current contract's requests for an action follow, resolved once and cached.
+        :return: H3Route, or None on failure
+        """
+        route = AlchemyRouting.cached(action_code, self.current_job_contract.work_base,
+                                      self.current_job_contract.code)
+        if route is None:
+            with self.session_scope(uow) as local_session:
+                route = AlchemyRouting.get_route(local_session, action_code, self.current_job_contract.work_base,
+                                                 self.current_job_contract.code)
+        return route
+
+    @relayed
+    def send_for_approval(self, action_code, transaction_ref, body=None, step=None, uow=None):
+        """
+        Sends the messages of a step of an action's route (the first by default) about a transaction.
+        :param step: number of the step, ie the next one once the first approved
+        :param uow: optional unit of work; if given, the caller commits
+        :return:
+        """
+        route = self.get_route(action_code, uow=uow)
+        if route is None:
+            return "ERR"
+        route_steps = [route_step for route_step in route.step(step if step is not None else route.first_step())
+                       if route_step.recipient]
+        if not route_steps:
+            logger.error(_("No recipient for action {action}, step {step}")
+                         .format(action=action_code, step=step))
+            return "ERR"
+        error_message = _("Failed to send the messages of action {action}").format(action=action_code)
+        with self.session_scope(uow) as local_session:
+            sent = datetime.datetime.utcnow()
+            for position, route_step in enumerate(route_steps, 1):
+                message = Acd.Message(base=self.current_job_contract.work_base,
+                                      period='PERMANENT',
+                                      origin_jc=self.current_job_contract.code,
+                                      target_jc=route_step.recipient,
+                                      sent=sent,
+                                      transaction_ref=transaction_ref,
+                                      requested_action=route_step.requested_action,
+                                      body=body)
+                # The messages of a step are committed together, with the last one
+                result = self.write_record(local_session, message, "CREATE", uow, error_message,
+                                           commit=position == len(route_steps))
+                if result != "OK":
+                    return result
+            return "OK"
+
+    def write_record(self, session, record, entry_type, uow, error_message, commit=True):
+        """
+        Writes a record and its sync entry, with the tables derived from the record : a new record gets its serial
+        and code first. Rolled back on failure.
+        :param entry_type: "CREATE" or "UPDATE"
+        :param uow: the unit of work of the call; if given, the caller commits
+        :param error_message: logged on failure
+        :param commit: False to leave the commit to a later write of the same call
+        :return: "OK" or "ERR"
+        """
+        if entry_type == "CREATE" and (record.base is None or record.period is None):
+            logger.error(_("{error} : no base or period given").format(error=error_message))
+            return "ERR"
         try:
-            local_session.merge(base)
-            local_session.add(sync_entry)
-            local_session.commit()
+            if entry_type == "CREATE":
+                if record.serial is None and record_incrementer(record, session) is None:
+                    session.rollback()
+                    return "ERR"
+                code_builder(record)
+            sync_entry = self.prepare_sync_entry(record, session, entry_type)
+            before_record_written(session, record)
+            if entry_type == "CREATE":
+                session.add(record)
+            else:
+                session.merge(record)
+            session.add(sync_entry)
+            session.flush()
+            after_record_written(session, record)
+            if commit:
+                self.finish(session, uow)
             return "OK"
         except sqlalchemy.exc.SQLAlchemyError:
-            logger.exception(_("Failed to update base"))
-            local_session.rollback()
+            logger.exception(error_message)
+            session.rollback()
             return "ERR"
-        finally:
-            local_session.close()
 
     def prepare_sync_entry(self, record, session, entry_type):
-        sync_entry = Acd.SyncJournal(serial=AlchemyLocal.get_lowest_queued_sync_entry(session) - 1,
-                                     origin=self.current_job_contract.code,
-                                     type=entry_type,
-                                     table=sqlalchemy.inspect(record).class_.__tablename__,
-                                     key=record.code,
-                                     status="UNSUBMITTED",
-                                     local_timestamp=datetime.datetime.utcnow())
-        return sync_entry
+        return self.prepare_sync_entries([record], session, entry_type)[0]
 
+    def prepare_sync_entries(self, records, session, entry_type):
+        """
+        Sync entries of a batch of records, numbered down from a single read of the queue.
+        """
+        lowest = AlchemyLocal.get_lowest_queued_sync_entry(session)
+        now = datetime.datetime.utcnow()
+        return [Acd.SyncJournal(serial=lowest - offset - 1,
+                                origin=self.current_job_contract.code,
+                                type=entry_type,
+                                table=sqlalchemy.inspect(record).class_.__tablename__,
+                                key=record.code,
+                                status="UNSUBMITTED",
+                                local_timestamp=now)
+                for offset, record in enumerate(records)]
+
+    @relayed
     def sync_up(self):
         """
         Sends unsubmitted (negative) sync entries to remote DB.
@@ -395,10 +725,39 @@ class H3AlchemyCore:
                 logger.debug(_("Sync up succeeded, no new updates from server"))
             else:
                 logger.error(_("Sync up succeeded but error downloading updates"))
+            self.download_stats(local_session, remote_session)
+            self.bound_local_history(local_session)
         local_session.close()
         remote_session.close()
         logger.debug(_("Sync end"))
 
+    def bound_local_history(self, local_session):
+        """
+        Once the local edits are uploaded, drops the local history past the local retention policy.
+        """
+        if local_session.info.get('versioning', True) is False:
+            return
+        for table, report in AlchemyRetention.apply_local_retention(local_session, self.options).items():
+            if report is False:
+                local_session.rollback()
+            elif report['moved']:
+                logger.debug(_("{no} old versions of {table} dropped from the local history")
+                             .format(no=report['moved'], table=table))
+
+    def download_stats(self, local_session, remote_session):
+        """
+        Optionally brings the stats of the local bases from the main DB, which holds all their contracts.
+        Off with "download stats = no" in the H3 Options of config.txt.
+        """
+        if not self.options.getboolean('H3 Options', 'download stats', fallback=True):
+            return
+        if AlchemyStats.download_base_stats(local_session, remote_session, self.local_bases) is False:
+            local_session.rollback()
+            remote_session.rollback()
+        else:
+            local_session.commit()
+            remote_session.commit()
+
     def rebase_sync_down(self, local_session, remote_session, conflict=False):
         """
         :return:
@@ -453,56 +812,242 @@ class H3AlchemyCore:
                     records_to_rebase.reverse()
                     for record_to_rebase in records_to_rebase:
                         # 0 = serial to apply, 1 = entry, 2 = record
+                        before_record_written(local_session, record_to_rebase[2])
+                        old_code = record_to_rebase[2].code
                         record_to_rebase[2].serial = record_to_rebase[0]
                         code_builder(record_to_rebase[2])
                         record_to_rebase[1].key = record_to_rebase[2].code
-                        local_session.merge(record_to_rebase[2])
-                        local_session.flush()
+                        with versioning_paused(local_session):
+                            local_session.merge(record_to_rebase[2])
+                            local_session.flush()
+                        if hasattr(record_to_rebase[2], '__history_mapper__'):
+                            AlchemyHistory.rename_history(local_session, type(record_to_rebase[2]),
+                                                          old_code, record_to_rebase[2].code)
+                        after_record_written(local_session, record_to_rebase[2])
                 except sqlalchemy.exc.SQLAlchemyError:
                     logger.exception(_("Error rebasing updates"))
                     result = "rebase_error"
         if result == "success":
-            result = process_downloaded_updates(remote_entries, remote_records, local_session)
+            result = process_downloaded_updates(remote_entries, remote_records, local_session, remote_session)
 
         return result
 
-    def export_bases(self):
-        local_session = self.SessionLocal()
-        bases = AlchemyGeneric.read_table(local_session, Acd.WorkBase)
-        local_session.close()
-        filename = XLexport.bases_writer(bases)
+    def export_bases(self, lookup=False, query=None, uow=None):
+        """
+        Streams the bases from the cursor to the workbook, without loading the table first.
+        Parents are shown by identifier, read along with each base.
+        :param lookup: keep the parent column as a live lookup into the Data sheet
+        :param query: an ORM query on the bases to narrow the export, or None for all of them
+        :return: the file name
+        """
+        parents = Acd.WorkBase.__table__.alias()
+        select = sqlalchemy.select([Acd.WorkBase.code,
+                                    Acd.WorkBase.identifier,
+                                    Acd.WorkBase.parent,
+                                    parents.c.identifier,
+                                    Acd.WorkBase.full_name,
+                                    Acd.WorkBase.opened_date,
+                                    Acd.WorkBase.closed_date,
+                                    Acd.WorkBase.country,
+                                    Acd.WorkBase.time_zone]) \
+            .select_from(Acd.WorkBase.__table__.outerjoin(parents, parents.c.code == Acd.WorkBase.parent))
+        if query is not None:
+            select = select.where(Acd.WorkBase.code.in_(query.with_entities(Acd.WorkBase.code).subquery()))
+        with self.session_scope(uow) as local_session:
+            bases = local_session.execute(select.order_by(Acd.WorkBase.serial)
+                                          .execution_options(stream_results=True))
+            filename = XLexport.bases_writer(bases, lookup)
         return filename
 
+    def export_table(self, mapped_class, query=None, title=None, lookup=False, uow=None):
+        """
+        Exports the records of any class, laid out from its mapper, ie users, contracts or the sync journal.
+        Bases go out in the layout the bases import reads back, see export_bases.
+        :param query: an ORM query on the class to narrow the export, or None for the whole table
+        :param lookup: keep the labels of the foreign keys to the class itself as live lookups
+        :return: the file name, or None on failure
+        """
+        try:
+            if mapped_class is Acd.WorkBase:
+                return self.export_bases(lookup, query, uow=uow)
+            with self.session_scope(uow) as local_session:
+                columns, rows = AlchemyExport.export_rows(local_session, mapped_class, query, lookup)
+                return XLexport.table_writer(title or AlchemyExport.export_title(mapped_class), columns, rows)
+        except sqlalchemy.exc.SQLAlchemyError:
+            logger.exception(_("Unable to export table {table}")
+                             .format(table=mapped_class.__tablename__))
+            return None
+
+    @relayed
+    def search(self, text, tables=None, limit=20, uow=None):
+        """
+        Prefix search over bases, users and job contracts of the local DB.
+        :return: list of (table, code, label), best matches first
+        """
+        with self.session_scope(uow) as local_session:
+            return AlchemySearch.search(local_session, text, tables, limit)
+
+    def archive_closed_periods(self):
+        """
+        Moves every closed period out of the local DB into its own archive file, then compacts the local DB.
+        :return: dict of {period: records moved, or False on failure}
+        """
+        with self.session_scope() as local_session:
+            periods = AlchemyArchive.get_closed_periods(local_session)
+        results = dict()
+        for period in periods:
+            results[period] = AlchemyArchive.archive_period(self.local_db, period)
+        if any(results.values()):
+            self.local_db.compact()
+        return results
+
+    def read_archive(self, class_of_table, period):
+        with self.session_scope() as local_session:
+            return AlchemyArchive.read_archived_table(local_session, class_of_table, period)
+
+    def get_record_as_of(self, mapped_class, code, timestamp, location="remote"):
+        """
+        A versioned record as it was at a point in time. The main DB has the whole history,
+        a local DB (location="local") the history of its own edits, within the local retention.
+        :param timestamp: naive UTC datetime
+        """
+        with self.session_scope(location=location) as session:
+            return AlchemyHistory.record_as_of(session, mapped_class, code, timestamp)
+
+    def get_subtree_as_of(self, base_code, timestamp, location="remote"):
+        with self.session_scope(location=location) as session:
+            return AlchemyHistory.subtree_as_of(session, base_code, timestamp)
+
+    def get_changes(self, mapped_class, code, before_version=None, page_size=50, location="remote"):
+        with self.session_scope(location=location) as session:
+            return AlchemyHistory.list_changes(session, mapped_class, code, before_version, page_size)
+
     def import_excel(self, filename):
-        return XLimport.data_reader(filename)
+        """
+        :return: the rows of the Data sheet, read lazily
+        """
+        return XLimport.row_reader(filename)
 
-    def get_queue(self):
-        local_session = self.SessionLocal()
-        return AlchemyLocal.get_sync_queue(local_session)
+    def import_bases(self, rows, chunk_size=AlchemyImport.IMPORT_CHUNK):
+        """
+        Creates bases out of the rows of a Data sheet, chunk by chunk as they are read.
+        Each chunk is validated with a couple of queries, then written in one transaction :
+        one serial reservation, one batch of sync entries. Rows of a chunk that fails to write all fail.
+        With a relay configured, each chunk is one round-trip to it.
+        :param rows: iterable of rows in the layout of the bases export, ie import_excel(filename)
+        :return: generator of (row number, "OK" or "ERR", code or error message), yielded once each chunk is committed
+        """
+        row_no = 0
+        for chunk in XLimport.chunked(rows, chunk_size):
+            try:
+                results = self.import_bases_chunk(chunk)
+            except AlchemyRelay.RelayError:
+                # The relay may have written it : the rows are reported, not imported again here
+                logger.exception(_("Import of a chunk of {no} bases not confirmed by the relay")
+                                 .format(no=len(chunk)))
+                results = [("ERR", _("Sent to the relay but not confirmed, check the bases before importing again"))] \
+                    * len(chunk)
+            for result, detail in results:
+                yield row_no, result, detail
+                row_no += 1
+
+    @relayed
+    def import_bases_chunk(self, rows, uow=None):
+        """
+        :param rows: list of rows of the Data sheet
+        :param uow: optional unit of work; if given, the caller commits
+        :return: list of ("OK", code) or ("ERR", error message), one per row
+        """
+        with self.session_scope(uow) as local_session:
+            checked = [(None, None)] * len(rows)
+            try:
+                checked = AlchemyImport.check_bases(local_session, rows)
+                bases = [base for base, error in checked if base is not None]
+                if bases:
+                    first_serial = AlchemySerials.reserve_serials(local_session, Acd.WorkBase, 'BASE-1', len(bases))
+                    if first_serial is None:
+                        raise sqlalchemy.exc.InvalidRequestError(_("No serials reserved"))
+                    for offset, base in enumerate(bases):
+                        base.serial = first_serial + offset
+                        code_builder(base)
+                    sync_entries = self.prepare_sync_entries(bases, local_session, "CREATE")
+                    # Codes are built from serials just reserved : nothing is stored under them to retract
+                    local_session.add_all(bases)
+                    local_session.add_all(sync_entries)
+                    local_session.flush()
+                    after_records_created(local_session, bases)
+                # read before the commit expires them
+                results = [("OK", base.code) if base is not None else ("ERR", error) for base, error in checked]
+                self.finish(local_session, uow)
+                return results
+            except sqlalchemy.exc.SQLAlchemyError:
+                logger.exception(_("Failed to import a chunk of {no} bases")
+                                 .format(no=len(rows)))
+                local_session.rollback()
+                return [("ERR", error or _("Chunk not written, see the log")) for base, error in checked]
 
-    def read_table(self, class_of_table, location="local"):
-        session = self.SessionLocal()
-        if location == "remote":
-            session = self.SessionRemote()
-        table = AlchemyGeneric.read_table(session, class_of_table)
-        session.close()
-        return table
+    @relayed
+    def reserve_serials(self, mapped_class, base_code, count, uow=None):
+        """
+        Reserves the serials of a batch of new records at once, ie before an import.
+        :return: the first serial of the range, or None on failure
+        """
+        with self.session_scope(uow) as local_session:
+            first_serial = AlchemySerials.reserve_serials(local_session, mapped_class, base_code, count)
+            if first_serial is not None:
+                self.finish(local_session, uow)
+            return first_serial
+
+    @relayed
+    def get_queue(self, uow=None):
+        with self.session_scope(uow) as local_session:
+            return AlchemyLocal.get_sync_queue(local_session)
+
+    @relayed
+    def read_table(self, class_of_table, location="local", uow=None):
+        with self.session_scope(uow, location) as session:
+            return AlchemyGeneric.read_table(session, class_of_table)
+
+    @relayed
+    def get_user_count(self, base_code, location="local", uow=None):
+        with self.session_scope(uow, location) as session:
+            return AlchemyGeneric.user_count(session, base_code)
+
+    def get_active_contracts(self, users=None, base_code=None, on_date=None, location="local"):
+        """
+        The contract held at a date by each of a set of users, or by the staff of a base subtree.
+        :return: dict of {user code: JobContract}
+        """
+        with self.session_scope(location=location) as session:
+            try:
+                return AlchemyGeneric.get_active_contracts(session, users, base_code, on_date)
+            except sqlalchemy.exc.SQLAlchemyError:
+                logger.exception(_("Unable to query the active job contracts"))
+                return dict()
 
-    def get_user_count(self, base_code, location="local"):
-        session = self.SessionLocal()
-        if location == "remote":
-            session = self.SessionRemote()
-        count = AlchemyGeneric.user_count(session, base_code)
-        session.close()
-        return count
+    def get_contract_overlaps(self, users=None, location="local"):
+        with self.session_scope(location=location) as session:
+            return AlchemyGeneric.get_contract_overlaps(session, users)
 
-    def get_from_primary_key(self, mapped_class, pkey, location="local"):
-        session = self.SessionLocal()
-        if location == "remote":
-            session = self.SessionRemote()
-        record = AlchemyGeneric.get_from_primary_key(session, mapped_class, pkey)
-        session.close()
-        return record
+    @relayed
+    def get_base_stats(self, base_code, uow=None):
+        """
+        A stale row is recomputed and stored on the way : always in a short session of its own, committed at once,
+        so reading stats never leaves a write (and the lock of the DB file) pending in a screen's unit of work.
+        :param uow: accepted like the other core calls, not used
+        :return: a detached copy of the BaseStats of a base, or None
+        """
+        with self.session_scope() as local_session:
+            stats = AlchemyStats.get_base_stats(local_session, base_code)
+            if stats:
+                stats = H3UnitOfWork.snapshot(stats)
+                local_session.commit()
+            return stats
+
+    @relayed
+    def get_from_primary_key(self, mapped_class, pkey, location="local", uow=None):
+        with self.session_scope(uow, location) as session:
+            return AlchemyGeneric.get_from_primary_key(session, mapped_class, pkey)
 
 
 def open_spreadsheet(filename):
@@ -522,37 +1067,66 @@ def code_builder(record):
     Global records have base = GLOBAL and will not have this prefix
     Permanent records (never archived) have period = PERMANENT and the year / quarter etc will not appear
     Examples : SHB-REQUISITION-2015-172 , USER-324
+    Stock movements coded before base and period were concatenated are renamed by AlchemyStock.repair_codes
     """
     mapper = sqlalchemy.inspect(record).mapper
-    base = record.base.join("-") if record.base != 'BASE-1' else ''
-    period = record.period.join("-") if record.period != 'PERMANENT' else ''
+    base = record.base + "-" if record.base != 'BASE-1' else ''
+    period = record.period + "-" if record.period != 'PERMANENT' else ''
     record.code = "{base}{prefix}-{period}{serial}".format(base=base,
                                                            prefix=mapper.class_.prefix,
                                                            period=period,
                                                            serial=record.serial)
 
 
-def process_downloaded_updates(entries, records, local_session):
+def process_downloaded_updates(entries, records, local_session, remote_session=None):
     """Records updates from the main DB as-is.
 
     :param entries: the Acd.SyncJournal objects pointing to records to process
     :param records: the records themselves; various types depending on AlchemyClassDefs object
+    :param remote_session: to settle a base moved here under one of its own sub-bases by a local change not
+    uploaded yet : the main DB wins, see yield_to_master
     :return:
     :rtype : object
     """
     down_sync_status = "success"
     fresh_entries = list()
+    local_history = local_session.info.get('versioning', True)
 
     if entries and records:
+        archived_periods = AlchemyArchive.get_archived_periods(local_session)
         for entry, record in zip(entries, records):
+            if str(record.period) in archived_periods:
+                # Archived periods stay in their archive files, never resurrected in the hot DB
+                logger.debug(_("Skipping update {type} {code} of archived period {period}")
+                             .format(type=entry.type, code=record.code, period=record.period))
+                continue
+            if entry.type == "UPDATE" and isinstance(record, Acd.WorkBase) and \
+                    AlchemyTree.would_create_cycle(local_session, record.code, record.parent):
+                # Moves crossed between sites : the queued local moves between the base and its new parent
+                # give way to the main DB's, which never holds a cycle
+                if remote_session is not None:
+                    for code in AlchemyTree.ancestors(local_session, record.parent):
+                        if code == record.code:
+                            break
+                        yield_to_master(local_session, remote_session, Acd.WorkBase, code)
+                if AlchemyTree.would_create_cycle(local_session, record.code, record.parent):
+                    logger.error(_("Skipping update of base {code}, its parent {parent} is one of its sub-bases here")
+                                 .format(code=record.code, parent=record.parent))
+                    continue
             try:
                 Acd.detach(record)
-                if entry.type == "CREATE":
-                    local_session.add(record)
-                elif entry.type == "UPDATE":
-                    local_session.merge(record)
+                before_record_written(local_session, record)
+                # the main DB versioned the update already; the local history keeps the version it replaces
+                if entry.type == "UPDATE" and local_history and hasattr(record, '__history_mapper__'):
+                    AlchemyHistory.snapshot_current(local_session, type(record), record.code, record.version)
+                with versioning_paused(local_session):
+                    if entry.type == "CREATE":
+                        local_session.add(record)
+                    elif entry.type == "UPDATE":
+                        local_session.merge(record)
 
-                local_session.flush()
+                    local_session.flush()
+                after_record_written(local_session, record)
             except sqlalchemy.exc.SQLAlchemyError:
                 logger.exception(_("Failed to process downloaded update {type} {code}")
                                  .format(type=entry.type, code=record.code))
@@ -572,6 +1146,112 @@ def process_downloaded_updates(entries, records, local_session):
     return down_sync_status
 
 
+def before_record_written(session, record):
+    """
+    Takes the stored version of a record out of the tables derived from it, before it's written or deleted.
+    Always paired with after_record_written, except for deletions.
+    :param record: the record about to be written; may be detached
+    """
+    AlchemyStats.retract_record(session, record)
+    AlchemyStock.retract_record(session, record)
+    AlchemyBudget.retract_record(session, record)
+    AlchemyAuthorization.retract_record(session, record)
+
+
+def after_record_written(session, record):
+    """
+    Keeps the tables derived from a record in step with it, in the same transaction.
+    Called on every local write, downloaded update and uploaded update, once the record is flushed.
+    :param record: the record as written; may be detached
+    """
+    if isinstance(record, Acd.WorkBase):
+        AlchemyTree.place_base(session, record.code, record.parent)
+    if hasattr(record, 'prefix') and record.serial is not None:
+        AlchemySerials.bump_serial(session, type(record), record.base, record.serial)
+    AlchemyStats.apply_record(session, record)
+    AlchemyStock.apply_record(session, record)
+    AlchemyBudget.apply_record(session, record)
+    AlchemyAuthorization.apply_record(session, record)
+    if isinstance(record, (Acd.AssignedAction, Acd.Action, Acd.JobContract)):
+        AlchemyAuthorization.invalidate()
+    if isinstance(record, Acd.Action):
+        AlchemyLocalization.invalidate()
+    if isinstance(record, (Acd.RoutingRules, Acd.WorkBase, Acd.JobContract)):
+        AlchemyRouting.invalidate()
+
+
+def after_records_created(session, records):
+    """
+    after_record_written for a batch of brand new records, ie an import. New bases are leaves under parents
+    already in the tree : the index and the stats take a few statements for the whole batch. Their serials
+    were reserved, and no budget, stock or limits hang from them yet.
+    """
+    bases = [record for record in records if isinstance(record, Acd.WorkBase)]
+    if bases:
+        paths = AlchemyTree.place_new_bases(session, [(base.code, base.parent) for base in bases])
+        AlchemyStats.apply_new_bases(session, bases, paths)
+        AlchemyRouting.invalidate()
+    for record in records:
+        if not isinstance(record, Acd.WorkBase):
+            after_record_written(session, record)
+
+
+def upload_versions(local_session, remote_session, record):
+    """
+    Sends the history a local DB kept of a versioned record along with it, so the main DB
+    doesn't version the upload again. Only done when the local history covers every version
+    since the one the main DB holds; otherwise the main DB versions the upload itself.
+    :return: True if the history was uploaded
+    """
+    mapped_class = type(record)
+    if not hasattr(mapped_class, '__history_mapper__') or not record.version:
+        return False
+    stored_version = remote_session.query(mapped_class.version) \
+        .filter(mapped_class.code == record.code) \
+        .scalar()
+    first_version = stored_version or 1
+    if record.version <= first_version:
+        return False
+    rows = AlchemyHistory.versions_between(local_session, mapped_class, record.code, first_version, record.version)
+    if len(rows) != record.version - first_version:
+        return False
+    AlchemyHistory.copy_versions(remote_session, mapped_class, rows)
+    return True
+
+
+def yield_to_master(local_session, remote_session, mapped_class, code):
+    """
+    Settles a local change the main DB can't take, ie a base moved under one of its own sub-bases once the moves
+    of two sites crossed : the main DB's version of the record replaces the local one, and the queued changes
+    of the record are dropped from the queue.
+    :return: True if the local record now matches the main DB
+    """
+    queued = local_session.query(Acd.SyncJournal) \
+        .filter(Acd.SyncJournal.serial < 0,
+                Acd.SyncJournal.table == mapped_class.__tablename__,
+                Acd.SyncJournal.key == code) \
+        .all()
+    if not queued:
+        return False
+    master = AlchemyGeneric.get_from_primary_key(remote_session, mapped_class, code)
+    if master is None:
+        return False
+    if isinstance(master, Acd.WorkBase) and AlchemyTree.would_create_cycle(local_session, code, master.parent):
+        return False
+    Acd.detach(master)
+    before_record_written(local_session, master)
+    with versioning_paused(local_session):
+        local_session.merge(master)
+        local_session.flush()
+    after_record_written(local_session, master)
+    for entry in queued:
+        local_session.delete(entry)
+    local_session.flush()
+    logger.warning(_("{no} local changes of {code} rejected, replaced by the version of the main DB")
+                   .format(no=len(queued), code=code))
+    return True
+
+
 def attempt_upload(local_session, remote_session):
     """
     Tries an optimistic upload of unsubmitted updates.
@@ -596,23 +1276,45 @@ def attempt_upload(local_session, remote_session):
             Acd.detach(record)
 
         to_be_deleted = list()
+        rejected = set()
 
         try:
             for entry, record in zip(entries, records):
                 timestamp = None
                 journal_serial = AlchemyGeneric.get_highest_synced_sync_serial(remote_session)
 
+                if (entry.table, entry.key) in rejected:
+                    continue
                 if entry.status == "UNSUBMITTED":
+                    if entry.type == "UPDATE" and isinstance(record, Acd.WorkBase) and \
+                            AlchemyTree.would_create_cycle(remote_session, record.code, record.parent):
+                        # Moves crossed between sites : the main DB wins, the local move is dropped from the queue
+                        if yield_to_master(local_session, remote_session, Acd.WorkBase, record.code):
+                            rejected.add((entry.table, entry.key))
+                        else:
+                            logger.error(_("Update of base {code} left in the queue, its parent {parent} is one "
+                                           "of its sub-bases in the main DB")
+                                         .format(code=record.code, parent=record.parent))
+                        continue
                     # Get a timestamp from the server and actually try and make the changes to remote
                     if entry.type == "CREATE":
                         # This needs an extra step to avoid collisions : deleting the local version, deferred
                         timestamp = remote_session.execute(sqlalchemy.func.current_timestamp()).scalar()
+                        before_record_written(remote_session, record)
+                        upload_versions(local_session, remote_session, record)
                         remote_session.add(record)
                         remote_session.flush()
+                        after_record_written(remote_session, record)
                         to_be_deleted.append(entry)
                     elif entry.type == "UPDATE":
                         timestamp = remote_session.execute(sqlalchemy.func.current_timestamp()).scalar()
-                        remote_session.merge(record)
+                        before_record_written(remote_session, record)
+                        uploaded = upload_versions(local_session, remote_session, record)
+                        merged = remote_session.merge(record)
+                        if uploaded:
+                            skip_version(remote_session, merged)
+                        remote_session.flush()
+                        after_record_written(remote_session, record)
 
                 # Manual increment of the global journal serial
                 journal_serial += 1
@@ -637,7 +1339,10 @@ def attempt_upload(local_session, remote_session):
                 # Processed backwards to avoid foreign key errors
                 mapped_class = Acd.get_class_by_table_name(entry.table)
                 try:
-                    local_session.query(mapped_class).filter(mapped_class.code == entry.key).delete()
+                    for record in local_session.query(mapped_class).filter(mapped_class.code == entry.key):
+                        before_record_written(local_session, record)
+                    with versioning_paused(local_session):
+                        local_session.query(mapped_class).filter(mapped_class.code == entry.key).delete()
                 except sqlalchemy.exc.SQLAlchemyError:
                     logger.exception(_("Couldn't delete the local version of record"))
 
@@ -717,6 +1422,97 @@ def init_remote(location, password):
     remote_session.close()
 
 
+def upgrade_remote(location, password):
+    target_db = AlchemyRemote.H3AlchemyRemoteDB(location)
+    if target_db.upgrade_db(password):
+        print(_("DB Upgrade successful"))
+    else:
+        print(_("DB Upgrade failed"))
+
+
+def prune_history(location, password, archive_file=None):
+    """
+    Applies the history retention policies to the main DB : old versions move to archive tables,
+    or to an archive file, batch by batch. Needs the master PG password.
+    """
+    target_db = AlchemyRemote.H3AlchemyRemoteDB(location)
+    target_db.admin_login(password)
+    options = configparser.ConfigParser()
+    options.read('config.txt')
+    archive_engine = AlchemyLocal.H3AlchemyLocalDB(archive_file).engine if archive_file else None
+    remote_session = sqlalchemy.orm.sessionmaker(bind=target_db.engine)()
+
+    reports = AlchemyRetention.apply_retention(remote_session, options, archive_engine)
+    remote_session.close()
+    for table, report in sorted(reports.items()):
+        if report is False:
+            print(_("{table} : history archiving failed, see the log")
+                  .format(table=table))
+        else:
+            print(_("{table} : {moved} versions archived, {compacted} snapshots rewritten whole, "
+                    "about {size} KB reclaimed")
+                  .format(table=table, moved=report['moved'], compacted=report['compacted'],
+                          size=report['bytes'] // 1024))
+    target_db.engine.dispose()
+
+
+def build_snapshot(location, username, password, base_code, filename):
+    """
+    Produces the snapshot file a new site installs from the wizard instead of downloading its base data.
+    """
+    source_db = AlchemyRemote.H3AlchemyRemoteDB(location)
+    if not source_db.login(username, password):
+        print(_("Unable to log into the main DB"))
+        return
+    SessionSnapshot = sqlalchemy.orm.sessionmaker()
+    SessionSnapshot.configure(bind=source_db.engine)
+    remote_session = SessionSnapshot()
+
+    serial = AlchemySnapshot.build_snapshot(remote_session, base_code, filename)
+    remote_session.close()
+    source_db.engine.dispose()
+    if serial is not None:
+        print(_("Snapshot of {base} written to {file} (sync serial {serial})")
+              .format(base=base_code, file=filename, serial=serial))
+    else:
+        print(_("Snapshot failed"))
+
+
+def run_relay(address, username, password):
+    """
+    Runs this machine as the relay of its site : it owns the local DB named in config.txt
+    and serves the desktops of the base until interrupted.
+    """
+    core = H3AlchemyCore()
+    if not core.options.read('config.txt') or not core.options.has_option('DB Locations', 'local'):
+        print(_("The relay needs the DB locations of config.txt"))
+        return
+    authkey = core.options.get('DB Locations', 'relay key', fallback='')
+    if not authkey:
+        print(_("The relay needs a relay key in config.txt, shared with the desktops of the site"))
+        return
+    core.local_db = AlchemyLocal.H3AlchemyLocalDB(core.options.get('DB Locations', 'local'))
+    core.SessionLocal.configure(bind=core.local_db.engine)
+    core.remote_db = AlchemyRemote.H3AlchemyRemoteDB(core.options.get('DB Locations', 'remote'))
+    if core.remote_db.login(username, password):
+        core.SessionRemote.configure(bind=core.remote_db.engine)
+    else:
+        logger.warning(_("Relay running without a connection to the main DB; syncs will fail"))
+    local_session = core.SessionLocal()
+    core.local_bases = AlchemyLocal.get_local_bases(local_session)
+    core.local_job_contracts = AlchemyLocal.get_local_users(local_session)
+    local_session.close()
+
+    server = AlchemyRelay.H3RelayServer(core, AlchemyRelay.parse_address(address), authkey.encode(),
+                                        sync_interval=300)
+    print(_("Relay serving {location} on {address}")
+          .format(location=core.local_db.location, address=server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
 def nuke_remote(location, password):
     target_db = AlchemyRemote.H3AlchemyRemoteDB(location)
     target_db.master_login('postgres', password)
@@ -771,20 +1567,16 @@ def build_user_pack(session, user_code):
 
 
 def build_base_pack(session, base_pkey):
-    records = list()
     sub_bases = AlchemyGeneric.subtree(session, base_pkey)
-    for base in sub_bases:
-        work_base = AlchemyGeneric.get_from_primary_key(session, Acd.WorkBase, base)
-        records.append(work_base)
-
-    return records
+    return AlchemyGeneric.get_from_primary_keys(session, Acd.WorkBase, sub_bases)
 
 
 def record_incrementer(record, session):
     """
     generates a new serial, for a brand new record.
     :param record:
-    :return:
+    :return: the serial, or None if none could be reserved : the record must not be written then
     """
     mapper = sqlalchemy.inspect(record).mapper
-    record.serial = AlchemyGeneric.get_highest_serial(session, mapper.class_, record.base) + 1
+    record.serial = AlchemySerials.reserve_serials(session, mapper.class_, record.base)
+    return record.serial
@@ -0,0 +1,111 @@
+__author__ = 'Man'
+
+import logging
+
+import sqlalchemy
+import sqlalchemy.orm
+
+from . import AlchemyClassDefs as Acd
+from ..XLLent import XLexport
+
+logger = logging.getLogger(__name__)
+
+# Columns naming a record for people, first found wins; records without any are shown by code
+LABEL_COLUMNS = ('identifier', 'login', 'job_title', 'full_name', 'category')
+
+YIELD_PER = 1000
+
+
+def label_column(mapped_class):
+    for name in LABEL_COLUMNS:
+        if name in mapped_class.__table__.c:
+            return mapped_class.__table__.c[name]
+    return None
+
+
+def column_kind(column):
+    if isinstance(column.type, sqlalchemy.DateTime):
+        return 'datetime'
+    if isinstance(column.type, sqlalchemy.Date):
+        return 'date'
+    if isinstance(column.type, sqlalchemy.Boolean):
+        return 'bool'
+    if isinstance(column.type, (sqlalchemy.Integer, sqlalchemy.Numeric)):
+        return 'number'
+    return 'text'
+
+
+def column_header(column):
+    return column.info.get('header') or column.name.replace('_', ' ').capitalize()
+
+
+def exported_columns(mapped_class):
+    """
+    The columns of a class that go to a spreadsheet, primary key first : columns marked info={'export': False}
+    (ie password hashes) stay out.
+    """
+    table = mapped_class.__table__
+    columns = [column for column in table.c if column.info.get('export', True)]
+    return [column for column in columns if column.primary_key] + \
+           [column for column in columns if not column.primary_key]
+
+
+def export_plan(mapped_class, lookup=False):
+    """
+    Reads the mapper once to lay out an export : one H3ExportColumn per value of the rows, the entities to query
+    and the outer joins bringing the label of every record a foreign key points to, shown in place of its code.
+    A foreign key to the class itself is also picked among the exported codes in the Data sheet.
+    :param lookup: keep the labels of those as live lookups into the Data sheet
+    :return: (list of H3ExportColumn, list of entities, list of (alias, on clause))
+    """
+    # H3 records show their label rather than their code and serial; others (ie the sync journal) show everything
+    hidden = ('code', 'serial') if hasattr(mapped_class, 'prefix') else ()
+    columns, entities, joins = list(), list(), list()
+    self_labels = list()
+
+    for column in exported_columns(mapped_class):
+        spec = XLexport.H3ExportColumn(column.name, column_header(column), column_kind(column),
+                                       in_view=column.name not in hidden, locked=column.primary_key)
+        columns.append(spec)
+        entities.append(column)
+        for foreign_key in column.foreign_keys:
+            target = Acd.get_class_by_table_name(foreign_key.column.table.name)
+            target_label = label_column(target) if target is not None else None
+            if target is mapped_class:
+                spec.codes = True
+            if target_label is not None:
+                # The code stays in the Data sheet, the view shows the label in its place
+                target_table = target.__table__.alias()
+                spec.in_view = False
+                label_spec = XLexport.H3ExportColumn(column.name + '_label', column_header(column), in_data=False)
+                columns.append(label_spec)
+                entities.append(target_table.c[target_label.name])
+                joins.append((target_table, target_table.c[foreign_key.column.name] == column))
+                if target is mapped_class and lookup:
+                    self_labels.append((label_spec, spec, target_label.name))
+
+    for label_spec, code_spec, label_name in self_labels:
+        label_spec.lookup = (code_spec, next(other for other in columns if other.name == label_name and other.in_data))
+    return columns, entities, joins
+
+
+def export_rows(session, mapped_class, query=None, lookup=False):
+    """
+    Streams the rows of an export from the DB, YIELD_PER at a time.
+    :param query: an ORM query on the class to narrow the export, or None for the whole table
+    :param lookup: keep the labels of the foreign keys to the class itself as live lookups
+    :return: (list of H3ExportColumn, iterable of rows in the same order)
+    """
+    columns, entities, joins = export_plan(mapped_class, lookup)
+    query = query.with_session(session) if query is not None else session.query(mapped_class)
+    for target, on_clause in joins:
+        query = query.outerjoin(target, on_clause)
+    primary_key = [column for column in mapped_class.__table__.c if column.primary_key]
+    rows = query.with_entities(*entities) \
+        .order_by(*primary_key) \
+        .yield_per(YIELD_PER)
+    return columns, rows
+
+
+def export_title(mapped_class):
+    return mapped_class.__tablename__.replace('_', ' ').capitalize()
@@ -8,6 +8,8 @@ import sqlalchemy.orm
 import sqlalchemy.exc
 
 from . import AlchemyClassDefs as Acd
+from . import AlchemyArchive
+from . import AlchemyTree
 
 logger = logging.getLogger(__name__)
 
@@ -36,26 +38,74 @@ def get_current_job_contract(session, user):
     :return:
     """
     try:
-        current_job = session.query(Acd.JobContract) \
-            .filter(Acd.JobContract.user == user.code) \
-            .filter(Acd.JobContract.start_date <= datetime.date.today(),
-                    Acd.JobContract.end_date >= datetime.date.today()) \
-            .one()
-        logger.debug(_("Active job found for user {name} : {job} - {title}")
-                     .format(name=user.login, job=current_job.job_code, title=current_job.job_title))
+        current_job = get_active_contracts(session, users=[user.code]).get(user.code)
+        if current_job:
+            logger.debug(_("Active job found for user {name} : {job} - {title}")
+                         .format(name=user.login, job=current_job.job_code, title=current_job.job_title))
+        else:
+            logger.info(_("No active jobs found for user {name}")
+                        .format(name=user.login))
         return current_job
-    except sqlalchemy.orm.exc.NoResultFound:
-        logger.info(_("No active jobs found for user {name}")
-                    .format(name=user.login))
-        return None
-    except sqlalchemy.orm.exc.MultipleResultsFound:
-        logger.error(_("Multiple active jobs found for user {name} !")
-                     .format(name=user.login))
     except sqlalchemy.exc.SQLAlchemyError:
         logger.exception(_("Querying the DB for {user}'s current job failed")
                          .format(user=user.login))
 
 
+def get_active_contracts(session, users=None, base_code=None, on_date=None):
+    """
+    The contract each user holds at a date, for a set of users or for everyone working in a base subtree,
+    in one query per 500 users over the validity indexes.
+    Where contracts overlap the one started last wins, and the overlap is logged (see get_contract_overlaps).
+    :param users: user codes
+    :param base_code: root of the subtree whose staff is wanted, if no users are given
+    :param on_date: defaults to today
+    :return: dict of {user code: JobContract}
+    """
+    on_date = on_date or datetime.date.today()
+    active = session.query(Acd.JobContract) \
+        .filter(Acd.JobContract.start_date <= on_date,
+                Acd.JobContract.end_date >= on_date)
+    if users is not None:
+        users = list(users)
+        queries = [active.filter(Acd.JobContract.user.in_(users[start:start + 500]))
+                   for start in range(0, len(users), 500)]
+    else:
+        sub_bases = session.query(Acd.BaseClosure.descendant) \
+            .filter(Acd.BaseClosure.ancestor == base_code)
+        queries = [active.filter(Acd.JobContract.work_base.in_(sub_bases))]
+
+    contracts = dict()
+    for query in queries:
+        for contract in query.order_by(Acd.JobContract.user, Acd.JobContract.start_date):
+            if contract.user in contracts:
+                logger.warning(_("Overlapping contracts {first} and {second} for user {user}")
+                               .format(first=contracts[contract.user].code, second=contract.code,
+                                       user=contract.user))
+            contracts[contract.user] = contract
+    return contracts
+
+
+def get_contract_overlaps(session, users=None):
+    """
+    Pairs of contracts of a same user whose validity intervals intersect, found in one self-join.
+    :param users: restrict the check to some user codes
+    :return: list of (JobContract, JobContract) tuples
+    """
+    other = sqlalchemy.orm.aliased(Acd.JobContract)
+    query = session.query(Acd.JobContract, other) \
+        .join(other, sqlalchemy.and_(other.user == Acd.JobContract.user,
+                                     other.code > Acd.JobContract.code)) \
+        .filter(Acd.JobContract.start_date <= other.end_date,
+                other.start_date <= Acd.JobContract.end_date)
+    if users is not None:
+        query = query.filter(Acd.JobContract.user.in_(list(users)))
+    try:
+        return query.all()
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to check the job contracts for overlaps"))
+        return list()
+
+
 def get_from_primary_key(session, class_to_query, p_key):
     if class_to_query:
         mapper = sqlalchemy.inspect(class_to_query)
@@ -77,6 +127,31 @@ def get_from_primary_key(session, class_to_query, p_key):
                      .format(cls=class_to_query, key=p_key))
 
 
+def get_from_primary_keys(session, class_to_query, p_keys, chunk_size=500):
+    """
+    Bulk version of get_from_primary_key : one query per chunk of keys instead of one per key.
+    Chunked to stay under the bound parameter limits of the backends.
+    :return: list of the records found, in no particular order
+    """
+    mapper = sqlalchemy.inspect(class_to_query)
+    assert len(mapper.primary_key) == 1
+    primary = mapper.primary_key[0]
+    p_keys = list(p_keys)
+    records = list()
+    try:
+        for start in range(0, len(p_keys), chunk_size):
+            records.extend(session.query(class_to_query)
+                           .filter(primary.in_(p_keys[start:start + chunk_size]))
+                           .all())
+        logger.debug(_("Found {no} objects of type {cls} out of {total} keys")
+                     .format(no=len(records), cls=class_to_query, total=len(p_keys)))
+        return records
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Failed to get objects of type {cls} from their primary keys")
+                         .format(cls=class_to_query))
+        return list()
+
+
 def merge_multiple(session, records):
     try:
         for record in records:
@@ -130,18 +205,19 @@ def get_assigned_actions(session, job_contract):
         logger.exception(_("Unable to query DB for actions linked to contract {id}")
                          .format(id=job_contract.code))
         return False
-    finally:
-        session.close()
 
 
 def get_highest_serial(session, mapped_class, base_code):
+    """
+    Highest serial used for a class and base, including the records moved out to period archives.
+    """
     try:
         max_num = session.query(sqlalchemy.func.max(mapped_class.serial).label('max')) \
             .filter(mapped_class.base == base_code) \
             .one()
         logger.debug(_("Highest serial for class {mapped} in local is {no}")
                      .format(mapped=mapped_class, no=max_num.max))
-        return max_num.max if max_num.max else 0
+        return max(max_num.max or 0, AlchemyArchive.get_archived_serial(session, mapped_class, base_code))
     except sqlalchemy.orm.exc.NoResultFound:
         logger.info(_("No entries for this class, serial defaulted to 0"))
         return 0
@@ -163,21 +239,12 @@ def user_count(session, base_code):
 
 def subtree(session, root_base_pkey):
     """
-    Queries local database for the organisational tree, then walks it to extract a list of sub-bases
+    Extracts the list of sub-bases of a base, itself included, from the org tree index.
     :param root_base_pkey: root of the extracted subtree
     """
-    org_table = read_table(session, Acd.WorkBase)
-    extracted_subtree = list()
-    extracted_subtree.append(root_base_pkey)
-    tree_row = [root_base_pkey]
-    next_row = list()
-    while tree_row:
-        for base in tree_row:
-            for record in org_table:
-                if record.parent == base:
-                    if record.parent != record.code:
-                        next_row.append(record.code)
-                        extracted_subtree.append(record.code)
-        tree_row = next_row
-        next_row = list()
-    return extracted_subtree
+    try:
+        return AlchemyTree.subtree(session, root_base_pkey) or [root_base_pkey]
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Querying the DB for the subtree of {base} failed")
+                         .format(base=root_base_pkey))
+        return [root_base_pkey]
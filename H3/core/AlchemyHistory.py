@@ -0,0 +1,412 @@
+__author__ = 'Man'
+
+import datetime
+import logging
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+
+from . import AlchemyClassDefs as Acd
+
+logger = logging.getLogger(__name__)
+
+# A history row keeps the values a record had at its version, until the moment in "changed"
+# when it was superseded. The state at a timestamp is therefore the first version superseded after it,
+# or the current record if none was.
+# Classes with a __history_snapshot_every__ only store the columns each version changed ("changes" lists them)
+# and a full row every N versions : a version is rebuilt from the next full row, or the current record,
+# by walking the diffs back down to it.
+
+
+def history_class(mapped_class):
+    return mapped_class.__history_mapper__.class_
+
+
+def versioned_classes():
+    return [mapped_class for mapped_class in Acd.Base._decl_class_registry.values()
+            if hasattr(mapped_class, '__history_mapper__')]
+
+
+def column_keys(mapped_class):
+    """
+    :return: the keys of the columns kept in history, all but the version
+    """
+    return [column.key for column in sqlalchemy.inspect(mapped_class).column_attrs if column.key != 'version']
+
+
+def primary_keys(mapped_class):
+    return [column.key for column in sqlalchemy.inspect(mapped_class).primary_key]
+
+
+def stored_values(mapped_class, history_row):
+    """
+    :return: dict of the values the row holds : every column of a full row, the key and changed columns of a diff
+    """
+    if history_row.changes is None:
+        kept = column_keys(mapped_class)
+    else:
+        kept = primary_keys(mapped_class) + [key for key in history_row.changes.split(',') if key]
+    return dict((key, getattr(history_row, key)) for key in kept)
+
+
+def rebuild_versions(mapped_class, history_rows, current=None):
+    """
+    Walks the history of one record back from its newest state, applying each diff to the version above it.
+    :param history_rows: history rows of the record, from the oldest version wanted up to a full row
+    or to the current record
+    :param current: the current record, needed if no full row closes the chain
+    :return: dict of {version: {column: value}}; versions that can't be rebuilt are left out
+    """
+    versions = dict()
+    state = None
+    above = None
+    if current is not None:
+        state = dict((key, getattr(current, key)) for key in column_keys(mapped_class))
+        above = current.version
+    for row in sorted(history_rows, key=lambda history_row: history_row.version, reverse=True):
+        values = stored_values(mapped_class, row)
+        if row.changes is None:
+            state = values
+        elif state is None or above != row.version + 1:
+            state = None  # a gap in the chain : nothing below can be trusted
+        else:
+            state = dict(state, **values)
+        above = row.version
+        if state is not None:
+            versions[row.version] = dict(state, version=row.version)
+    return versions
+
+
+def fetch_chains(session, mapped_class, first_versions):
+    """
+    Reads what rebuild_versions needs for several records in two queries.
+    With snapshots every N versions, the full row closing a chain is less than N versions up.
+    :param first_versions: dict of {code: oldest version wanted}
+    :return: dict of {code: (history rows ascending, current record or None)}
+    """
+    history = history_class(mapped_class)
+    snapshot_every = mapped_class.__history_snapshot_every__
+    chains = dict((code, (list(), None)) for code in first_versions)
+    codes = list(first_versions)
+    for start in range(0, len(codes), 200):
+        chunk = codes[start:start + 200]
+        ranges = list()
+        for code in chunk:
+            in_range = sqlalchemy.and_(history.code == code, history.version >= first_versions[code])
+            if snapshot_every:
+                in_range = sqlalchemy.and_(in_range, history.version < first_versions[code] + snapshot_every)
+            ranges.append(in_range)
+        for row in session.query(history).filter(sqlalchemy.or_(*ranges)).order_by(history.code, history.version):
+            chains[row.code][0].append(row)
+        for record in session.query(mapped_class).filter(mapped_class.code.in_(chunk)):
+            chains[record.code] = (chains[record.code][0], record)
+    return chains
+
+
+def version_values(session, mapped_class, code, version):
+    """
+    :return: dict of the values of one version of a record, or None if it can't be rebuilt
+    """
+    history = history_class(mapped_class)
+    next_full = session.query(sqlalchemy.func.min(history.version)) \
+        .filter(history.code == code,
+                history.version >= version,
+                history.changes.is_(None)) \
+        .scalar()
+    query = session.query(history).filter(history.code == code, history.version >= version)
+    current = None
+    if next_full is None:
+        current = session.query(mapped_class).filter(mapped_class.code == code).first()
+    else:
+        query = query.filter(history.version <= next_full)
+    return rebuild_versions(mapped_class, query.all(), current).get(version)
+
+
+def complete_rows(session, mapped_class, history_rows):
+    """
+    Fills the diff rows in a list of history rows with the values they didn't change.
+    :return: list of transient history rows holding full versions, in the same order
+    """
+    wanted = dict()
+    for row in history_rows:
+        if row.changes is not None:
+            wanted[row.code] = min(row.version, wanted.get(row.code, row.version))
+    if not wanted:
+        return history_rows
+    versions = dict()
+    for code, (rows, current) in fetch_chains(session, mapped_class, wanted).items():
+        versions[code] = rebuild_versions(mapped_class, rows, current)
+    history = history_class(mapped_class)
+    completed = list()
+    for row in history_rows:
+        if row.changes is None:
+            completed.append(row)
+            continue
+        values = versions[row.code].get(row.version)
+        if values is None:
+            values = version_values(session, mapped_class, row.code, row.version) \
+                or dict(stored_values(mapped_class, row), version=row.version)
+        completed.append(history(changed=row.changed, changes=row.changes, **values))
+    return completed
+
+
+def to_record(mapped_class, history_row):
+    """
+    Rebuilds a record from a full history row. The result is transient, meant for reading only.
+    """
+    values = dict((key, getattr(history_row, key)) for key in column_keys(mapped_class) + ['version'])
+    return mapped_class(**values)
+
+
+def rebuild_record(session, mapped_class, history_row):
+    """
+    Rebuilds a record from its history row, full or diff. The result is transient, meant for reading only.
+    """
+    if history_row.changes is None:
+        return to_record(mapped_class, history_row)
+    values = version_values(session, mapped_class, history_row.code, history_row.version)
+    return mapped_class(**values) if values is not None else None
+
+
+def copy_record(record):
+    values = dict((column.key, getattr(record, column.key))
+                  for column in sqlalchemy.inspect(record).mapper.column_attrs)
+    return type(record)(**values)
+
+
+def created_after(session, mapped_class, timestamp, codes=None):
+    """
+    Records created after the timestamp, according to the journal (complete on the main DB only).
+    :return: set of codes
+    """
+    query = session.query(Acd.SyncJournal.key) \
+        .filter(Acd.SyncJournal.table == mapped_class.__tablename__,
+                Acd.SyncJournal.type == "CREATE",
+                Acd.SyncJournal.processed_timestamp > timestamp)
+    if codes is not None:
+        query = query.filter(Acd.SyncJournal.key.in_(codes))
+    return set(key for key, in query)
+
+
+def record_as_of(session, mapped_class, code, timestamp):
+    """
+    A record as it was at a point in time.
+    :param timestamp: naive UTC datetime
+    :return: a transient record, or None if it didn't exist yet
+    """
+    history = history_class(mapped_class)
+    try:
+        if created_after(session, mapped_class, timestamp, [code]):
+            return None
+        row = session.query(history) \
+            .filter(history.code == code,
+                    history.changed > timestamp) \
+            .order_by(history.version) \
+            .first()
+        if row:
+            return rebuild_record(session, mapped_class, row)
+        current = session.query(mapped_class).filter(mapped_class.code == code).first()
+        return copy_record(current) if current else None
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to read {code} as of {time}")
+                         .format(code=code, time=timestamp))
+        return None
+
+
+def records_as_of(session, mapped_class, timestamp, codes=None):
+    """
+    Bulk version of record_as_of : a whole table, or a set of records, in two queries.
+    :return: dict of {code: transient record}
+    """
+    history = history_class(mapped_class)
+    first_versions = session.query(history.code, sqlalchemy.func.min(history.version).label('version')) \
+        .filter(history.changed > timestamp)
+    current = session.query(mapped_class)
+    if codes is not None:
+        codes = list(codes)
+        first_versions = first_versions.filter(history.code.in_(codes))
+        current = current.filter(mapped_class.code.in_(codes))
+    first_versions = first_versions.group_by(history.code).subquery()
+
+    records = dict()
+    rows = session.query(history).join(first_versions,
+                                       sqlalchemy.and_(history.code == first_versions.c.code,
+                                                       history.version == first_versions.c.version)).all()
+    for row in complete_rows(session, mapped_class, rows):
+        records[row.code] = to_record(mapped_class, row)
+    for record in current:
+        if record.code not in records:
+            records[record.code] = copy_record(record)
+    for code in created_after(session, mapped_class, timestamp, codes):
+        records.pop(code, None)
+    return records
+
+
+def subtree_as_of(session, root_base_pkey, timestamp):
+    """
+    The org tree below a base as it was at a point in time, with the parent links of that time.
+    :return: list of transient WorkBase records, root first then level by level
+    """
+    try:
+        bases = records_as_of(session, Acd.WorkBase, timestamp)
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to rebuild the org tree as of {time}")
+                         .format(time=timestamp))
+        return list()
+    if root_base_pkey not in bases:
+        return list()
+    children = dict()
+    for base in bases.values():
+        if base.parent != base.code:
+            children.setdefault(base.parent, list()).append(base)
+    extracted_subtree = [bases[root_base_pkey]]
+    for base in extracted_subtree:
+        extracted_subtree.extend(children.get(base.code, list()))
+    return extracted_subtree
+
+
+def list_changes(session, mapped_class, code, before_version=None, page_size=50):
+    """
+    One page of the versions of a record, newest first. Pages are keyed on the version so each one
+    is a short range of the (code, version) primary key, however long the history.
+    :param before_version: the last version of the previous page, None for the first page
+    :return: list of history rows (with their version and "changed" timestamp)
+    """
+    history = history_class(mapped_class)
+    query = session.query(history).filter(history.code == code)
+    if before_version is not None:
+        query = query.filter(history.version < before_version)
+    try:
+        return complete_rows(session, mapped_class, query.order_by(history.version.desc()).limit(page_size).all())
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to list the changes of {code}")
+                         .format(code=code))
+        return list()
+
+
+def list_changes_between(session, mapped_class, start, end, after=None, page_size=100):
+    """
+    One page of all the changes made to a table in a time window, oldest first, ie for audits.
+    Served by the index on "changed".
+    :param after: (changed, code) of the last row of the previous page, None for the first page
+    :return: list of history rows
+    """
+    history = history_class(mapped_class)
+    query = session.query(history).filter(history.changed >= start, history.changed < end)
+    if after is not None:
+        after_changed, after_code = after
+        query = query.filter(sqlalchemy.or_(history.changed > after_changed,
+                                            sqlalchemy.and_(history.changed == after_changed,
+                                                            history.code > after_code)))
+    try:
+        return complete_rows(session, mapped_class,
+                             query.order_by(history.changed, history.code).limit(page_size).all())
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to list the changes of table {table}")
+                         .format(table=mapped_class.__tablename__))
+        return list()
+
+
+def convert_to_diffs(session, mapped_class, batch_size=200):
+    """
+    Trims the full-copy history rows of a class stored as diffs down to the columns each version changed,
+    keeping one full row every N versions and the last row of deleted records.
+    Works through the records in batches; the caller commits.
+    :return: number of rows converted
+    """
+    snapshot_every = mapped_class.__history_snapshot_every__
+    if not snapshot_every:
+        return 0
+    history = history_class(mapped_class)
+    table = mapped_class.__history_mapper__.local_table
+    keys = primary_keys(mapped_class)
+    data_keys = [key for key in column_keys(mapped_class) if key not in keys]
+    codes = [code for code, in session.query(history.code)
+             .filter(history.changes.is_(None), history.version % snapshot_every != 0)
+             .distinct()]
+    update = table.update() \
+        .where(sqlalchemy.and_(table.c.code == sqlalchemy.bindparam('b_code'),
+                               table.c.version == sqlalchemy.bindparam('b_version'))) \
+        .values(dict((key, sqlalchemy.bindparam(key)) for key in data_keys + ['changes']))
+    converted = 0
+    for start in range(0, len(codes), batch_size):
+        chunk = codes[start:start + batch_size]
+        rows = dict((code, list()) for code in chunk)
+        for row in session.query(history).filter(history.code.in_(chunk)).order_by(history.code, history.version):
+            rows[row.code].append(row)
+        current = dict((record.code, record)
+                       for record in session.query(mapped_class).filter(mapped_class.code.in_(chunk)))
+        parameters = list()
+        for code in chunk:
+            versions = rebuild_versions(mapped_class, rows[code], current.get(code))
+            if code in current:
+                versions[current[code].version] = dict((key, getattr(current[code], key))
+                                                       for key in column_keys(mapped_class))
+            for row in rows[code]:
+                if row.changes is not None or row.version % snapshot_every == 0 \
+                        or row.version not in versions or row.version + 1 not in versions:
+                    continue
+                before, after = versions[row.version], versions[row.version + 1]
+                changes = [key for key in data_keys if before[key] != after[key]]
+                values = dict((key, before[key] if key in changes else None) for key in data_keys)
+                values.update(b_code=code, b_version=row.version, changes=','.join(changes))
+                parameters.append(values)
+        if parameters:
+            session.execute(update, parameters)
+            converted += len(parameters)
+        logger.debug(_("{no} history rows of {table} converted to diffs")
+                     .format(no=converted, table=table.name))
+    return converted
+
+
+def history_values(mapped_class, history_row):
+    table = mapped_class.__history_mapper__.local_table
+    return dict((column.key, getattr(history_row, column.key)) for column in table.c)
+
+
+def versions_between(session, mapped_class, code, first_version, last_version):
+    """
+    :return: the history rows of a record from first_version up to last_version excluded, ascending
+    """
+    history = history_class(mapped_class)
+    return session.query(history) \
+        .filter(history.code == code,
+                history.version >= first_version,
+                history.version < last_version) \
+        .order_by(history.version) \
+        .all()
+
+
+def copy_versions(session, mapped_class, history_rows):
+    """
+    Writes history rows read from another DB as they are, in one statement.
+    """
+    if history_rows:
+        session.execute(mapped_class.__history_mapper__.local_table.insert(),
+                        [history_values(mapped_class, row) for row in history_rows])
+
+
+def snapshot_current(session, mapped_class, code, new_version):
+    """
+    Writes the stored state of a record as a full history row of its version, if that row is missing,
+    before the record is overwritten by a later version without being versioned (ie by a downloaded update).
+    The local diffs below it can then still be rebuilt.
+    """
+    history = history_class(mapped_class)
+    current = session.query(mapped_class).filter(mapped_class.code == code).first()
+    if current is None or current.version is None or new_version is None or current.version >= new_version \
+            or session.query(history.version) \
+            .filter(history.code == code, history.version == current.version).first():
+        return
+    values = dict((key, getattr(current, key)) for key in column_keys(mapped_class))
+    values.update(version=current.version, changed=datetime.datetime.utcnow(), changes=None)
+    session.execute(mapped_class.__history_mapper__.local_table.insert(), values)
+
+
+def rename_history(session, mapped_class, old_code, new_code):
+    """
+    Follows a record whose code was rewritten, ie by a rebase.
+    """
+    table = mapped_class.__history_mapper__.local_table
+    session.execute(table.update().where(table.c.code == old_code).values(code=new_code))
@@ -0,0 +1,113 @@
+__author__ = 'Man'
+
+import datetime
+import logging
+
+from . import AlchemyClassDefs as Acd
+
+logger = logging.getLogger(__name__)
+
+# Rows validated and written per transaction : one serial reservation, one read of the sync queue
+IMPORT_CHUNK = 500
+
+# Data sheet of the bases export : code, identifier, parent, full name, opening date, closing date, country, time zone
+BASE_COLUMNS = 8
+
+EXCEL_EPOCH = datetime.date(1899, 12, 30)  # day 0 of Excel's 1900 date system
+
+
+def as_date(value):
+    """
+    Excel dates come back as datetimes, or as day numbers from cells that lost their date format;
+    dates typed as text are read as ISO dates.
+    :raise ValueError: for anything else
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return EXCEL_EPOCH + datetime.timedelta(days=int(value))
+    return datetime.datetime.strptime(str(value).strip(), "%Y-%m-%d").date()
+
+
+def as_text(value):
+    """
+    Text cells may come back as numbers, ie an identifier typed as 1234 reads as 1234.0; they are kept as text.
+    :raise ValueError: for dates and anything else that isn't a cell of text or a number
+    """
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, (datetime.date, datetime.time, datetime.timedelta)):
+        raise ValueError(value)
+    text = str(value).strip()
+    return text or None
+
+
+def base_from_row(row):
+    """
+    A new base out of a row of the Data sheet; the code of the row, if any, is ignored.
+    :raise ValueError: for dates that can't be read and text cells holding a date
+    """
+    row = list(row[:BASE_COLUMNS]) + [None] * (BASE_COLUMNS - len(row))
+    # noinspection PyArgumentList
+    return Acd.WorkBase(base='BASE-1',
+                        period='PERMANENT',
+                        identifier=as_text(row[1]),
+                        parent=as_text(row[2]),
+                        full_name=as_text(row[3]),
+                        opened_date=as_date(row[4]),
+                        closed_date=as_date(row[5]),
+                        country=as_text(row[6]),
+                        time_zone=as_text(row[7]))
+
+
+def check_bases(session, rows):
+    """
+    Reads and validates a chunk of rows with two queries, whatever its size : identifiers already in use
+    and parents that exist. Rows are also checked against the rows before them in the chunk.
+    :return: list of (WorkBase or None, error message or None), one per row
+    """
+    checked = list()
+    for row in rows:
+        if any(value is not None for value in row[BASE_COLUMNS:]):
+            # ie the Data sheet of another export of the bases table
+            checked.append((None, _("More than {no} columns, not a row of the bases export")
+                                  .format(no=BASE_COLUMNS)))
+            continue
+        try:
+            checked.append((base_from_row(row), None))
+        except ValueError:
+            checked.append((None, _("Dates must be dates or YYYY-MM-DD, other cells text")))
+
+    bases = [base for base, error in checked if base is not None]
+    identifiers = [base.identifier for base in bases if base.identifier]
+    parents = [base.parent for base in bases if base.parent]
+    taken = set(identifier for identifier, in session.query(Acd.WorkBase.identifier)
+                .filter(Acd.WorkBase.identifier.in_(identifiers))) if identifiers else set()
+    known = set(code for code, in session.query(Acd.WorkBase.code)
+                .filter(Acd.WorkBase.code.in_(parents))) if parents else set()
+
+    results = list()
+    for base, error in checked:
+        if base is not None:
+            if not base.identifier:
+                error = _("Identifier missing")
+            elif base.identifier in taken:
+                error = _("Identifier {identifier} already used").format(identifier=base.identifier)
+            elif not base.parent:
+                error = _("Parent missing")
+            elif base.parent not in known:
+                error = _("Unknown parent {parent}").format(parent=base.parent)
+            elif base.opened_date and base.closed_date and base.closed_date < base.opened_date:
+                error = _("Closing date before opening date")
+            elif base.country and not (len(base.country) == 2 and base.country.isalpha()):
+                error = _("Country code {country} is not 2 letters").format(country=base.country)
+            if base.identifier:
+                taken.add(base.identifier)
+        results.append((base if error is None else None, error))
+    return results
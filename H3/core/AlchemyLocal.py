@@ -11,6 +11,10 @@ import sqlalchemy.engine.url
 from sqlalchemy.event import listen
 
 from . import AlchemyClassDefs as Acd
+from . import AlchemySearch
+from . import AlchemyAuthorization
+from . import AlchemyTree
+from . import AlchemyStock
 
 logger = logging.getLogger(__name__)
 
@@ -35,18 +39,45 @@ class H3AlchemyLocalDB:
 
     def create_all_tables(self):
         """
-        Formats the database with the public tables.
+        Formats the database with the public tables, and the local-only search index.
+        Safe to run on an existing DB : only adds the tables, columns and indexes it lacks.
         :return:
         """
         try:
             meta = Acd.Base.metadata
             meta.create_all(bind=self.engine)
+            Acd.create_missing_columns(self.engine)
+            Acd.create_missing_indexes(self.engine)
+            session = sqlalchemy.orm.sessionmaker(bind=self.engine)()
+            AlchemyAuthorization.backfill_limits(session)
+            AlchemyTree.index_tree(session)
+            AlchemyStock.repair_codes(session)
+            session.commit()
+            session.close()
             logger.info(_('all tables created'))
+            AlchemySearch.create_search_index(self.engine)
             return True
         except sqlalchemy.exc.SQLAlchemyError:
             logger.error(_('failed to create all tables'))
             return False
 
+    def compact(self):
+        """
+        Gives the space of deleted rows back to the disk, ie once periods are archived. VACUUM may renumber
+        the rowids the search indexes point to : they are rebuilt after it.
+        :return: True on success
+        """
+        try:
+            conn = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+            conn.execute(sqlalchemy.text("VACUUM"))
+            conn.close()
+            AlchemySearch.rebuild_search_index(self.engine)
+            logger.info(_("Local DB compacted"))
+            return True
+        except sqlalchemy.exc.SQLAlchemyError:
+            logger.exception(_("Failed to compact the local DB"))
+            return False
+
 
 def get_local_users(session):
     """
@@ -0,0 +1,94 @@
+__author__ = 'Man'
+
+import json
+import logging
+import threading
+
+import sqlalchemy.exc
+
+from . import AlchemyClassDefs as Acd
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCALE = 'en_UK'
+
+# The catalog of the local DB, dropped whenever an action is written locally or arrives through sync
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+class H3Catalog:
+    """
+    The translations of every action, parsed once from their JSON into {action code: {locale: {field: text}}}.
+    Lookups fall back from the locale to another variant of its language, then to DEFAULT_LOCALE,
+    then to any translation, then to the action identifier.
+    """
+
+    def __init__(self, actions):
+        """
+        :param actions: iterable of (code, identifier, language JSON)
+        """
+        self.texts = dict()
+        self.identifiers = dict()
+        for code, identifier, language in actions:
+            self.identifiers[code] = identifier
+            try:
+                self.texts[code] = json.loads(language) if language else dict()
+            except ValueError:
+                logger.error(_("Unreadable translations for action {code}")
+                             .format(code=code))
+                self.texts[code] = dict()
+        self._resolved = dict()
+
+    def translations(self, action_code, locale):
+        """
+        :return: the {field: text} dict the locale falls back to for this action
+        """
+        key = (action_code, locale)
+        if key not in self._resolved:
+            texts = self.texts.get(action_code, dict())
+            language = locale.split('_')[0]
+            resolved = texts.get(locale) \
+                or next((texts[other] for other in sorted(texts) if other.split('_')[0] == language), None) \
+                or texts.get(DEFAULT_LOCALE) \
+                or next((texts[other] for other in sorted(texts)), dict())
+            self._resolved[key] = resolved
+        return self._resolved[key]
+
+    def lookup(self, action_code, locale, field):
+        return self.translations(action_code, locale).get(field) or self.identifiers.get(action_code, action_code)
+
+    def description(self, action_code, locale):
+        return self.lookup(action_code, locale, 'desc')
+
+    def category(self, action_code, locale):
+        return self.lookup(action_code, locale, 'cat')
+
+
+def cached():
+    return _catalog
+
+
+def get_catalog(session):
+    """
+    The catalog of all the actions in the DB, built with one query on first use.
+    :return: H3Catalog, or None if the actions can't be read
+    """
+    global _catalog
+    catalog = _catalog
+    if catalog is not None:
+        return catalog
+    try:
+        catalog = H3Catalog(session.query(Acd.Action.code, Acd.Action.identifier, Acd.Action.language))
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to read the translations of the actions"))
+        return None
+    with _catalog_lock:
+        _catalog = catalog
+    return catalog
+
+
+def invalidate():
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
@@ -0,0 +1,203 @@
+__author__ = 'Man'
+
+import logging
+import multiprocessing.connection
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Core calls a relay will run on behalf of its clients. sync_up is coalesced, see H3RelayServer.sync_up
+RELAYED_CALLS = {'read_table', 'get_from_primary_key', 'get_user_count', 'get_base_stats', 'get_queue', 'search',
+                 'create_base', 'update_base', 'reserve_serials', 'import_bases_chunk', 'sync_up',
+                 'record_movement', 'get_stock_on_hand', 'get_stock_levels',
+                 'create_budget_line', 'write_commitment', 'get_budget',
+                 'write_routing_rule', 'get_route', 'send_for_approval', 'find_approvers'}
+
+
+class RelayUnavailable(Exception):
+    """
+    Raised by the client when the relay can't be reached; callers fall back to direct file access.
+    """
+
+
+class RelayError(Exception):
+    """
+    Raised by the client once a call was sent and didn't come back as a result : the relay reported an error,
+    or the connection dropped with the call in flight. The relay may have run it, so it's never run again here.
+    """
+
+
+def check_authkey(authkey):
+    """
+    Connections unpickle what they receive : only peers holding the site's own secret may talk to each other.
+    :raise ValueError: when no key is given
+    """
+    if not authkey:
+        raise ValueError(_("A relay key must be set in config.txt ([DB Locations] relay key)"))
+    return authkey
+
+
+def parse_address(address):
+    """
+    "host:port" as stored in the config file -> (host, port)
+    """
+    host, _sep, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class H3RelayServer:
+    """
+    Owns the site's SQLite DB on behalf of the desktops of a base.
+    Clients send core calls over the LAN; the relay runs them one at a time against its own core,
+    so writers never lock each other out, and it alone syncs with the master.
+    """
+
+    def __init__(self, core, address, authkey, sync_interval=None):
+        """
+        :param core: a H3AlchemyCore set up on the local DB (and logged into remote for syncs)
+        :param address: (host, port) to listen on; ('localhost', 0) picks a free port
+        :param authkey: shared secret of the site's clients
+        :param sync_interval: optional period in seconds of a background sync of the queue
+        :return:
+        """
+        self.core = core
+        self.listener = multiprocessing.connection.Listener(address, authkey=check_authkey(authkey))
+        self.address = self.listener.address
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.sync_generation = 0
+        self.running = False
+
+    def start(self):
+        """
+        Serves in a background thread, ie for a localhost stand-in.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.running = False
+        self.listener.close()
+
+    def serve_forever(self):
+        self.running = True
+        logger.info(_("Relay listening on {address}")
+                    .format(address=self.address))
+        if self.sync_interval:
+            threading.Thread(target=self.sync_periodically, daemon=True).start()
+        while self.running:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                if self.running:
+                    logger.exception(_("Relay failed to accept a client"))
+                continue
+            threading.Thread(target=self.serve_client, args=(connection,), daemon=True).start()
+
+    def serve_client(self, connection):
+        try:
+            while True:
+                contract, name, args, kwargs = connection.recv()
+                connection.send(self.dispatch(contract, name, args, kwargs))
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+
+    def dispatch(self, contract, name, args, kwargs):
+        """
+        Runs one core call for a client.
+        :param contract: the client's current job contract, origin of the sync entries written for it
+        :return: ("OK", result) or ("ERR", message)
+        """
+        if name not in RELAYED_CALLS:
+            return "ERR", _("{name} can't be called through the relay").format(name=name)
+        try:
+            if name == 'sync_up':
+                return "OK", self.sync_up()
+            with self.lock:
+                self.core.current_job_contract = contract
+                return "OK", getattr(self.core, name)(*args, **kwargs)
+        except Exception as error:
+            logger.exception(_("Relayed call {name} failed")
+                             .format(name=name))
+            return "ERR", repr(error)
+
+    def sync_up(self):
+        """
+        One consolidated sync for all the site's clients : a request that waited while another sync
+        ran is already covered by it, since every write it could depend on was queued before that sync started.
+        """
+        generation = self.sync_generation
+        with self.lock:
+            if self.sync_generation == generation:
+                self.core.sync_up()
+                self.sync_generation += 1
+            else:
+                logger.debug(_("Sync request covered by a sync that just ran"))
+        return True
+
+    def sync_periodically(self):
+        while self.running:
+            time.sleep(self.sync_interval)
+            if self.core.get_queue():
+                self.sync_up()
+
+
+class H3RelayClient:
+    """
+    The desktop side : forwards core calls to the relay of the site.
+    When the relay can't be reached, raises RelayUnavailable and waits retry_delay seconds before trying again.
+    Once a call is sent, failures raise RelayError.
+    """
+
+    def __init__(self, address, authkey, retry_delay=30):
+        self.address = address
+        self.authkey = check_authkey(authkey)
+        self.retry_delay = retry_delay
+        self.connection = None
+        self.down_since = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection:
+            return self.connection
+        if self.down_since and time.time() - self.down_since < self.retry_delay:
+            raise RelayUnavailable()
+        try:
+            self.connection = multiprocessing.connection.Client(self.address, authkey=self.authkey)
+            self.down_since = None
+            return self.connection
+        except (OSError, EOFError, multiprocessing.AuthenticationError):
+            logger.info(_("Relay at {address} unreachable, using the local DB file directly")
+                        .format(address=self.address))
+            self.down_since = time.time()
+            raise RelayUnavailable()
+
+    def call(self, contract, name, *args, **kwargs):
+        """
+        :return: the result of the core call as run by the relay
+        """
+        with self.lock:
+            connection = self.connect()
+            try:
+                connection.send((contract, name, args, kwargs))
+                status, result = connection.recv()
+            except (OSError, EOFError) as error:
+                self.close()
+                logger.error(_("Connection to the relay lost during {name}")
+                             .format(name=name))
+                raise RelayError(_("Connection to the relay lost during {name} : {error}")
+                                 .format(name=name, error=repr(error)))
+        if status == "ERR":
+            logger.error(_("Relay could not run {name} : {error}")
+                         .format(name=name, error=result))
+            raise RelayError(result)
+        return result
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
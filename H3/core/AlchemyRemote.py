@@ -12,6 +12,11 @@ import sqlalchemy.engine
 import sqlalchemy.engine.url
 
 from . import AlchemyClassDefs as Acd
+from . import AlchemyHistory
+from . import AlchemyBudget
+from . import AlchemyAuthorization
+from . import AlchemyTree
+from . import AlchemyStock
 
 logger = logging.getLogger(__name__)
 
@@ -166,6 +171,8 @@ class H3AlchemyRemoteDB:
 
             # App-level
             session.add(base)
+            session.flush()
+            AlchemyTree.place_base(session, base.code, base.parent)
             logger.debug(_("Base {name} added to the table")
                          .format(name=base.full_name))
 
@@ -220,6 +227,58 @@ class H3AlchemyRemoteDB:
         meta.create_all(bind=self.engine)
         logger.debug(_("All tables created in remote"))
 
+    def admin_login(self, password):
+        """
+        Connects to the H3 database itself with the master PG password, for maintenance.
+        """
+        self.engine = sqlalchemy.create_engine(sqlalchemy.engine.url.URL(drivername='postgresql+pg8000',
+                                                                         username='postgres',
+                                                                         password=password,
+                                                                         host=self.location,
+                                                                         port=5432,
+                                                                         database='h3a'))
+
+    def upgrade_db(self, password):
+        """
+        Brings an existing main DB to the current structure : new tables, new columns and indexes on existing tables,
+        history converted to its current storage, and the users group's rights on the new tables.
+        Needs the master PG password.
+        :return: True on success
+        """
+        try:
+            self.admin_login(password)
+            Acd.Base.metadata.create_all(bind=self.engine)
+            for change in Acd.create_missing_columns(self.engine):
+                logger.info(_("Column {change}")
+                            .format(change=change))
+            for index in Acd.create_missing_indexes(self.engine):
+                logger.info(_("Index {name} created")
+                            .format(name=index))
+            session = sqlalchemy.orm.sessionmaker(bind=self.engine)()
+            AlchemyBudget.rebuild_rollups(session)
+            AlchemyAuthorization.backfill_limits(session)
+            AlchemyTree.index_tree(session)
+            AlchemyStock.repair_codes(session)
+            session.commit()
+            for mapped_class in AlchemyHistory.versioned_classes():
+                converted = AlchemyHistory.convert_to_diffs(session, mapped_class)
+                session.commit()
+                if converted:
+                    logger.info(_("{no} history rows of {table} converted to diffs")
+                                .format(no=converted, table=mapped_class.__tablename__))
+            session.close()
+            conn = self.engine.connect()
+            conn.execution_options(isolation_level="AUTOCOMMIT")
+            conn.execute(sqlalchemy.text('GRANT SELECT, INSERT, UPDATE ON ALL TABLES IN SCHEMA PUBLIC '
+                                         'TO GROUP h3_users WITH GRANT OPTION;'))
+            conn.execute(sqlalchemy.text('GRANT DELETE ON TABLE bases_closure TO GROUP h3_users;'))
+            conn.close()
+            logger.info(_("Main DB upgraded"))
+            return True
+        except sqlalchemy.exc.SQLAlchemyError:
+            logger.exception(_("Failed to upgrade the main DB"))
+            return False
+
     # noinspection PyArgumentList
     def populate(self, session):
         """
@@ -370,6 +429,7 @@ class H3AlchemyRemoteDB:
             conn.close()
 
             self.create_base(session, root_base)
+            session.add(Acd.BaseClosure(ancestor='BASE-1', descendant='BASE-1', depth=0))
             self.create_user(session, reader_user)
             self.create_user(session, root_user)
 
@@ -380,6 +440,7 @@ class H3AlchemyRemoteDB:
             query7 = sqlalchemy.text('GRANT INSERT, UPDATE ON TABLE users, bases TO GROUP h3_fps WITH GRANT OPTION;')
             query8 = sqlalchemy.text('GRANT SELECT ON TABLE users, bases, jobs, job_contracts '
                                      'TO "f66ce97dfce5d8604edab9a721f3b85b";')
+            query9 = sqlalchemy.text('GRANT DELETE ON TABLE bases_closure TO GROUP h3_users;')
 
             conn = self.engine.connect()
             conn.execution_options(isolation_level="AUTOCOMMIT")
@@ -393,6 +454,8 @@ class H3AlchemyRemoteDB:
             logger.debug(_("FP group can now change users and bases tables"))
             conn.execute(query8)
             logger.debug(_("Reader role can now see users, bases and job contracts only"))
+            conn.execute(query9)
+            logger.debug(_("Users group can now move bases in the org tree index"))
             conn.close()
 
             logger.info(_("Basic rights granted to H3 default roles"))
@@ -466,7 +529,7 @@ def get_updates(session, first_serial, bases_list, job_contract_list):
 
         # Currently getting all local bases ie The ones grabbed with job
         # TODO : configurable "live" bases vs. sub-bases without updates
-        # TODO: add in procurement and stocks  records, filtering on Acd.base
+        # TODO: add in procurement records, filtering on Acd.base
         base_updates = session.query(Acd.SyncJournal, Acd.WorkBase) \
             .filter(Acd.WorkBase.base.in_(bases_list),
                     Acd.SyncJournal.table == 'bases',
@@ -500,6 +563,43 @@ def get_updates(session, first_serial, bases_list, job_contract_list):
             .filter(Acd.AssignedAction.assigned_to.in_(job_contract_list)) \
             .all()
 
+        stock_updates = session.query(Acd.SyncJournal, Acd.StockMovement) \
+            .filter(Acd.SyncJournal.table == 'stock_movements', Acd.SyncJournal.serial > first_serial) \
+            .join(Acd.StockMovement, Acd.StockMovement.code == Acd.SyncJournal.key) \
+            .filter(Acd.StockMovement.base.in_(bases_list)) \
+            .all()
+
+        budget_line_updates = session.query(Acd.SyncJournal, Acd.BudgetLine) \
+            .filter(Acd.SyncJournal.table == 'budget_lines', Acd.SyncJournal.serial > first_serial) \
+            .join(Acd.BudgetLine, Acd.BudgetLine.code == Acd.SyncJournal.key) \
+            .filter(Acd.BudgetLine.base.in_(bases_list)) \
+            .all()
+
+        commitment_updates = session.query(Acd.SyncJournal, Acd.Commitment) \
+            .filter(Acd.SyncJournal.table == 'commitments', Acd.SyncJournal.serial > first_serial) \
+            .join(Acd.Commitment, Acd.Commitment.code == Acd.SyncJournal.key) \
+            .filter(Acd.Commitment.base.in_(bases_list)) \
+            .all()
+
+        # Routing rules are few, and any of them may apply to a base through its ancestors
+        routing_rule_updates = session.query(Acd.SyncJournal, Acd.RoutingRules) \
+            .filter(Acd.SyncJournal.table == 'routing_rules', Acd.SyncJournal.serial > first_serial) \
+            .join(Acd.RoutingRules, Acd.RoutingRules.code == Acd.SyncJournal.key) \
+            .all()
+
+        message_updates = session.query(Acd.SyncJournal, Acd.Message) \
+            .filter(Acd.SyncJournal.table == 'messages', Acd.SyncJournal.serial > first_serial) \
+            .join(Acd.Message, Acd.Message.code == Acd.SyncJournal.key) \
+            .filter(sqlalchemy.or_(Acd.Message.target_jc.in_(job_contract_list),
+                                   Acd.Message.origin_jc.in_(job_contract_list))) \
+            .all()
+
+        # The item catalog is global, and movements of any base may point to any item
+        item_updates = session.query(Acd.SyncJournal, Acd.Item) \
+            .filter(Acd.SyncJournal.table == 'items', Acd.SyncJournal.serial > first_serial) \
+            .join(Acd.Item, Acd.Item.code == Acd.SyncJournal.key) \
+            .all()
+
         # Here the query gets more complicated as fishing the targeted actions from the job contract
         # is 2 levels of indirection. This catches new actions that have been freshly assigned
         # without ending up with all actions (including admin ones) in the local DB.
@@ -521,7 +621,13 @@ def get_updates(session, first_serial, bases_list, job_contract_list):
                 + job_updates \
                 + user_updates \
                 + action_updates \
-                + assigned_action_updates:
+                + assigned_action_updates \
+                + item_updates \
+                + stock_updates \
+                + budget_line_updates \
+                + commitment_updates \
+                + routing_rule_updates \
+                + message_updates:
             pack.update({entry.serial: [entry, record]})
 
         sorted_pack = sorted(pack)
@@ -0,0 +1,240 @@
+__author__ = 'Man'
+
+import datetime
+import logging
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+
+from . import AlchemyClassDefs as Acd
+from . import AlchemyHistory
+
+logger = logging.getLogger(__name__)
+
+# History younger than the policy's full_days is kept whole. Past that, only the last version in force
+# in each year (or month) stays in the live history table, as a full row; the others move to the archive,
+# either a "<table>_history_archive" table of the same DB or the same table in a separate SQLite file.
+TIERS = ('year', 'month', 'none')
+
+OPTIONS_SECTION = 'History Retention'  # config.txt, ie "bases = 730, year"
+LOCAL_OPTIONS_SECTION = 'Local History Retention'  # same, for the history kept by a local DB
+
+
+class H3RetentionPolicy:
+    def __init__(self, full_days, snapshots='year'):
+        if snapshots not in TIERS:
+            raise ValueError(snapshots)
+        self.full_days = int(full_days)
+        self.snapshots = snapshots
+
+    @classmethod
+    def parse(cls, text):
+        """
+        :param text: "days, tier", ie "730, year"
+        """
+        days, _sep, snapshots = text.partition(',')
+        return cls(days.strip(), snapshots.strip() or 'year')
+
+    def cutoff(self, now=None):
+        return (now or datetime.datetime.utcnow()) - datetime.timedelta(days=self.full_days)
+
+    def tier(self, changed):
+        """
+        :return: the period whose last version is kept, None if no version is kept
+        """
+        if self.snapshots == 'year':
+            return changed.year
+        if self.snapshots == 'month':
+            return changed.year, changed.month
+        return None
+
+    def __str__(self):
+        return "{days} days, then {tier}".format(days=self.full_days, tier=self.snapshots)
+
+
+def get_policy(mapped_class, options=None, local=False):
+    """
+    The retention of a versioned class : config.txt if it sets one, else the class default.
+    :param options: the ConfigParser of the core, if any
+    :param local: the policy of a local DB rather than of the main DB
+    :return: H3RetentionPolicy, or None to keep everything
+    """
+    section = LOCAL_OPTIONS_SECTION if local else OPTIONS_SECTION
+    if options is not None and options.has_option(section, mapped_class.__tablename__):
+        text = options.get(section, mapped_class.__tablename__)
+        try:
+            return H3RetentionPolicy.parse(text)
+        except ValueError:
+            logger.error(_("Unreadable history retention {text} for {table}, using the default")
+                         .format(text=text, table=mapped_class.__tablename__))
+    default = mapped_class.__local_history_retention__ if local else mapped_class.__history_retention__
+    return H3RetentionPolicy(*default) if default else None
+
+
+def archive_table(history_table, metadata):
+    """
+    Archive tables mirror the history table without its foreign keys, and only hold full rows.
+    """
+    return sqlalchemy.Table(history_table.name + '_archive', metadata,
+                            *[sqlalchemy.Column(column.name, column.type, primary_key=column.primary_key)
+                              for column in history_table.c])
+
+
+def split_versions(policy, rows, cutoff):
+    """
+    :param rows: history rows of one record, ascending
+    :return: (old rows kept as the snapshots of their period, old rows to move)
+    """
+    old = [row for row in rows if row.changed is not None and row.changed < cutoff]
+    last_of_tier = dict()
+    for row in old:
+        tier = policy.tier(row.changed)
+        if tier is not None:
+            last_of_tier[tier] = row
+    kept = set(row.version for row in last_of_tier.values())
+    return [row for row in old if row.version in kept], [row for row in old if row.version not in kept]
+
+
+def row_size(mapped_class, history_row):
+    """
+    Rough size of a row's data, for the report.
+    """
+    return sum(len(str(value)) for value in AlchemyHistory.stored_values(mapped_class, history_row).values()
+               if value is not None)
+
+
+def move_history(session, mapped_class, policy, archive_engine=None, now=None, batch_size=200,
+                 discard=False, protected=()):
+    """
+    Applies a retention policy to the history of a class, a batch of records per transaction
+    so the live tables are never locked for long. Kept diff rows are rewritten whole first,
+    as the versions they were rebuilt from leave.
+    :param archive_engine: engine of the archive file, None to archive in the same DB
+    :param discard: drop the old versions instead of archiving them (ie on a local DB)
+    :param protected: codes of the records whose history must stay whole
+    :return: dict of {'moved', 'compacted', 'bytes'}, or False on failure
+    """
+    report = {'moved': 0, 'compacted': 0, 'bytes': 0}
+    if policy is None:
+        return report
+    history = AlchemyHistory.history_class(mapped_class)
+    table = mapped_class.__history_mapper__.local_table
+    data_keys = [key for key in AlchemyHistory.column_keys(mapped_class)
+                 if key not in AlchemyHistory.primary_keys(mapped_class)]
+    cutoff = policy.cutoff(now)
+
+    archive_meta = sqlalchemy.MetaData()
+    archive = archive_table(table, archive_meta)
+    key_filter = sqlalchemy.and_(table.c.code == sqlalchemy.bindparam('b_code'),
+                                 table.c.version == sqlalchemy.bindparam('b_version'))
+    archive_key_filter = sqlalchemy.and_(archive.c.code == sqlalchemy.bindparam('b_code'),
+                                         archive.c.version == sqlalchemy.bindparam('b_version'))
+    compact = table.update().where(key_filter) \
+        .values(dict((key, sqlalchemy.bindparam(key)) for key in data_keys + ['changes']))
+    delete = table.delete().where(key_filter)
+
+    try:
+        if not discard:
+            archive_meta.create_all(bind=archive_engine or session.get_bind())
+        codes = [code for code, in session.query(history.code).filter(history.changed < cutoff).distinct()
+                 if code not in protected]
+        session.commit()
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to prepare the archive of {table}")
+                         .format(table=table.name))
+        session.rollback()
+        return False
+
+    for start in range(0, len(codes), batch_size):
+        chunk = codes[start:start + batch_size]
+        try:
+            rows = dict((code, list()) for code in chunk)
+            for row in session.query(history).filter(history.code.in_(chunk)).order_by(history.code,
+                                                                                       history.version):
+                rows[row.code].append(row)
+            current = dict((record.code, record)
+                           for record in session.query(mapped_class).filter(mapped_class.code.in_(chunk)))
+
+            archived, compacted, deleted = list(), list(), list()
+            for code in chunk:
+                kept, moved = split_versions(policy, rows[code], cutoff)
+                if not moved:
+                    continue
+                versions = AlchemyHistory.rebuild_versions(mapped_class, rows[code], current.get(code))
+                if any(row.version not in versions for row in kept + ([] if discard else moved)):
+                    logger.error(_("History of {code} can't be rebuilt, left in place")
+                                 .format(code=code))
+                    continue
+                for row in moved:
+                    if not discard:
+                        archived.append(dict(versions[row.version], changed=row.changed, changes=None))
+                    deleted.append({'b_code': code, 'b_version': row.version})
+                    report['bytes'] += row_size(mapped_class, row)
+                for row in kept:
+                    if row.changes is not None:
+                        values = dict((key, versions[row.version][key]) for key in data_keys)
+                        compacted.append(dict(values, changes=None, b_code=code, b_version=row.version))
+            if not deleted:
+                continue
+
+            # archiving twice the same version (ie a batch retried after a failure) replaces the first copy
+            if discard:
+                pass
+            elif archive_engine is None:
+                session.execute(archive.delete().where(archive_key_filter), deleted)
+                session.execute(archive.insert(), archived)
+            else:
+                with archive_engine.begin() as connection:
+                    connection.execute(archive.delete().where(archive_key_filter), deleted)
+                    connection.execute(archive.insert(), archived)
+            if compacted:
+                session.execute(compact, compacted)
+            session.execute(delete, deleted)
+            session.commit()
+            report['moved'] += len(deleted)
+            report['compacted'] += len(compacted)
+        except sqlalchemy.exc.SQLAlchemyError:
+            logger.exception(_("Failed to archive the history of {table}, stopped after {no} rows")
+                             .format(table=table.name, no=report['moved']))
+            session.rollback()
+            return False
+        logger.debug(_("{no} history rows of {table} archived")
+                     .format(no=report['moved'], table=table.name))
+    return report
+
+
+def apply_retention(session, options=None, archive_engine=None, now=None):
+    """
+    Runs move_history on every versioned class with a policy.
+    :return: dict of {history table name: report}
+    """
+    reports = dict()
+    for mapped_class in AlchemyHistory.versioned_classes():
+        policy = get_policy(mapped_class, options)
+        if policy is None:
+            continue
+        logger.info(_("History retention of {table} : {policy}")
+                    .format(table=mapped_class.__tablename__, policy=policy))
+        reports[mapped_class.__history_mapper__.local_table.name] = \
+            move_history(session, mapped_class, policy, archive_engine, now)
+    return reports
+
+
+def apply_local_retention(session, options=None, now=None):
+    """
+    Bounds the history of a local DB : old versions are dropped, the main DB having them,
+    except those of records still waiting for upload.
+    :return: dict of {history table name: report}
+    """
+    reports = dict()
+    for mapped_class in AlchemyHistory.versioned_classes():
+        policy = get_policy(mapped_class, options, local=True)
+        if policy is None:
+            continue
+        queued = set(key for key, in session.query(Acd.SyncJournal.key)
+                     .filter(Acd.SyncJournal.serial < 0,
+                             Acd.SyncJournal.table == mapped_class.__tablename__))
+        reports[mapped_class.__history_mapper__.local_table.name] = \
+            move_history(session, mapped_class, policy, now=now, discard=True, protected=queued)
+    return reports
@@ -0,0 +1,151 @@
+__author__ = 'Man'
+
+import datetime
+import logging
+import threading
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from . import AlchemyClassDefs as Acd
+from . import AlchemyTree
+
+logger = logging.getLogger(__name__)
+
+ROOT_SCOPE = 'ROOT'
+
+# {(action code, base code, contract code): H3Route}, emptied whenever rules, bases or contracts change.
+# Routes name the contracts holding jobs on the day they were resolved, so they're also dropped the next day.
+_cache = dict()
+_cache_lock = threading.Lock()
+
+
+class H3RouteStep:
+    """
+    One step of a route : who gets the message, to do what, and the rule it comes from.
+    """
+    __slots__ = ('step', 'requested_action', 'recipient', 'rule')
+
+    def __init__(self, step, requested_action, recipient, rule):
+        self.step = step
+        self.requested_action = requested_action
+        self.recipient = recipient  # job contract code, None if nobody holds the job
+        self.rule = rule
+
+    def __repr__(self):
+        return "{step}: {what} -> {who}".format(step=self.step, what=self.requested_action, who=self.recipient)
+
+
+class H3Route:
+    """
+    The effective route of an action for a contract at a base, resolved once : steps in order,
+    recipients named.
+    """
+
+    def __init__(self, action_code, base_code, contract_code, steps, resolved_date):
+        self.action_code = action_code
+        self.base_code = base_code
+        self.contract_code = contract_code
+        self.steps = steps
+        self.resolved_date = resolved_date
+
+    def first_step(self):
+        return self.steps[0].step if self.steps else None
+
+    def step(self, number):
+        """
+        :return: the H3RouteSteps of a step number (several rules may define the same step at the same scope)
+        """
+        return [route_step for route_step in self.steps if route_step.step == number]
+
+    def unresolved(self):
+        return [route_step for route_step in self.steps if route_step.recipient is None]
+
+
+def resolve_route(session, action_code, base_code, contract_code=None, on_date=None):
+    """
+    Walks the base hierarchy once : the chain of ancestors, every rule of the action scoped to the root,
+    one of those bases or the contract, then the contracts holding the targeted jobs along the chain.
+    Each step keeps the rule of the most specific scope : contract, then the nearest base, then the root.
+    A job is looked for at the base of the request first, then up the tree; the requester never routes to itself.
+    :return: H3Route
+    """
+    on_date = on_date or datetime.date.today()
+    chain = AlchemyTree.ancestors(session, base_code)
+    precedence = dict((scope, depth) for depth, scope in enumerate([contract_code] + chain + [ROOT_SCOPE])
+                      if scope is not None)
+
+    chosen = dict()  # {step: (precedence, [rules])}
+    for rule in session.query(Acd.RoutingRules) \
+            .filter(Acd.RoutingRules.action == action_code,
+                    Acd.RoutingRules.scope.in_(list(precedence))):
+        rank = precedence[rule.scope]
+        if rule.step not in chosen or rank < chosen[rule.step][0]:
+            chosen[rule.step] = (rank, [rule])
+        elif rank == chosen[rule.step][0]:
+            chosen[rule.step][1].append(rule)
+
+    jobs = set(rule.target_job for _rank, rules in chosen.values() for rule in rules
+               if rule.target_jc is None and rule.target_job is not None)
+    holders = dict()  # {job: (distance up the tree, contract code)}
+    if jobs:
+        distance = dict((code, depth) for depth, code in enumerate(chain))
+        for code, job, work_base in session.query(Acd.JobContract.code, Acd.JobContract.job_code,
+                                                  Acd.JobContract.work_base) \
+                .filter(Acd.JobContract.job_code.in_(list(jobs)),
+                        Acd.JobContract.work_base.in_(chain),
+                        Acd.JobContract.start_date <= on_date,
+                        Acd.JobContract.end_date >= on_date,
+                        Acd.JobContract.code != contract_code) \
+                .order_by(Acd.JobContract.code):
+            if job not in holders or distance[work_base] < holders[job][0]:
+                holders[job] = (distance[work_base], code)
+
+    steps = list()
+    for step in sorted(chosen):
+        for rule in sorted(chosen[step][1], key=lambda rule: rule.code):
+            if rule.target_jc is not None:
+                recipient = rule.target_jc
+            elif rule.target_job is not None:
+                recipient = holders.get(rule.target_job, (None, None))[1]
+                if recipient is None:
+                    logger.warning(_("Nobody holds job {job} above base {base} for step {step} of {action}")
+                                   .format(job=rule.target_job, base=base_code, step=step, action=action_code))
+            else:
+                continue  # the step is dropped at this scope
+            steps.append(H3RouteStep(step, rule.requested_action, recipient, rule.code))
+    return H3Route(action_code, base_code, contract_code, steps, on_date)
+
+
+def cached(action_code, base_code, contract_code=None):
+    route = _cache.get((action_code, base_code, contract_code))
+    if route is not None and route.resolved_date == datetime.date.today():
+        return route
+    return None
+
+
+def get_route(session, action_code, base_code, contract_code=None):
+    """
+    The effective route of an action, from the cache when possible.
+    :return: H3Route, or None if the rules can't be read
+    """
+    route = cached(action_code, base_code, contract_code)
+    if route is not None:
+        return route
+    try:
+        route = resolve_route(session, action_code, base_code, contract_code)
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to resolve the route of action {action} for base {base}")
+                         .format(action=action_code, base=base_code))
+        return None
+    with _cache_lock:
+        _cache[(action_code, base_code, contract_code)] = route
+    return route
+
+
+def invalidate():
+    """
+    Drops every resolved route : a rule, a move in the tree or a contract may change any of them.
+    """
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,155 @@
+__author__ = 'Man'
+
+import logging
+import re
+
+import sqlalchemy
+import sqlalchemy.exc
+
+logger = logging.getLogger(__name__)
+
+# Searchable tables : {table: (FTS5 index, indexed columns, label template)}
+SEARCH_SOURCES = {'bases': ('bases_search',
+                            ('identifier', 'full_name'),
+                            "{identifier} - {full_name}"),
+                  'users': ('users_search',
+                            ('first_name', 'last_name', 'login'),
+                            "{first_name} {last_name} ({login})"),
+                  'job_contracts': ('job_contracts_search',
+                                    ('job_title',),
+                                    "{job_title}")}
+
+
+def create_search_index(engine):
+    """
+    Creates the FTS5 indexes over the local tables, and the triggers keeping them in sync on every
+    insert, update and delete - whether from the GUI, an import or a downloaded update.
+    Indexes are external-content tables keyed on the source rowid, so the text isn't stored twice.
+    Existing rows are indexed when an index is first created.
+    :return: True if the indexes are available, False if this SQLite has no FTS5 (search falls back to LIKE)
+    """
+    try:
+        with engine.begin() as connection:
+            existing = set(name for name, in connection.execute("SELECT name FROM sqlite_master"))
+            for table, (index, columns, _label) in SEARCH_SOURCES.items():
+                if index in existing:
+                    continue
+                column_list = ", ".join(columns)
+                new_values = ", ".join("new." + column for column in columns)
+                old_values = ", ".join("old." + column for column in columns)
+                connection.execute("CREATE VIRTUAL TABLE {index} USING fts5({columns}, content='{table}', "
+                                   "content_rowid='rowid', prefix='2 3', tokenize='unicode61')"
+                                   .format(index=index, columns=column_list, table=table))
+                connection.execute("CREATE TRIGGER {index}_insert AFTER INSERT ON {table} BEGIN "
+                                   "INSERT INTO {index}(rowid, {columns}) VALUES (new.rowid, {new}); END"
+                                   .format(index=index, table=table, columns=column_list, new=new_values))
+                connection.execute("CREATE TRIGGER {index}_delete AFTER DELETE ON {table} BEGIN "
+                                   "INSERT INTO {index}({index}, rowid, {columns}) "
+                                   "VALUES ('delete', old.rowid, {old}); END"
+                                   .format(index=index, table=table, columns=column_list, old=old_values))
+                connection.execute("CREATE TRIGGER {index}_update AFTER UPDATE ON {table} BEGIN "
+                                   "INSERT INTO {index}({index}, rowid, {columns}) "
+                                   "VALUES ('delete', old.rowid, {old}); "
+                                   "INSERT INTO {index}(rowid, {columns}) VALUES (new.rowid, {new}); END"
+                                   .format(index=index, table=table, columns=column_list,
+                                           old=old_values, new=new_values))
+                connection.execute("INSERT INTO {index}({index}) VALUES ('rebuild')"
+                                   .format(index=index))
+                logger.info(_("Search index {index} created")
+                            .format(index=index))
+        return True
+    except sqlalchemy.exc.OperationalError:
+        logger.warning(_("FTS5 unavailable in this SQLite build, search will be slower"))
+        return False
+
+
+def rebuild_search_index(engine):
+    """
+    Re-indexes every row; needed after a VACUUM, which may renumber the rowids the indexes point to.
+    :return: True if the indexes were rebuilt, False if this DB has none (no FTS5)
+    """
+    try:
+        with engine.begin() as connection:
+            for index, _columns, _label in SEARCH_SOURCES.values():
+                connection.execute("INSERT INTO {index}({index}) VALUES ('rebuild')"
+                                   .format(index=index))
+        return True
+    except sqlalchemy.exc.OperationalError:
+        logger.warning(_("No search index to rebuild"))
+        return False
+
+
+def words_of(text):
+    return re.findall(r'\w+', text, re.UNICODE)
+
+
+def match_expression(text):
+    """
+    User text -> FTS5 query : every word must match as a prefix. Quoting keeps FTS5 operators inert.
+    """
+    return " ".join('"{word}"*'.format(word=word) for word in words_of(text))
+
+
+def like_condition(columns, words):
+    """
+    The same search without FTS5 : every word must start one of the words of a column.
+    LIKE wildcards typed by the user are escaped.
+    :return: (SQL condition, its parameters)
+    """
+    conditions = list()
+    parameters = dict()
+    for position, word in enumerate(words):
+        escaped = word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        parameters['start{}'.format(position)] = escaped + '%'
+        parameters['inside{}'.format(position)] = '% ' + escaped + '%'
+        conditions.append("(" + " OR ".join("t.{column} LIKE :start{position} ESCAPE '\\' OR "
+                                            "t.{column} LIKE :inside{position} ESCAPE '\\'"
+                                            .format(column=column, position=position)
+                                            for column in columns) + ")")
+    return " AND ".join(conditions), parameters
+
+
+def search(session, text, tables=None, limit=20):
+    """
+    Prefix search over bases, users and job contracts, best matches first. bm25 scores of different indexes
+    don't compare, so each table is ranked on its own and the results taken in turn from each.
+    :param text: what the user typed, ie "nai ke" finds NAIROBI - Kenya country office
+    :param tables: restrict to some of SEARCH_SOURCES' tables
+    :param limit: maximum number of results
+    :return: list of (table, code, label) tuples
+    """
+    expression = match_expression(text)
+    if not expression:
+        return list()
+    tables = tables or sorted(SEARCH_SOURCES)
+    words = words_of(text)
+    ranked = list()
+    try:
+        existing = set(name for name, in session.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        for table in tables:
+            index, columns, label = SEARCH_SOURCES[table]
+            column_list = ", ".join("t." + column for column in columns)
+            if index in existing:
+                rows = session.execute(sqlalchemy.text("SELECT t.code, bm25({index}) AS rank, {columns} "
+                                                       "FROM {index} JOIN {table} AS t ON t.rowid = {index}.rowid "
+                                                       "WHERE {index} MATCH :expression "
+                                                       "ORDER BY rank LIMIT :limit"
+                                                       .format(index=index, table=table, columns=column_list)),
+                                       {'expression': expression, 'limit': limit})
+            else:
+                condition, parameters = like_condition(columns, words)
+                parameters['limit'] = limit
+                rows = session.execute(sqlalchemy.text("SELECT t.code, 0 AS rank, {columns} FROM {table} AS t "
+                                                       "WHERE {condition} ORDER BY {columns} LIMIT :limit"
+                                                       .format(table=table, columns=column_list,
+                                                               condition=condition)),
+                                       parameters)
+            for position, row in enumerate(rows):
+                values = dict(zip(columns, row[2:]))
+                ranked.append((position, table, row[0], label.format(**values)))
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Search for {text} failed")
+                         .format(text=text))
+        return list()
+    ranked.sort(key=lambda result: (result[0], tables.index(result[1])))
+    return [(table, code, label) for _rank, table, code, label in ranked[:limit]]
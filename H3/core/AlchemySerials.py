@@ -0,0 +1,105 @@
+__author__ = 'Man'
+
+import logging
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from . import AlchemyClassDefs as Acd
+from . import AlchemyGeneric
+
+logger = logging.getLogger(__name__)
+
+counters = Acd.SerialCounter.__table__
+
+
+def counted_classes():
+    """
+    Classes whose codes are built from a per-base serial (see code_builder).
+    """
+    return [mapped_class for mapped_class in Acd.Base._decl_class_registry.values()
+            if hasattr(mapped_class, 'prefix') and hasattr(mapped_class, 'base') and hasattr(mapped_class, 'serial')]
+
+
+def counter_filter(mapped_class, base_code):
+    return sqlalchemy.and_(counters.c.table == mapped_class.__tablename__,
+                           counters.c.base == base_code)
+
+
+def reserve_serials(session, mapped_class, base_code, count=1):
+    """
+    Hands out a range of serials for new records of a class and base with one UPDATE,
+    whatever the size of the range. The counter row stays locked until the caller's transaction ends,
+    so concurrent writers never get overlapping ranges.
+    A counter missing from the table starts from the highest serial in use (archives included).
+    :param count: size of the range, ie the number of rows of an import
+    :return: the first serial of the range, or None on failure
+    """
+    try:
+        updated = session.execute(counters.update()
+                                  .where(counter_filter(mapped_class, base_code))
+                                  .values(last_serial=counters.c.last_serial + count))
+        if updated.rowcount:
+            last_serial = session.execute(sqlalchemy.select([counters.c.last_serial])
+                                          .where(counter_filter(mapped_class, base_code))) \
+                .scalar()
+        else:
+            last_serial = AlchemyGeneric.get_highest_serial(session, mapped_class, base_code) + count
+            session.execute(counters.insert(), {'table': mapped_class.__tablename__,
+                                                'base': base_code,
+                                                'last_serial': last_serial})
+        logger.debug(_("Reserved {no} serials of class {cls} for base {base}, up to {last}")
+                     .format(no=count, cls=mapped_class, base=base_code, last=last_serial))
+        return last_serial - count + 1
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to reserve serials of class {cls} for base {base}")
+                         .format(cls=mapped_class, base=base_code))
+        return None
+
+
+def bump_serial(session, mapped_class, base_code, serial):
+    """
+    Raises a counter to a serial written outside of a reservation : downloaded, uploaded or rebased records.
+    A counter that doesn't exist yet is left alone, it will start from the table when first used.
+    """
+    session.execute(counters.update()
+                    .where(sqlalchemy.and_(counter_filter(mapped_class, base_code),
+                                           counters.c.last_serial < serial))
+                    .values(last_serial=serial))
+
+
+def backfill_serial_counters(session):
+    """
+    Brings every counter up to the highest serial of its table and base, ie after a pack or snapshot
+    was merged in bulk. Works with a session or a plain connection.
+    :return: number of counters written
+    """
+    top_serials = dict()
+    for mapped_class in counted_classes():
+        table = mapped_class.__table__
+        for base_code, top_serial in session.execute(sqlalchemy.select([table.c.base,
+                                                                        sqlalchemy.func.max(table.c.serial)])
+                                                     .group_by(table.c.base)):
+            top_serials[(table.name, base_code)] = top_serial or 0
+    for table_name, base_code, top_serial in session.execute(sqlalchemy.select([Acd.ArchivedPeriod.table,
+                                                                                Acd.ArchivedPeriod.base,
+                                                                                Acd.ArchivedPeriod.top_serial])):
+        key = (table_name, base_code)
+        top_serials[key] = max(top_serials.get(key, 0), top_serial or 0)
+
+    existing = dict(((table_name, base_code), last_serial) for table_name, base_code, last_serial
+                    in session.execute(sqlalchemy.select([counters.c.table, counters.c.base,
+                                                          counters.c.last_serial])))
+    written = 0
+    for (table_name, base_code), top_serial in top_serials.items():
+        if (table_name, base_code) not in existing:
+            session.execute(counters.insert(), {'table': table_name, 'base': base_code, 'last_serial': top_serial})
+            written += 1
+        elif existing[(table_name, base_code)] < top_serial:
+            session.execute(counters.update()
+                            .where(sqlalchemy.and_(counters.c.table == table_name, counters.c.base == base_code))
+                            .values(last_serial=top_serial))
+            written += 1
+    logger.info(_("{no} serial counters brought up to date")
+                .format(no=written))
+    return written
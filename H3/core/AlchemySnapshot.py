@@ -0,0 +1,156 @@
+__author__ = 'Man'
+
+import logging
+import os
+import shutil
+import tempfile
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+
+from . import AlchemyClassDefs as Acd
+from . import AlchemyAuthorization, AlchemyGeneric, AlchemyLocal, AlchemySerials, AlchemyTree
+
+logger = logging.getLogger(__name__)
+
+
+def build_snapshot(remote_session, base_code, filename):
+    """
+    Builds, on the master, a ready-to-use local DB for a base and its sub-bases :
+     - the bases of the subtree
+     - the job contracts on those bases, with their users and jobs
+     - the assigned actions of those contracts and the actions they reference
+     - the latest sync entry, the high-water mark the new site will pull from
+    Everything is read in a single repeatable-read transaction so records and mark agree.
+    :param remote_session: session bound to the master DB
+    :param base_code: root of the subtree to package
+    :param filename: path of the SQLite file to produce; must not exist yet
+    :return: the high-water sync serial stored in the snapshot, or None on failure
+    """
+    if os.access(filename, os.F_OK):
+        logger.error(_("Snapshot file {file} already exists")
+                     .format(file=filename))
+        return None
+
+    remote_session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+
+    try:
+        high_water_serial = AlchemyGeneric.get_highest_synced_sync_serial(remote_session)
+        high_water_entry = AlchemyGeneric.get_from_primary_key(remote_session, Acd.SyncJournal, high_water_serial)
+
+        bases = AlchemyGeneric.get_from_primary_keys(remote_session, Acd.WorkBase,
+                                                     AlchemyGeneric.subtree(remote_session, base_code))
+        base_codes = [base.code for base in bases]
+
+        job_contracts = list()
+        for start in range(0, len(base_codes), 500):
+            job_contracts.extend(remote_session.query(Acd.JobContract)
+                                 .filter(Acd.JobContract.work_base.in_(base_codes[start:start + 500]))
+                                 .all())
+        contract_codes = [job_contract.code for job_contract in job_contracts]
+
+        users = AlchemyGeneric.get_from_primary_keys(remote_session, Acd.User,
+                                                     set(job_contract.user for job_contract in job_contracts))
+        jobs = AlchemyGeneric.get_from_primary_keys(remote_session, Acd.Job,
+                                                    set(job_contract.job_code for job_contract in job_contracts))
+
+        assigned_actions = list()
+        for start in range(0, len(contract_codes), 500):
+            assigned_actions.extend(remote_session.query(Acd.AssignedAction)
+                                    .filter(Acd.AssignedAction.assigned_to.in_(contract_codes[start:start + 500]))
+                                    .all())
+        actions = AlchemyGeneric.get_from_primary_keys(remote_session, Acd.Action,
+                                                       set(assigned_action.action
+                                                           for assigned_action in assigned_actions))
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Failed to read the data for the snapshot of base {base}")
+                         .format(base=base_code))
+        return None
+
+    tables = {Acd.WorkBase: bases,
+              Acd.User: users,
+              Acd.Job: jobs,
+              Acd.JobContract: job_contracts,
+              Acd.Action: actions,
+              Acd.AssignedAction: assigned_actions,
+              Acd.SyncJournal: [high_water_entry] if high_water_entry else []}
+
+    snapshot_db = AlchemyLocal.H3AlchemyLocalDB(filename)
+    if not snapshot_db.create_all_tables():
+        return None
+
+    connection = snapshot_db.engine.connect()
+    # The subtree root points to a parent the site won't hold, like any base pack would
+    connection.execute("PRAGMA foreign_keys=OFF")
+    transaction = connection.begin()
+    try:
+        for table in Acd.Base.metadata.sorted_tables:
+            mapped_class = Acd.get_class_by_table_name(table.name)
+            if tables.get(mapped_class):
+                connection.execute(table.insert(), [record_values(record) for record in tables[mapped_class]])
+        AlchemyTree.rebuild_closure(connection)
+        AlchemySerials.backfill_serial_counters(connection)
+        AlchemyAuthorization.backfill_limits(connection)
+        transaction.commit()
+        logger.info(_("Snapshot of base {base} written to {file} at sync serial {serial}")
+                    .format(base=base_code, file=filename, serial=high_water_serial))
+        return high_water_serial
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Failed to write the snapshot of base {base}")
+                         .format(base=base_code))
+        transaction.rollback()
+        return None
+    finally:
+        connection.close()
+        snapshot_db.engine.dispose()
+
+
+def install_snapshot(source, location):
+    """
+    Installs a snapshot as the local DB with a single copy. The file is copied next to its destination and checked
+    there first, then swapped in : an interrupted transfer or an invalid file never replaces the local DB.
+    :param source: path to the snapshot file, or a readable binary file object (ie a network transfer)
+    :param location: path of the local DB
+    :return: True if the snapshot was a valid H3 DB and was installed
+    """
+    directory = os.path.dirname(os.path.abspath(location))
+    handle, temp_location = tempfile.mkstemp(suffix='.part', dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as destination:
+            if hasattr(source, 'read'):
+                shutil.copyfileobj(source, destination)
+            else:
+                with open(source, 'rb') as source_file:
+                    shutil.copyfileobj(source_file, destination)
+
+        snapshot_db = AlchemyLocal.H3AlchemyLocalDB(temp_location)
+        session = sqlalchemy.orm.sessionmaker(bind=snapshot_db.engine)()
+        valid = AlchemyLocal.has_a_base(session)
+        session.close()
+        snapshot_db.engine.dispose()
+
+        if valid:
+            os.replace(temp_location, location)
+            logger.info(_("Snapshot installed at {location}")
+                        .format(location=location))
+        else:
+            logger.error(_("{source} doesn't hold a valid snapshot, {location} left as it was")
+                         .format(source=getattr(source, 'name', source), location=location))
+        return valid
+    except OSError:
+        logger.exception(_("Failed to copy the snapshot to {location}")
+                         .format(location=location))
+        return False
+    finally:
+        if os.access(temp_location, os.F_OK):
+            os.remove(temp_location)
+
+
+def record_values(record):
+    """
+    Column values of a record, keyed for a Core insert.
+    """
+    mapper = sqlalchemy.inspect(record).mapper
+    return {column.key: getattr(record, mapper.get_property_by_column(column).key)
+            for column in mapper.local_table.c}
@@ -0,0 +1,223 @@
+__author__ = 'Man'
+
+import datetime
+import logging
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from . import AlchemyClassDefs as Acd
+from . import AlchemyTree
+
+logger = logging.getLogger(__name__)
+
+stats = Acd.BaseStats.__table__
+
+COUNTERS = ('active_contracts', 'headcount', 'open_sub_bases', 'closed_sub_bases')
+
+
+def is_active(contract, today):
+    return contract.start_date is not None and contract.end_date is not None \
+        and contract.start_date <= today <= contract.end_date
+
+
+def is_open(base, today):
+    return base.closed_date is None or base.closed_date > today
+
+
+def compute_stats(session, base_codes, today=None):
+    """
+    Counts the figures of some bases from scratch : three grouped queries over the org tree index,
+    whatever the number of bases.
+    :return: dict of {base code: {counter: value}}
+    """
+    today = today or datetime.date.today()
+    base_codes = list(base_codes)
+    figures = dict((code, dict((counter, 0) for counter in COUNTERS)) for code in base_codes)
+    active = sqlalchemy.and_(Acd.JobContract.start_date <= today,
+                             Acd.JobContract.end_date >= today)
+    for start in range(0, len(base_codes), 500):
+        chunk = base_codes[start:start + 500]
+        for code, count in session.query(Acd.JobContract.work_base, sqlalchemy.func.count()) \
+                .filter(Acd.JobContract.work_base.in_(chunk), active) \
+                .group_by(Acd.JobContract.work_base):
+            figures[code]['active_contracts'] = count
+        for code, count in session.query(Acd.BaseClosure.ancestor, sqlalchemy.func.count()) \
+                .join(Acd.JobContract, Acd.JobContract.work_base == Acd.BaseClosure.descendant) \
+                .filter(Acd.BaseClosure.ancestor.in_(chunk), active) \
+                .group_by(Acd.BaseClosure.ancestor):
+            figures[code]['headcount'] = count
+        is_closed = sqlalchemy.and_(Acd.WorkBase.closed_date.isnot(None), Acd.WorkBase.closed_date <= today)
+        for code, closed, total in session.query(Acd.BaseClosure.ancestor,
+                                                 sqlalchemy.func.sum(sqlalchemy.case([(is_closed, 1)], else_=0)),
+                                                 sqlalchemy.func.count()) \
+                .join(Acd.WorkBase, Acd.WorkBase.code == Acd.BaseClosure.descendant) \
+                .filter(Acd.BaseClosure.ancestor.in_(chunk), Acd.BaseClosure.depth > 0) \
+                .group_by(Acd.BaseClosure.ancestor):
+            figures[code]['closed_sub_bases'] = closed or 0
+            figures[code]['open_sub_bases'] = total - (closed or 0)
+    return figures
+
+
+def refresh_base_stats(session, base_codes=None, stale_only=False):
+    """
+    Recomputes and stores the stats of some bases, or of all of them.
+    :param stale_only: only the rows missing or last computed before today
+    :return: number of rows written
+    """
+    today = datetime.date.today()
+    existing = dict()
+    if base_codes is None:
+        base_codes = [code for code, in session.query(Acd.WorkBase.code)]
+        existing.update(session.query(Acd.BaseStats.base, Acd.BaseStats.computed_date).all())
+    else:
+        base_codes = list(base_codes)
+        for start in range(0, len(base_codes), 500):
+            existing.update(session.query(Acd.BaseStats.base, Acd.BaseStats.computed_date)
+                            .filter(Acd.BaseStats.base.in_(base_codes[start:start + 500])).all())
+    base_codes = set(base_codes)
+    if stale_only:
+        base_codes = set(code for code in base_codes if existing.get(code) is None or existing[code] < today)
+    if not base_codes:
+        return 0
+    now = datetime.datetime.utcnow()
+    for code, values in compute_stats(session, base_codes, today).items():
+        values.update(computed_date=today, delivered=False)
+        if code in existing:
+            session.execute(stats.update().where(stats.c.base == code).values(**values))
+        else:
+            session.execute(stats.insert(), dict(values, base=code, last_change=now))
+    logger.debug(_("Stats of {no} bases recomputed")
+                 .format(no=len(base_codes)))
+    return len(base_codes)
+
+
+def get_base_stats(session, base_code):
+    """
+    The stats of one base : a single row read, recomputed first if it's missing or dates from a previous day.
+    Rows delivered by the main DB are kept as they are until the next sync.
+    :return: the BaseStats record, or None on failure
+    """
+    try:
+        row = session.query(Acd.BaseStats).filter(Acd.BaseStats.base == base_code).first()
+        if row is None or (not row.delivered and (row.computed_date is None
+                                                 or row.computed_date < datetime.date.today())):
+            refresh_base_stats(session, [base_code])
+            session.expire_all()
+            row = session.query(Acd.BaseStats).filter(Acd.BaseStats.base == base_code).first()
+        return row
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to read the stats of base {base}")
+                         .format(base=base_code))
+        return None
+
+
+def adjust(session, base_codes, **deltas):
+    """
+    Adds the deltas to the counters of some bases in one UPDATE. Missing rows are left alone,
+    they are computed from scratch when first read.
+    """
+    if not base_codes:
+        return
+    values = dict((counter, getattr(stats.c, counter) + delta) for counter, delta in deltas.items() if delta)
+    values['last_change'] = datetime.datetime.utcnow()
+    session.execute(stats.update().where(stats.c.base.in_(base_codes)).values(**values))
+
+
+def subtree_deltas(session, base, sign):
+    """
+    What a base and its whole subtree add to the bases above it.
+    """
+    today = datetime.date.today()
+    row = session.query(Acd.BaseStats).filter(Acd.BaseStats.base == base.code).first()
+    if row is None:
+        figures = compute_stats(session, [base.code], today)[base.code]
+    else:
+        figures = dict((counter, getattr(row, counter)) for counter in COUNTERS)
+    own_open = 1 if is_open(base, today) else 0
+    return {'headcount': sign * figures['headcount'],
+            'open_sub_bases': sign * (figures['open_sub_bases'] + own_open),
+            'closed_sub_bases': sign * (figures['closed_sub_bases'] + 1 - own_open)}
+
+
+def retract_record(session, record):
+    """
+    Takes the stored version of a record out of the stats, before it's updated, moved or deleted.
+    """
+    today = datetime.date.today()
+    if isinstance(record, Acd.JobContract):
+        stored = session.query(Acd.JobContract).filter(Acd.JobContract.code == record.code).first()
+        if stored and is_active(stored, today):
+            adjust(session, [stored.work_base], active_contracts=-1)
+            adjust(session, AlchemyTree.ancestors(session, stored.work_base), headcount=-1)
+    elif isinstance(record, Acd.WorkBase):
+        stored = session.query(Acd.WorkBase).filter(Acd.WorkBase.code == record.code).first()
+        if stored:
+            adjust(session, AlchemyTree.ancestors(session, stored.code)[1:], **subtree_deltas(session, stored, -1))
+
+
+def apply_record(session, record):
+    """
+    Adds a freshly written record to the stats; the org tree index must already be up to date.
+    """
+    today = datetime.date.today()
+    if isinstance(record, Acd.JobContract):
+        if is_active(record, today):
+            adjust(session, [record.work_base], active_contracts=1)
+            adjust(session, AlchemyTree.ancestors(session, record.work_base), headcount=1)
+    elif isinstance(record, Acd.WorkBase):
+        if session.query(Acd.BaseStats).filter(Acd.BaseStats.base == record.code).count():
+            adjust(session, [record.code])
+        else:
+            refresh_base_stats(session, [record.code])
+        adjust(session, AlchemyTree.ancestors(session, record.code)[1:], **subtree_deltas(session, record, 1))
+
+
+def apply_new_bases(session, bases, paths):
+    """
+    Adds a batch of brand new leaf bases to the stats, ie an import : their own rows start at zero,
+    and each base above them gets one UPDATE per distinct set of figures.
+    :param paths: the (ancestor, descendant, depth) rows of the bases in the org tree index
+    """
+    today = datetime.date.today()
+    now = datetime.datetime.utcnow()
+    session.execute(stats.insert(), [dict(((counter, 0) for counter in COUNTERS), base=base.code,
+                                          computed_date=today, delivered=False, last_change=now)
+                                     for base in bases])
+    opened = dict((base.code, is_open(base, today)) for base in bases)
+    added = dict()  # {ancestor: [open, closed]}
+    for ancestor, descendant, depth in paths:
+        if depth > 0:
+            counts = added.setdefault(ancestor, [0, 0])
+            counts[0 if opened[descendant] else 1] += 1
+    by_deltas = dict()
+    for ancestor, counts in added.items():
+        by_deltas.setdefault(tuple(counts), list()).append(ancestor)
+    for (open_count, closed_count), ancestors in by_deltas.items():
+        for start in range(0, len(ancestors), 500):
+            adjust(session, ancestors[start:start + 500], open_sub_bases=open_count, closed_sub_bases=closed_count)
+
+
+def download_base_stats(local_session, remote_session, base_codes):
+    """
+    Copies the main DB's stats of some bases, which count the contracts this DB doesn't hold.
+    Stale rows are recomputed on the main DB first.
+    :return: number of rows delivered, or False on failure
+    """
+    try:
+        refresh_base_stats(remote_session, base_codes, stale_only=True)
+        delivered = 0
+        base_codes = list(base_codes)
+        for start in range(0, len(base_codes), 500):
+            for row in remote_session.query(Acd.BaseStats) \
+                    .filter(Acd.BaseStats.base.in_(base_codes[start:start + 500])):
+                values = dict((column.name, getattr(row, column.name)) for column in stats.c)
+                values['delivered'] = True
+                if not local_session.execute(stats.update().where(stats.c.base == row.base).values(**values)) \
+                        .rowcount:
+                    local_session.execute(stats.insert(), values)
+                delivered += 1
+        return delivered
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception(_("Unable to download the stats of the local bases"))
+        return False
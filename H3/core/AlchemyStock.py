@@ -0,0 +1,211 @@
+__author__ = 'Man'
+
+import datetime
+import decimal
+import logging
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from . import AlchemyClassDefs as Acd
+
+logger = logging.getLogger(__name__)
+
+movements = Acd.StockMovement.__table__
+snapshots = Acd.StockSnapshot.__table__
+
+# Movements of an item written past its latest snapshot before a new one is taken : the most a balance sums
+SNAPSHOT_EVERY = 200
+
+ZERO = decimal.Decimal(0)
+
+
+def period_of(moved_date):
+    return str(moved_date.year)
+
+
+def period_end(period):
+    return datetime.date(int(period), 12, 31)
+
+
+def ledger_filter(base_code, item_code, after=None, on_date=None):
+    """
+    Movements of an item at a base, made after a day (excluded) and up to another (included).
+    """
+    clauses = [movements.c.base == base_code, movements.c.item == item_code]
+    if after is not None:
+        clauses.append(movements.c.moved_date > after)
+    if on_date is not None:
+        clauses.append(movements.c.moved_date <= on_date)
+    return sqlalchemy.and_(*clauses)
+
+
+def latest_snapshot(session, base_code, item_code, on_date=None):
+    """
+    :return: the (as_of, balance) row of the last snapshot taken on or before a day, or None
+    """
+    query = sqlalchemy.select([snapshots.c.as_of, snapshots.c.balance]) \
+        .where(sqlalchemy.and_(snapshots.c.base == base_code, snapshots.c.item == item_code))
+    if on_date is not None:
+        query = query.where(snapshots.c.as_of <= on_date)
+    return session.execute(query.order_by(snapshots.c.as_of.desc()).limit(1)).first()
+
+
+def stock_on_hand(session, base_code, item_code, on_date=None):
+    """
+    Balance of an item at a base at the end of a day : the last snapshot before it, plus the movements since.
+    Days of archived years only see the movements left in the hot DB.
+    Works with a session or a plain connection.
+    :param on_date: None for the current balance
+    :return: Decimal
+    """
+    snapshot = latest_snapshot(session, base_code, item_code, on_date)
+    tail = session.execute(sqlalchemy.select([sqlalchemy.func.sum(movements.c.quantity)])
+                           .where(ledger_filter(base_code, item_code, snapshot.as_of if snapshot else None,
+                                                on_date))) \
+        .scalar()
+    return (snapshot.balance if snapshot else ZERO) + (tail or ZERO)
+
+
+def stock_levels(session, base_code, on_date=None):
+    """
+    Balances of every item a base ever held, with two grouped queries whatever the size of the ledger.
+    :return: dict of {item code: Decimal}
+    """
+    latest = sqlalchemy.select([snapshots.c.item, sqlalchemy.func.max(snapshots.c.as_of).label('as_of')]) \
+        .where(snapshots.c.base == base_code)
+    if on_date is not None:
+        latest = latest.where(snapshots.c.as_of <= on_date)
+    latest = latest.group_by(snapshots.c.item).alias('latest')
+
+    levels = dict(session.execute(sqlalchemy.select([snapshots.c.item, snapshots.c.balance])
+                                  .select_from(snapshots.join(latest,
+                                                              sqlalchemy.and_(latest.c.item == snapshots.c.item,
+                                                                              latest.c.as_of == snapshots.c.as_of)))
+                                  .where(snapshots.c.base == base_code)).fetchall())
+    tail = sqlalchemy.select([movements.c.item, sqlalchemy.func.sum(movements.c.quantity)]) \
+        .select_from(movements.outerjoin(latest, latest.c.item == movements.c.item)) \
+        .where(sqlalchemy.and_(movements.c.base == base_code,
+                               sqlalchemy.or_(latest.c.as_of.is_(None), movements.c.moved_date > latest.c.as_of)))
+    if on_date is not None:
+        tail = tail.where(movements.c.moved_date <= on_date)
+    for item_code, quantity in session.execute(tail.group_by(movements.c.item)):
+        levels[item_code] = levels.get(item_code, ZERO) + (quantity or ZERO)
+    return levels
+
+
+def take_snapshot(session, base_code, item_code, as_of):
+    """
+    Stores the balance of an item at the end of a day, replacing any snapshot of that day.
+    Works with a session or a plain connection.
+    :return: the balance stored
+    """
+    balance = stock_on_hand(session, base_code, item_code, as_of)
+    values = {'balance': balance, 'taken': datetime.datetime.utcnow()}
+    if not session.execute(snapshots.update()
+                           .where(sqlalchemy.and_(snapshots.c.base == base_code,
+                                                  snapshots.c.item == item_code,
+                                                  snapshots.c.as_of == as_of))
+                           .values(**values)).rowcount:
+        session.execute(snapshots.insert(), dict(values, base=base_code, item=item_code, as_of=as_of))
+    return balance
+
+
+def snapshot_if_due(session, base_code, item_code):
+    """
+    Takes a new snapshot once SNAPSHOT_EVERY movements were written past the latest one,
+    as of the last day they cover.
+    """
+    snapshot = latest_snapshot(session, base_code, item_code)
+    count, last_date = session.execute(sqlalchemy.select([sqlalchemy.func.count(),
+                                                          sqlalchemy.func.max(movements.c.moved_date)])
+                                       .where(ledger_filter(base_code, item_code,
+                                                            snapshot.as_of if snapshot else None))) \
+        .first()
+    if count >= SNAPSHOT_EVERY:
+        take_snapshot(session, base_code, item_code, last_date)
+        logger.debug(_("Stock snapshot of {item} at {base} taken as of {date}")
+                     .format(item=item_code, base=base_code, date=last_date))
+
+
+def adjust_snapshots(session, base_code, item_code, moved_date, quantity):
+    """
+    Carries a movement into the snapshots taken since its day, in one UPDATE.
+    """
+    session.execute(snapshots.update()
+                    .where(sqlalchemy.and_(snapshots.c.base == base_code,
+                                           snapshots.c.item == item_code,
+                                           snapshots.c.as_of >= moved_date))
+                    .values(balance=snapshots.c.balance + quantity))
+
+
+def retract_record(session, record):
+    """
+    Takes the stored version of a movement out of the snapshots, before it's updated or deleted.
+    """
+    if isinstance(record, Acd.StockMovement):
+        stored = session.execute(sqlalchemy.select([movements.c.base, movements.c.item,
+                                                    movements.c.moved_date, movements.c.quantity])
+                                 .where(movements.c.code == record.code)).first()
+        if stored:
+            adjust_snapshots(session, stored.base, stored.item, stored.moved_date, -stored.quantity)
+
+
+def apply_record(session, record):
+    """
+    Carries a freshly written movement into the snapshots.
+    """
+    if isinstance(record, Acd.StockMovement):
+        adjust_snapshots(session, record.base, record.item, record.moved_date, decimal.Decimal(str(record.quantity)))
+        snapshot_if_due(session, record.base, record.item)
+
+
+def snapshot_period(session, period):
+    """
+    Takes a snapshot at the end of a year for every item moved at a base during it, so balances
+    don't need the movements of that year once it's archived.
+    Works with a session or a plain connection.
+    :return: number of snapshots taken
+    """
+    as_of = period_end(period)
+    pairs = session.execute(sqlalchemy.select([movements.c.base, movements.c.item])
+                            .where(movements.c.period == period)
+                            .distinct()).fetchall()
+    for base_code, item_code in pairs:
+        take_snapshot(session, base_code, item_code, as_of)
+    logger.debug(_("{no} stock snapshots taken at the end of {period}")
+                 .format(no=len(pairs), period=period))
+    return len(pairs)
+
+
+def repair_codes(session):
+    """
+    Renames the movements coded "-STOCK--<serial>" by the code_builder of the first stock ledger, which dropped
+    their base and year, to the code code_builder gives them now, along with the journal entries keyed on them.
+    The new code only depends on the record, so every DB holding a movement renames it alike.
+    Works with a session or a plain connection.
+    :return: number of movements renamed
+    """
+    journal = Acd.SyncJournal.__table__
+    renamed = 0
+    for code, base_code, period, serial in session.execute(
+            sqlalchemy.select([movements.c.code, movements.c.base, movements.c.period, movements.c.serial])
+            .where(movements.c.code.like('-' + Acd.StockMovement.prefix + '--%'))).fetchall():
+        # As AlchemyCore.code_builder
+        new_code = "{base}{prefix}-{period}{serial}".format(base=base_code + "-" if base_code != 'BASE-1' else '',
+                                                            prefix=Acd.StockMovement.prefix,
+                                                            period=period + "-" if period != 'PERMANENT' else '',
+                                                            serial=serial)
+        if session.execute(sqlalchemy.select([movements.c.code]).where(movements.c.code == new_code)).first():
+            logger.error(_("Stock movement {code} not renamed, {new_code} is taken")
+                         .format(code=code, new_code=new_code))
+            continue
+        session.execute(movements.update().where(movements.c.code == code).values(code=new_code))
+        session.execute(journal.update().where(sqlalchemy.and_(journal.c.table == movements.name,
+                                                               journal.c.key == code))
+                        .values(key=new_code))
+        renamed += 1
+    if renamed:
+        logger.info(_("{no} stock movement codes repaired")
+                    .format(no=renamed))
+    return renamed
@@ -1,13 +1,13 @@
 """Versioned mixin class and other utilities."""
 
+import contextlib
 import datetime
 
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import mapper, attributes, object_mapper
+from sqlalchemy.orm import mapper, attributes
 from sqlalchemy.orm.exc import UnmappedColumnError
-from sqlalchemy import Table, Column, ForeignKeyConstraint, Integer, DateTime
+from sqlalchemy import Table, Column, ForeignKeyConstraint, Index, Integer, String, DateTime
 from sqlalchemy import event, util
-from sqlalchemy.orm.properties import RelationshipProperty
 
 
 def col_references_table(col, table):
@@ -24,24 +24,23 @@ def _is_versioning_col(col):
 def _history_mapper(local_mapper):
     cls = local_mapper.class_
 
-    # set the "active_history" flag
-    # on on column-mapped attributes so that the old version
-    # of the info is always loaded (currently sets it on all attributes)
-    for prop in local_mapper.iterate_properties:
-        getattr(local_mapper.class_, prop.key).impl.active_history = True
-
     super_mapper = local_mapper.inherits
     super_history_mapper = getattr(cls, '__history_mapper__', None)
 
     polymorphic_on = None
     super_fks = []
 
+    # with column diffs, the values a version didn't change are left empty
+    snapshot_every = getattr(cls, '__history_snapshot_every__', None)
+
     def _col_copy(col):
         orig = col
         col = col.copy()
         orig.info['history_copy'] = col
         col.unique = False
         col.default = col.server_default = None
+        if snapshot_every and not col.primary_key:
+            col.nullable = True
         return col
 
     properties = util.OrderedDict()
@@ -100,9 +99,17 @@ def _history_mapper(local_mapper):
             default=datetime.datetime.utcnow,
             info=version_meta))
 
+        # "changes" lists the columns a diff row stores, comma separated;
+        # empty for rows holding the full record.
+        cols.append(Column('changes', String, info=version_meta))
+
         if super_fks:
             cols.append(ForeignKeyConstraint(*zip(*super_fks)))
 
+        # (code, version) lookups are served by the primary key;
+        # this one serves "as of" and "changed since" queries
+        cols.append(Index(local_mapper.local_table.name + '_history_changed_idx', 'changed'))
+
         table = Table(
             local_mapper.local_table.name + '_history',
             local_mapper.local_table.metadata,
@@ -148,42 +155,28 @@ def _history_mapper(local_mapper):
         local_mapper.add_property(
             "version", local_mapper.local_table.c.version)
 
+    # the column plan needs every mapper of the hierarchy, including
+    # single table subclasses, so it's compiled once they're all configured
+    event.listen(local_mapper, 'mapper_configured', _compile_version_plan)
 
-class Versioned(object):
-    @declared_attr
-    def __mapper_cls__(cls):
-        def map(cls, *arg, **kw):
-            mp = mapper(cls, *arg, **kw)
-            _history_mapper(mp)
-            return mp
-
-        return map
-
-
-def versioned_objects(iter):
-    for obj in iter:
-        if hasattr(obj, '__history_mapper__'):
-            yield obj
-
-
-def create_version(obj, session, deleted=False):
-    obj_mapper = object_mapper(obj)
-    history_mapper = obj.__history_mapper__
-    history_cls = history_mapper.class_
-
-    obj_state = attributes.instance_state(obj)
-
-    attr = {}
-
-    obj_changed = False
 
+def _compile_version_plan(local_mapper, cls):
+    """
+    Works out once per class which attribute feeds which history column,
+    so that flushes don't have to walk the mappers again.
+    cls.__version_plan__ is (list of (history table, [(history column key, attribute key, primary key?)]),
+    keys of the relationships whose change alters a foreign key).
+    """
+    history_mapper = cls.__history_mapper__
+    tables = []
     for om, hm in zip(
-            obj_mapper.iterate_to_root(),
+            local_mapper.iterate_to_root(),
             history_mapper.iterate_to_root()
     ):
         if hm.single:
             continue
 
+        columns = []
         for hist_col in hm.local_table.c:
             if _is_versioning_col(hist_col):
                 continue
@@ -195,7 +188,7 @@ def create_version(obj, session, deleted=False):
             # mapped column.  this will allow usage of MapperProperties
             # that have a different keyname than that of the mapped column.
             try:
-                prop = obj_mapper.get_property_by_column(obj_col)
+                prop = local_mapper.get_property_by_column(obj_col)
             except UnmappedColumnError:
                 # in the case of single table inheritance, there may be
                 # columns on the mapped table intended for the subclass only.
@@ -203,54 +196,175 @@ def create_version(obj, session, deleted=False):
                 # base class is a feature of the declarative module.
                 continue
 
-            # expired object attributes and also deferred cols might not
-            # be in the dict.  force it to load no matter what by
-            # using getattr().
-            if prop.key not in obj_state.dict:
-                getattr(obj, prop.key)
+            # only the attributes copied to history need their old value
+            # loaded when they're set
+            getattr(cls, prop.key).impl.active_history = True
+            columns.append((hist_col.key, prop.key, hist_col.primary_key))
+        # base tables first, their history rows are referenced by the subclasses'
+        tables.insert(0, (hm.local_table, columns))
 
-            a, u, d = attributes.get_history(obj, prop.key)
+    relationships = [prop.key for prop in local_mapper.relationships
+                     if any(col.foreign_keys for col in prop.local_columns)]
 
-            if d:
-                attr[hist_col.key] = d[0]
-                obj_changed = True
-            elif u:
-                attr[hist_col.key] = u[0]
+    cls.__version_plan__ = (tables, relationships)
+
+
+class Versioned(object):
+    # None keeps a full copy of the record in every history row;
+    # N only stores the columns each version changed, with a full copy every N versions
+    __history_snapshot_every__ = None
+    # None keeps every version forever; (days, 'year' / 'month' / 'none') keeps all of them
+    # for that many days, then only the last of each period (see AlchemyRetention)
+    __history_retention__ = None
+    # the same for the history a local DB keeps of its own edits until they're uploaded, and a while after
+    __local_history_retention__ = (365, 'none')
+
+    @declared_attr
+    def __mapper_cls__(cls):
+        def map(cls, *arg, **kw):
+            mp = mapper(cls, *arg, **kw)
+            _history_mapper(mp)
+            return mp
+
+        return map
+
+
+def versioned_objects(iter):
+    for obj in iter:
+        if hasattr(obj, '__history_mapper__'):
+            yield obj
+
+
+def create_version(obj, session, deleted=False):
+    """
+    Bumps the version of a changed or deleted object.
+    :return: list of (history table, row values) to insert, empty if the object didn't change
+    """
+    tables, relationships = obj.__version_plan__
+
+    obj_state = attributes.instance_state(obj)
+    obj_dict = obj_state.dict
+    committed = obj_state.committed_state
+
+    rows = []
+
+    obj_changed = False
+
+    for table, columns in tables:
+        attr = {}
+        changes = set()
+        for hist_key, prop_key, primary_key in columns:
+            if prop_key in committed:
+                a, u, d = attributes.get_history(obj, prop_key)
+
+                if d:
+                    attr[hist_key] = d[0]
+                    changes.add(hist_key)
+                elif u:
+                    attr[hist_key] = u[0]
+                else:
+                    # if the attribute had no value.
+                    attr[hist_key] = a[0]
+                    changes.add(hist_key)
             else:
-                # if the attribute had no value.
-                attr[hist_col.key] = a[0]
-                obj_changed = True
+                # untouched : the current value is the old one.
+                # expired object attributes and also deferred cols might not
+                # be in the dict.  force it to load no matter what by
+                # using getattr().
+                if prop_key not in obj_dict:
+                    getattr(obj, prop_key)
+                attr[hist_key] = obj_dict.get(prop_key)
+        obj_changed = obj_changed or bool(changes)
+        rows.append((table, columns, attr, changes))
 
     if not obj_changed:
         # not changed, but we have relationships.  OK
         # check those too
-        for prop in obj_mapper.iterate_properties:
-            if isinstance(prop, RelationshipProperty) and \
-                    attributes.get_history(
-                        obj, prop.key,
-                        passive=attributes.PASSIVE_NO_INITIALIZE).has_changes():
-                for p in prop.local_columns:
-                    if p.foreign_keys:
-                        obj_changed = True
-                        break
-                if obj_changed is True:
-                    break
+        for key in relationships:
+            if attributes.get_history(
+                    obj, key,
+                    passive=attributes.PASSIVE_NO_INITIALIZE).has_changes():
+                obj_changed = True
+                break
 
     if not obj_changed and not deleted:
-        return
-
-    attr['version'] = obj.version
-    hist = history_cls()
-    for key, value in attr.items():
-        setattr(hist, key, value)
-    session.add(hist)
-    obj.version += 1
+        return []
+
+    # a detached copy merged over a newer version (ie uploaded from a DB that
+    # missed the latest changes) must not rewind the version
+    version = obj.version
+    if 'version' in committed:
+        a, u, d = attributes.get_history(obj, 'version')
+        if d and d[0] is not None:
+            version = d[0]
+
+    # deleted records and every Nth version keep the full record,
+    # to rebuild the diffs from. So do changes made through a relationship,
+    # as the foreign key only moves later in the flush.
+    snapshot_every = obj.__history_snapshot_every__
+    as_diff = snapshot_every and not deleted and version % snapshot_every \
+        and any(changes for table, columns, attr, changes in rows)
+
+    versions = []
+    for table, columns, attr, changes in rows:
+        attr['version'] = version
+        attr['changes'] = None
+        if as_diff:
+            for hist_key, prop_key, primary_key in columns:
+                if not primary_key and hist_key not in changes:
+                    attr[hist_key] = None
+            attr['changes'] = ','.join(sorted(changes))
+        versions.append((table, attr))
+    obj.version = version + 1
+    return versions
 
 
 def versioned_session(session):
+    """
+    Records the history of the versioned objects flushed by a session,
+    or by every session of a sessionmaker.
+    Sessions with info['versioning'] set to False are left alone.
+    """
     @event.listens_for(session, 'before_flush')
     def before_flush(session, flush_context, instances):
+        if session.info.get('versioning', True) is False:
+            return
+        # objects whose history was written by another DB, ie uploaded along with them
+        versioned_elsewhere = session.info.get('versioned_elsewhere', set())
+        # one executemany per history table for the whole flush,
+        # rather than one unit of work object per version
+        inserts = util.OrderedDict()
         for obj in versioned_objects(session.dirty):
-            create_version(obj, session)
+            if attributes.instance_state(obj).key in versioned_elsewhere:
+                continue
+            for table, values in create_version(obj, session):
+                inserts.setdefault(table, []).append(values)
         for obj in versioned_objects(session.deleted):
-            create_version(obj, session, deleted=True)
+            for table, values in create_version(obj, session, deleted=True):
+                inserts.setdefault(table, []).append(values)
+        for table, rows in inserts.items():
+            session.execute(table.insert(), rows)
+
+    @event.listens_for(session, 'after_flush')
+    def after_flush(session, flush_context):
+        session.info.pop('versioned_elsewhere', None)
+
+
+def skip_version(session, obj):
+    """
+    The next flush of the session won't version this object, its history having been written already.
+    """
+    session.info.setdefault('versioned_elsewhere', set()).add(attributes.instance_state(obj).key)
+
+
+@contextlib.contextmanager
+def versioning_paused(session):
+    """
+    Writes made in this block leave no history, ie records downloaded as they are from the main DB.
+    """
+    previous = session.info.get('versioning', True)
+    session.info['versioning'] = False
+    try:
+        yield session
+    finally:
+        session.info['versioning'] = previous
@@ -0,0 +1,187 @@
+__author__ = 'Man'
+
+import logging
+
+import sqlalchemy
+
+from . import AlchemyClassDefs as Acd
+
+logger = logging.getLogger(__name__)
+
+closure = Acd.BaseClosure.__table__
+
+
+def subtree(session, root_base_pkey):
+    """
+    A base and all its sub-bases, closest first, from the closure table.
+    :param root_base_pkey: root of the extracted subtree
+    :return: list of base codes, empty for an unknown base
+    """
+    return [code for code, in session.query(Acd.BaseClosure.descendant)
+            .filter(Acd.BaseClosure.ancestor == root_base_pkey)
+            .order_by(Acd.BaseClosure.depth)]
+
+
+def ancestors(session, base_code):
+    """
+    The chain of bases from this one up to the root, this base first.
+    :return: list of base codes, empty for an unknown base
+    """
+    return [code for code, in session.query(Acd.BaseClosure.ancestor)
+            .filter(Acd.BaseClosure.descendant == base_code)
+            .order_by(Acd.BaseClosure.depth)]
+
+
+def would_create_cycle(session, base_code, new_parent):
+    """
+    Making a base the child of one of its own sub-bases (or of itself) would cut it from the tree.
+    """
+    if new_parent is None or new_parent == base_code:
+        return False
+    return session.query(Acd.BaseClosure) \
+        .filter(Acd.BaseClosure.ancestor == base_code,
+                Acd.BaseClosure.descendant == new_parent) \
+        .count() > 0
+
+
+def index_tree(session):
+    """
+    Builds the closure table of a DB that predates it, or holds bases written without their place.
+    Run when the tables are created or upgraded, so lookups never have to.
+    :return: True if the table was rebuilt
+    """
+    unplaced = session.query(Acd.WorkBase) \
+        .filter(~sqlalchemy.exists().where(sqlalchemy.and_(Acd.BaseClosure.ancestor == Acd.WorkBase.code,
+                                                           Acd.BaseClosure.descendant == Acd.WorkBase.code))) \
+        .count()
+    if unplaced:
+        rebuild_closure(session)
+        return True
+    return False
+
+
+def is_indexed(session, base_code):
+    return session.query(Acd.BaseClosure) \
+        .filter(Acd.BaseClosure.ancestor == base_code,
+                Acd.BaseClosure.descendant == base_code) \
+        .count() > 0
+
+
+def place_base(session, base_code, parent):
+    """
+    Records a base at its place in the tree, for a base just created, re-parented, downloaded or uploaded.
+    New bases are linked under their parent and adopt any sub-bases that arrived before them.
+    Re-parenting moves the whole subtree : paths from the old ancestors are deleted, paths from the new ones
+    inserted, in the caller's transaction so the tree is never seen half-moved.
+    :param parent: code of the parent base; the root is its own parent
+    :return: True if the tree changed
+    """
+    if parent == base_code:
+        parent = None
+    if parent and not is_indexed(session, parent):
+        if session.query(Acd.WorkBase).filter(Acd.WorkBase.code == parent).count():
+            # Parent written without its place : the index is repaired from the parent links
+            rebuild_closure(session)
+            return True
+        # Top of a site's subtree, whose parent isn't held here
+        parent = None
+
+    if not is_indexed(session, base_code):
+        session.execute(closure.insert(), {'ancestor': base_code, 'descendant': base_code, 'depth': 0})
+        if parent:
+            link_subtree(session, base_code, parent)
+        orphans = session.query(Acd.WorkBase.code) \
+            .filter(Acd.WorkBase.parent == base_code,
+                    Acd.WorkBase.code != base_code,
+                    ~sqlalchemy.exists().where(sqlalchemy.and_(Acd.BaseClosure.descendant == Acd.WorkBase.code,
+                                                               Acd.BaseClosure.depth == 1))) \
+            .all()
+        for orphan, in orphans:
+            if is_indexed(session, orphan):
+                link_subtree(session, orphan, base_code)
+        return True
+
+    current_parent = session.query(Acd.BaseClosure.ancestor) \
+        .filter(Acd.BaseClosure.descendant == base_code,
+                Acd.BaseClosure.depth == 1) \
+        .scalar()
+    if current_parent == parent:
+        return False
+    if would_create_cycle(session, base_code, parent):
+        raise ValueError(_("Base {code} can't become a child of its own sub-base {parent}")
+                         .format(code=base_code, parent=parent))
+
+    moved = sqlalchemy.select([closure.c.descendant]).where(closure.c.ancestor == base_code)
+    old_ancestors = sqlalchemy.select([closure.c.ancestor]).where(sqlalchemy.and_(closure.c.descendant == base_code,
+                                                                                  closure.c.ancestor != base_code))
+    session.execute(closure.delete().where(sqlalchemy.and_(closure.c.descendant.in_(moved),
+                                                           closure.c.ancestor.in_(old_ancestors))))
+    if parent:
+        link_subtree(session, base_code, parent)
+    return True
+
+
+def place_new_bases(session, bases):
+    """
+    Records a batch of brand new leaf bases under parents in the tree or earlier in the batch, ie an import :
+    one read of the parents' ancestors and one insert, whatever the size of the batch.
+    A base whose parent isn't held here tops its own subtree, as in place_base.
+    :param bases: list of (code, parent code), parents before their sub-bases
+    :return: list of the paths inserted, as (ancestor, descendant, depth)
+    """
+    codes = set(code for code, parent in bases)
+    parents = list(set(parent for code, parent in bases if parent not in codes))
+    above = dict()
+    for start in range(0, len(parents), 500):
+        chunk = parents[start:start + 500]
+        for descendant, ancestor, depth in session.query(Acd.BaseClosure.descendant, Acd.BaseClosure.ancestor,
+                                                         Acd.BaseClosure.depth) \
+                .filter(Acd.BaseClosure.descendant.in_(chunk)):
+            above.setdefault(descendant, list()).append((ancestor, depth))
+
+    paths = list()
+    for code, parent in bases:
+        paths.append((code, code, 0))
+        paths.extend((ancestor, code, depth + 1) for ancestor, depth in above.get(parent, list()))
+        above[code] = [(code, 0)] + [(ancestor, depth + 1) for ancestor, depth in above.get(parent, list())]
+    session.execute(closure.insert(), [{'ancestor': ancestor, 'descendant': descendant, 'depth': depth}
+                                       for ancestor, descendant, depth in paths])
+    return paths
+
+
+def link_subtree(session, base_code, parent):
+    """
+    Connects the subtree rooted at base_code to every ancestor of parent, parent included.
+    """
+    above = closure.alias('above')
+    below = closure.alias('below')
+    paths = sqlalchemy.select([above.c.ancestor, below.c.descendant, above.c.depth + below.c.depth + 1]) \
+        .where(sqlalchemy.and_(above.c.descendant == parent,
+                               below.c.ancestor == base_code))
+    session.execute(closure.insert().from_select(['ancestor', 'descendant', 'depth'], paths))
+
+
+def rebuild_closure(session):
+    """
+    Recomputes the whole closure table from the parent links, ie for a DB created before it existed.
+    Works with a session or a plain connection.
+    """
+    parents = dict((code, parent) for code, parent in
+                   session.execute(sqlalchemy.select([Acd.WorkBase.code, Acd.WorkBase.parent])))
+    rows = list()
+    for code in parents:
+        depth = 0
+        ancestor = code
+        seen = set()
+        while ancestor in parents and ancestor not in seen:
+            rows.append({'ancestor': ancestor, 'descendant': code, 'depth': depth})
+            seen.add(ancestor)
+            if parents[ancestor] == ancestor:
+                break
+            ancestor = parents[ancestor]
+            depth += 1
+    session.execute(closure.delete())
+    if rows:
+        session.execute(closure.insert(), rows)
+    logger.info(_("Org tree index rebuilt with {no} paths")
+                .format(no=len(rows)))
@@ -0,0 +1,78 @@
+__author__ = 'Man'
+
+import logging
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+
+logger = logging.getLogger(__name__)
+
+
+class H3UnitOfWork:
+    """
+    A session opened once by a GUI screen or a batch job and passed through the core calls.
+    Related lookups share one connection and one identity map; nothing is committed until the owner says so.
+    """
+
+    def __init__(self, session_factory):
+        """
+        :param session_factory: the sessionmaker (local or remote) to draw the session from
+        :return:
+        """
+        self.session = session_factory()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.rollback()
+        else:
+            self.commit()
+        self.close()
+        return False
+
+    def commit(self):
+        """
+        Commits everything written through this unit of work since the last commit.
+        :return: True on success; on failure the work is rolled back and False returned
+        """
+        try:
+            self.session.commit()
+            return True
+        except sqlalchemy.exc.SQLAlchemyError:
+            logger.exception(_("Failed to commit unit of work"))
+            self.session.rollback()
+            return False
+
+    def rollback(self):
+        self.session.rollback()
+
+    def close(self):
+        """
+        Ends the unit of work. Pending changes that weren't committed are discarded.
+        """
+        self.session.close()
+
+    @staticmethod
+    def snapshot(records):
+        """
+        Copies records into detached objects that outlive the unit of work
+        and can be edited without dirtying its session.
+        :param records: a mapped object or a list of them
+        :return: the copy, or a list of copies
+        """
+        if isinstance(records, list):
+            return [snapshot_record(record) for record in records]
+        return snapshot_record(records)
+
+
+def snapshot_record(record):
+    if not record:
+        return record
+    mapper = sqlalchemy.inspect(record).mapper
+    copy = mapper.class_()
+    for column_attr in mapper.column_attrs:
+        setattr(copy, column_attr.key, getattr(record, column_attr.key))
+    return copy
@@ -0,0 +1,71 @@
+"""
+Writes the same bases export with precomputed parent names and with a live lookup formula per row,
+then compares file sizes, write times and the time openpyxl takes to open each file again.
+openpyxl doesn't calculate : the formulas and validation rules Excel would have to evaluate on opening are counted.
+
+    python benchmarks/bench_exports.py [--bases 50000]
+"""
+
+__author__ = 'Emmanuel'
+
+import argparse
+import builtins
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+builtins.__dict__.setdefault('_', lambda message: message)
+
+import openpyxl
+
+from H3.XLLent import xlexport as XLexport
+
+
+def bases(count):
+    """
+    A tree of bases as export_bases reads them : parent of BASE-i is BASE-i//2.
+    """
+    opened = datetime.date(2000, 1, 1)
+    for serial in range(1, count + 1):
+        parent = max(serial // 2, 1)
+        yield ('BASE-{}'.format(serial), 'B{}'.format(serial), 'BASE-{}'.format(parent), 'B{}'.format(parent),
+               'Base number {}'.format(serial), opened, None, 'FR', 'Europe/Paris')
+
+
+def measure(count, lookup, directory):
+    os.chdir(directory)
+    start = time.perf_counter()
+    filename = XLexport.bases_writer(bases(count), lookup)
+    written = time.perf_counter() - start
+    size = os.path.getsize(filename)
+    start = time.perf_counter()
+    wb = openpyxl.load_workbook(filename)
+    opened = time.perf_counter() - start
+    formulas = sum(1 for row in wb["Bases"].iter_rows(values_only=True)
+                   for value in row if isinstance(value, str) and value.startswith('='))
+    rules = len(wb["Data"].data_validations.dataValidation)
+    wb.close()
+    os.remove(filename)
+    return written, size, opened, formulas, rules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--bases', type=int, default=50000)
+    args = parser.parse_args()
+
+    here = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        for name, lookup in (("precomputed names", False), ("lookup per row", True)):
+            written, size, opened, formulas, rules = measure(args.bases, lookup, directory)
+            print("{name:<18} {size:>10} bytes, written in {written:.2f}s, opened in {opened:.2f}s, "
+                  "{formulas} formulas, {rules} validation rules"
+                  .format(name=name, size=size, written=written, opened=opened, formulas=formulas, rules=rules))
+        os.chdir(here)
+
+
+if __name__ == '__main__':
+    main()
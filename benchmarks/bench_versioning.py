@@ -0,0 +1,83 @@
+"""
+Times a flush of 10k updated WorkBase records on an in-memory SQLite DB, with and without the history layer,
+and counts the statements each one sends.
+
+    python benchmarks/bench_versioning.py [--records 10000]
+"""
+
+__author__ = 'Man'
+
+import argparse
+import builtins
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+builtins.__dict__.setdefault('_', lambda message: message)
+
+import sqlalchemy
+import sqlalchemy.orm
+
+from H3.core import AlchemyClassDefs as Acd
+from H3.core.AlchemyTemporal import versioned_session
+
+
+def populate(session, records):
+    session.add(Acd.WorkBase(code='BASE-1', serial=1, identifier='ROOT', parent='BASE-1', period='PERMANENT',
+                             opened_date=datetime.date(2000, 1, 1)))
+    session.flush()
+    session.bulk_insert_mappings(Acd.WorkBase, [dict(code='BASE-{}'.format(serial), serial=serial, base='BASE-1',
+                                                     period='PERMANENT', identifier='B{}'.format(serial),
+                                                     parent='BASE-1', full_name='Base {}'.format(serial),
+                                                     opened_date=datetime.date(2000, 1, 1), country='FR',
+                                                     version=1)
+                                                for serial in range(2, records + 2)])
+    session.commit()
+
+
+def run(records, versioned):
+    engine = sqlalchemy.create_engine('sqlite://')
+    Acd.Base.metadata.create_all(engine)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    populate(session, records)
+
+    statements = [0]
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements[0] += 1
+
+    if versioned:
+        versioned_session(session)
+    bases = session.query(Acd.WorkBase).filter(Acd.WorkBase.code != 'BASE-1').all()
+    session.expire_all()  # as after a commit : the old values have to come back from the DB
+    for base in bases:
+        base.full_name = base.full_name + ' (renamed)'
+        base.closed_date = datetime.date(2020, 1, 1)
+    statements[0] = 0
+    start = time.perf_counter()
+    session.flush()
+    elapsed = time.perf_counter() - start
+    history_rows = session.query(Acd.WorkBase.__history_mapper__.class_).count() if versioned else 0
+    session.rollback()
+    session.close()
+    engine.dispose()
+    return elapsed, statements[0], history_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=10000)
+    args = parser.parse_args()
+
+    for versioned in (False, True):
+        elapsed, statements, history_rows = run(args.records, versioned)
+        print("{mode:<10} {records} updates flushed in {elapsed:.3f}s, {statements} statements, "
+              "{history} history rows".format(mode="versioned" if versioned else "plain", records=args.records,
+                                              elapsed=elapsed, statements=statements, history=history_rows))
+
+
+if __name__ == '__main__':
+    main()